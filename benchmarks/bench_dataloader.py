@@ -0,0 +1,63 @@
+"""End-to-end benchmark of reading an epoch through the train dataloader of an `ABaseDataModule`,
+for several worker counts and batch sizes. Times are reported per sample (the inverse of the
+throughput in samples/s). Workers are persistent, so worker startup is only paid in the warmup.
+
+    python benchmarks/bench_dataloader.py --scale medium --workers 0 2 4 --batch-sizes 64 512 -o results.json
+"""
+import time
+
+import pyperf
+
+from hscitorchutil.dataset import ABaseDataModule, EntryTransformingMapDataset, LinearMapSubset
+from hscitorchutil.sqlite import SQLiteDataset
+
+from data import DEFAULT_DATA_DIR, SCALES, sqlite_database
+
+
+def _text_lengths(batch):
+    return [(value, len(text)) for _, value, text in batch]
+
+
+class BenchmarkDataModule(ABaseDataModule):
+    def __init__(self, sqlite_filename: str, samples: int, **kwargs):
+        super().__init__(pin_memory=False, **kwargs)
+        dataset = SQLiteDataset(sqlite_filename, "samples", "entry_number", "id, value, text", "id")
+        self.train_dataset = LinearMapSubset(EntryTransformingMapDataset(dataset, _text_lengths), 0, samples)
+
+
+def bench_epoch(loops: int, datamodule: BenchmarkDataModule) -> float:
+    dataloader = datamodule.train_dataloader()
+    start = time.perf_counter()
+    for _ in range(loops):
+        for _ in dataloader:
+            pass
+    return time.perf_counter() - start
+
+
+def _add_cmdline_args(cmd, args):
+    cmd.extend(("--scale", args.scale, "--data-dir", args.data_dir, "--samples", str(args.samples),
+                "--workers", *map(str, args.workers), "--batch-sizes", *map(str, args.batch_sizes)))
+
+
+def main():
+    runner = pyperf.Runner(add_cmdline_args=_add_cmdline_args)
+    runner.argparser.add_argument("--scale", choices=list(SCALES), default="small")
+    runner.argparser.add_argument("--data-dir", default=DEFAULT_DATA_DIR)
+    runner.argparser.add_argument("--samples", type=int, default=8192, help="The number of samples in an epoch")
+    runner.argparser.add_argument("--workers", type=int, nargs="+", default=[0, 2, 4])
+    runner.argparser.add_argument("--batch-sizes", type=int, nargs="+", default=[64, 512])
+    args = runner.parse_args()
+    runner.metadata["scale"] = args.scale
+
+    sqlite_filename = sqlite_database(args.data_dir, args.scale)
+    samples = min(args.samples, SCALES[args.scale])
+    for workers in args.workers:
+        for batch_size in args.batch_sizes:
+            datamodule = BenchmarkDataModule(sqlite_filename, samples, batch_size=batch_size,
+                                             num_train_workers=workers)
+            runner.bench_time_func(f"dataloader-workers{workers}-batch{batch_size}", bench_epoch, datamodule,
+                                   inner_loops=samples)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""Micro-benchmarks of `__getitem__` and `__getitems__` on SQLiteDataset, the dataset wrappers and
+EDZipMapDataset, and of `remove_nones_from_batch`. Times are reported per sample.
+
+    python benchmarks/bench_datasets.py --scale medium -o results.json
+"""
+import re
+import time
+
+import numpy as np
+import pyperf
+
+from hscitorchutil.dataset import (EntryTransformingMapDataset, IdBasedMapSubset, KeyTransformingMapDataset,
+                                   LinearMapSubset, ShuffledMapDataset, UnionMapDataset, identity_transformation,
+                                   remove_nones_from_batch)
+from hscitorchutil.sqlite import SQLiteDataset
+from hscitorchutil.zipdataset import EDZipMapDataset
+
+from data import DEFAULT_DATA_DIR, SCALES, sqlite_database, zip_archive
+
+SINGLE_ITEMS = 256
+
+
+def _text_lengths(batch):
+    return [(id, value, len(text)) for id, value, text in batch]
+
+
+def _samples(data_dir: str, scale: str, shard: int = 0) -> SQLiteDataset:
+    return SQLiteDataset(sqlite_database(data_dir, scale, shard), "samples", "entry_number", "id, value, text", "id")
+
+
+def datasets(data_dir: str, scale: str) -> dict:
+    """The benchmarked datasets, by name"""
+    n = SCALES[scale]
+    samples = _samples(data_dir, scale)
+    zip_path, directory = zip_archive(data_dir, scale)
+    return {
+        "SQLiteDataset": samples,
+        "LinearMapSubset": LinearMapSubset(samples, n // 4, 3 * n // 4),
+        "IdBasedMapSubset": IdBasedMapSubset(samples, np.random.default_rng(0).permutation(n)[:n // 2]),
+        "ShuffledMapDataset": ShuffledMapDataset(samples, seed=0),
+        "ShuffledMapDataset-blocks": ShuffledMapDataset(samples, seed=0, block_size=64),
+        "UnionMapDataset": UnionMapDataset([samples, _samples(data_dir, scale, 1)]),
+        "KeyTransformingMapDataset": KeyTransformingMapDataset(samples, identity_transformation),
+        "EntryTransformingMapDataset": EntryTransformingMapDataset(samples, _text_lengths),
+        "EDZipMapDataset": EDZipMapDataset(zip_path, directory),
+    }
+
+
+def bench_getitem(loops: int, dataset, indices: np.ndarray) -> float:
+    indices = indices[:SINGLE_ITEMS].tolist()
+    start = time.perf_counter()
+    for _ in range(loops):
+        for idx in indices:
+            dataset[idx]
+    return time.perf_counter() - start
+
+
+def bench_getitems(loops: int, dataset, batches: list[list[int]]) -> float:
+    start = time.perf_counter()
+    for _ in range(loops):
+        for batch in batches:
+            dataset.__getitems__(batch)
+    return time.perf_counter() - start
+
+
+def bench_collate(loops: int, batches: list[list]) -> float:
+    start = time.perf_counter()
+    for _ in range(loops):
+        for batch in batches:
+            remove_nones_from_batch(batch)
+    return time.perf_counter() - start
+
+
+def _add_cmdline_args(cmd, args):
+    cmd.extend(("--scale", args.scale, "--data-dir", args.data_dir,
+               "--batch-size", str(args.batch_size), "--batches", str(args.batches), "--filter", args.filter))
+
+
+def main():
+    runner = pyperf.Runner(add_cmdline_args=_add_cmdline_args)
+    runner.argparser.add_argument("--scale", choices=list(SCALES), default="small")
+    runner.argparser.add_argument("--data-dir", default=DEFAULT_DATA_DIR)
+    runner.argparser.add_argument("--batch-size", type=int, default=256)
+    runner.argparser.add_argument("--batches", type=int, default=8)
+    runner.argparser.add_argument("--filter", default="", help="Only run benchmarks whose name matches this regular expression")
+    args = runner.parse_args()
+    selected = re.compile(args.filter).search
+    runner.metadata["scale"] = args.scale
+
+    rng = np.random.default_rng(0)
+    for name, dataset in datasets(args.data_dir, args.scale).items():
+        n = len(dataset)
+        indices = rng.integers(0, n, args.batch_size * args.batches)
+        random_batches = [batch.tolist() for batch in np.split(indices, args.batches)]
+        sequential_batches = [list(range(start, start + args.batch_size))
+                              for start in rng.integers(0, n - args.batch_size, args.batches).tolist()]
+        if selected(f"{name}.__getitem__"):
+            runner.bench_time_func(f"{name}.__getitem__", bench_getitem, dataset, indices,
+                                   inner_loops=min(SINGLE_ITEMS, len(indices)))
+        if selected(f"{name}.__getitems__-random"):
+            runner.bench_time_func(f"{name}.__getitems__-random", bench_getitems, dataset, random_batches,
+                                   inner_loops=len(indices))
+        if selected(f"{name}.__getitems__-sequential"):
+            runner.bench_time_func(f"{name}.__getitems__-sequential", bench_getitems, dataset, sequential_batches,
+                                   inner_loops=len(indices))
+
+    samples = _samples(args.data_dir, args.scale)
+    batches = [samples.__getitems__(rng.integers(0, len(samples), args.batch_size).tolist())
+               for _ in range(args.batches)]
+    for batch in batches:
+        batch[::16] = [None] * len(batch[::16])
+    if selected("remove_nones_from_batch"):
+        runner.bench_time_func("remove_nones_from_batch", bench_collate, batches,
+                               inner_loops=args.batch_size * args.batches)
+
+
+if __name__ == "__main__":
+    main()
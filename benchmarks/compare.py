@@ -0,0 +1,66 @@
+"""Compares benchmark results against a baseline, failing if any benchmark regressed.
+
+    python benchmarks/compare.py baseline.json results.json --threshold 0.1
+
+A benchmark regresses if its mean time grows by more than `threshold` and the means are further
+apart than their standard deviations, so that noisy benchmarks do not fail spuriously. Benchmarks
+of the baseline missing from the results also fail the comparison, unless `--allow-missing` is
+given (e.g. when comparing a run restricted with `--filter`).
+"""
+import sys
+
+import click
+import pyperf
+
+
+def _format(seconds: float) -> str:
+    for unit, scale in (("s", 1.0), ("ms", 1e-3), ("us", 1e-6)):
+        if seconds >= scale:
+            return f"{seconds / scale:.2f} {unit}"
+    return f"{seconds / 1e-9:.1f} ns"
+
+
+def compare(baseline: pyperf.BenchmarkSuite, results: pyperf.BenchmarkSuite, threshold: float) -> tuple[list[str], list[str]]:
+    """Prints a comparison of each benchmark and returns the names of the regressed ones and of
+    the ones missing from the results"""
+    baselines = {benchmark.get_name(): benchmark for benchmark in baseline.get_benchmarks()}
+    regressions = []
+    for benchmark in results.get_benchmarks():
+        name = benchmark.get_name()
+        if name not in baselines:
+            click.echo(f"{name}: {_format(benchmark.mean())} (not in baseline)")
+            continue
+        base = baselines.pop(name)
+        ratio = benchmark.mean() / base.mean()
+        stdevs = (benchmark.stdev() if benchmark.get_nvalue() > 1 else 0.0) + \
+            (base.stdev() if base.get_nvalue() > 1 else 0.0)
+        regressed = ratio > 1 + threshold and benchmark.mean() - base.mean() > stdevs
+        click.echo(f"{name}: {_format(base.mean())} -> {_format(benchmark.mean())} ({ratio:.2f}x)"
+                   + (" REGRESSION" if regressed else ""))
+        if regressed:
+            regressions.append(name)
+    for name in baselines:
+        click.echo(f"{name}: missing from results")
+    return regressions, list(baselines)
+
+
+@click.command()
+@click.argument("baseline", type=click.Path(exists=True, dir_okay=False))
+@click.argument("results", type=click.Path(exists=True, dir_okay=False))
+@click.option("--threshold", "-t", default=0.1, show_default=True, help="The allowed relative slowdown")
+@click.option("--allow-missing", is_flag=True, help="Do not fail if benchmarks of the baseline are missing from the results")
+def main(baseline: str, results: str, threshold: float, allow_missing: bool):
+    regressions, missing = compare(pyperf.BenchmarkSuite.load(baseline), pyperf.BenchmarkSuite.load(results), threshold)
+    failed = False
+    if regressions:
+        click.echo(f"{len(regressions)} benchmark(s) regressed by more than {threshold:.0%}", err=True)
+        failed = True
+    if missing and not allow_missing:
+        click.echo(f"{len(missing)} benchmark(s) missing from the results", err=True)
+        failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
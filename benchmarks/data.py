@@ -0,0 +1,68 @@
+"""Synthetic benchmark data: SQLite databases and zip archives of a given scale, generated once
+into a data directory and reused by later runs (and by the worker processes of pyperf)."""
+import os
+import sqlite3
+import tempfile
+import zipfile
+
+import numpy as np
+
+from hscitorchutil.zipdirectory import create_sqlite_directory
+
+SCALES = {"small": 10_000, "medium": 100_000, "large": 1_000_000}
+DEFAULT_DATA_DIR = os.path.join(tempfile.gettempdir(), "hscitorchutil-benchmarks")
+
+_WORDS = np.array(["lorem", "ipsum", "dolor", "sit", "amet", "consectetur", "adipiscing", "elit",
+                  "sed", "do", "eiusmod", "tempor", "incididunt", "ut", "labore", "et", "dolore"])
+
+
+def _texts(rng: np.random.Generator, n: int, max_words: int) -> list[str]:
+    lengths = rng.integers(1, max_words, n)
+    words = _WORDS[rng.integers(0, len(_WORDS), int(lengths.sum()))]
+    ends = np.cumsum(lengths)
+    return [" ".join(words[end - length:end]) for end, length in zip(ends.tolist(), lengths.tolist())]
+
+
+def sqlite_database(data_dir: str, scale: str, shard: int = 0) -> str:
+    """Returns a database with a table `samples(entry_number, id, value, text)` of `SCALES[scale]`
+    rows, creating it if necessary"""
+    path = os.path.join(data_dir, f"{scale}-{shard}.sqlite3")
+    if os.path.exists(path):
+        return path
+    os.makedirs(data_dir, exist_ok=True)
+    n = SCALES[scale]
+    rng = np.random.default_rng(shard)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    con = sqlite3.connect(tmp_path)
+    try:
+        con.execute("CREATE TABLE samples (entry_number INTEGER PRIMARY KEY, id TEXT, value INTEGER, text TEXT)")
+        for start in range(0, n, 100_000):
+            stop = min(start + 100_000, n)
+            con.executemany("INSERT INTO samples VALUES (?, ?, ?, ?)", zip(
+                range(start, stop), (f"id_{shard}_{i}" for i in range(start, stop)),
+                rng.integers(0, 1 << 31, stop - start).tolist(), _texts(rng, stop - start, 64)))
+        con.execute("CREATE INDEX idx_samples_id ON samples (id)")
+        con.commit()
+    finally:
+        con.close()
+    os.replace(tmp_path, path)
+    return path
+
+
+def zip_archive(data_dir: str, scale: str) -> tuple[str, str]:
+    """Returns a zip archive of `SCALES[scale] // 10` members (alternately stored and deflated) and
+    its SQLite directory, creating them if necessary"""
+    path = os.path.join(data_dir, f"{scale}.zip")
+    directory = path + ".offsets.sqlite3"
+    if os.path.exists(directory):
+        return path, directory
+    os.makedirs(data_dir, exist_ok=True)
+    rng = np.random.default_rng(0)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with zipfile.ZipFile(tmp_path, "w") as zf:
+        for i, text in enumerate(_texts(rng, SCALES[scale] // 10, 512)):
+            zf.writestr(f"member_{i}.txt", text, compress_type=zipfile.ZIP_DEFLATED if i % 2 else zipfile.ZIP_STORED)
+    os.replace(tmp_path, path)
+    create_sqlite_directory(path, f"{directory}.{os.getpid()}.tmp", progress=False)
+    os.replace(f"{directory}.{os.getpid()}.tmp", directory)
+    return path, directory
@@ -0,0 +1,312 @@
+import abc
+import hashlib
+import multiprocessing
+import os
+import pickle
+import sys
+import weakref
+from collections import OrderedDict
+from multiprocessing.context import get_spawning_popen
+from multiprocessing.shared_memory import SharedMemory
+from typing import Any, Callable, Hashable, Optional
+
+import numpy as np
+import torch
+
+
+def approximate_size(obj: Any) -> int:
+    """Approximates the number of bytes held by a sample, counting tensor and array payloads in full."""
+    if isinstance(obj, torch.Tensor):
+        return obj.element_size() * obj.nelement() + sys.getsizeof(obj)
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes + sys.getsizeof(obj)
+    if isinstance(obj, memoryview):
+        return obj.nbytes + sys.getsizeof(obj)
+    if isinstance(obj, (tuple, list)):
+        return sys.getsizeof(obj) + sum(approximate_size(item) for item in obj)
+    if isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(approximate_size(key) + approximate_size(value) for key, value in obj.items())
+    return sys.getsizeof(obj)
+
+
+class SampleCache(abc.ABC):
+    """A byte-budgeted cache of dataset samples"""
+
+    @abc.abstractmethod
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        pass
+
+    @abc.abstractmethod
+    def put(self, key: Hashable, value: Any) -> None:
+        pass
+
+
+class LRUCache(SampleCache):
+    r"""
+    A process-local cache evicting the least recently used samples once `max_bytes` is exceeded.
+
+    Args:
+        max_bytes (int): The memory budget of the cache
+        sizeof (Callable[[Any], int]): Function returning the size of a sample in bytes
+    """
+
+    def __init__(self, max_bytes: int, sizeof: Callable[[Any], int] = approximate_size):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.bytes = 0
+        self._entries: OrderedDict[Hashable, tuple[Any, int]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._entries.get(key)
+        if entry is None:
+            return default
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key: Hashable, value: Any) -> None:
+        size = self.sizeof(value)
+        if size > self.max_bytes:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.bytes -= old[1]
+        while self.bytes + size > self.max_bytes:
+            _, (_, evicted_size) = self._entries.popitem(last=False)
+            self.bytes -= evicted_size
+        self._entries[key] = (value, size)
+        self.bytes += size
+
+    def __getstate__(self):
+        return (self.max_bytes, self.sizeof)
+
+    def __setstate__(self, state):
+        (self.max_bytes, self.sizeof) = state
+        self.bytes = 0
+        self._entries = OrderedDict()
+
+
+class ARCCache(SampleCache):
+    r"""
+    A process-local cache using the Adaptive Replacement Cache policy (Megiddo & Modha, 2003), with
+    list sizes measured in bytes instead of entries. ARC balances between recency and frequency, so
+    that a single scan over a large dataset does not flush samples that are read repeatedly.
+
+    Args:
+        max_bytes (int): The memory budget of the cache
+        sizeof (Callable[[Any], int]): Function returning the size of a sample in bytes
+    """
+
+    def __init__(self, max_bytes: int, sizeof: Callable[[Any], int] = approximate_size):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self._reset()
+
+    def _reset(self):
+        # t1/t2 hold (value, size), b1/b2 the sizes of recently evicted keys
+        self._t1: OrderedDict[Hashable, tuple[Any, int]] = OrderedDict()
+        self._t2: OrderedDict[Hashable, tuple[Any, int]] = OrderedDict()
+        self._b1: OrderedDict[Hashable, int] = OrderedDict()
+        self._b2: OrderedDict[Hashable, int] = OrderedDict()
+        self._t1_bytes = self._t2_bytes = self._b1_bytes = self._b2_bytes = 0
+        self._target = 0.0
+
+    @property
+    def bytes(self) -> int:
+        return self._t1_bytes + self._t2_bytes
+
+    def __len__(self) -> int:
+        return len(self._t1) + len(self._t2)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._t1.pop(key, None)
+        if entry is not None:
+            self._t1_bytes -= entry[1]
+            self._t2[key] = entry
+            self._t2_bytes += entry[1]
+            return entry[0]
+        entry = self._t2.get(key)
+        if entry is not None:
+            self._t2.move_to_end(key)
+            return entry[0]
+        return default
+
+    def _replace(self, size: int, in_b2: bool) -> None:
+        while self._t1_bytes + self._t2_bytes + size > self.max_bytes:
+            if self._t1 and (self._t1_bytes > self._target or (in_b2 and self._t1_bytes >= self._target) or not self._t2):
+                key, (_, evicted_size) = self._t1.popitem(last=False)
+                self._t1_bytes -= evicted_size
+                self._b1[key] = evicted_size
+                self._b1_bytes += evicted_size
+            else:
+                key, (_, evicted_size) = self._t2.popitem(last=False)
+                self._t2_bytes -= evicted_size
+                self._b2[key] = evicted_size
+                self._b2_bytes += evicted_size
+
+    def _trim_ghosts(self) -> None:
+        while self._b1 and self._t1_bytes + self._b1_bytes > self.max_bytes:
+            self._b1_bytes -= self._b1.popitem(last=False)[1]
+        while self._b2 and self._t1_bytes + self._t2_bytes + self._b1_bytes + self._b2_bytes > 2 * self.max_bytes:
+            self._b2_bytes -= self._b2.popitem(last=False)[1]
+
+    def put(self, key: Hashable, value: Any) -> None:
+        size = self.sizeof(value)
+        if size > self.max_bytes:
+            return
+        for t in (self._t1, self._t2):
+            old = t.pop(key, None)
+            if old is not None:
+                if t is self._t1:
+                    self._t1_bytes -= old[1]
+                else:
+                    self._t2_bytes -= old[1]
+        if key in self._b1:
+            self._target = min(self._target + max(self._b2_bytes / max(self._b1_bytes, 1), 1) * size, self.max_bytes)
+            self._b1_bytes -= self._b1.pop(key)
+            self._replace(size, False)
+            self._t2[key] = (value, size)
+            self._t2_bytes += size
+        elif key in self._b2:
+            self._target = max(self._target - max(self._b1_bytes / max(self._b2_bytes, 1), 1) * size, 0)
+            self._b2_bytes -= self._b2.pop(key)
+            self._replace(size, True)
+            self._t2[key] = (value, size)
+            self._t2_bytes += size
+        else:
+            self._replace(size, False)
+            self._t1[key] = (value, size)
+            self._t1_bytes += size
+        self._trim_ghosts()
+
+    def __getstate__(self):
+        return (self.max_bytes, self.sizeof)
+
+    def __setstate__(self, state):
+        (self.max_bytes, self.sizeof) = state
+        self._reset()
+
+
+def _stable_hash(key: Hashable) -> int:
+    # must give the same value in every process, which the builtin hash does not for strings
+    if isinstance(key, (int, np.integer)):
+        x = (int(key) + 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+        x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+        x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & 0xFFFFFFFFFFFFFFFF
+        x ^= x >> 31
+    elif isinstance(key, str):
+        x = int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "little")
+    else:
+        x = int.from_bytes(hashlib.blake2b(pickle.dumps(key), digest_size=8).digest(), "little")
+    return x & 0x7FFFFFFFFFFFFFFF
+
+
+def _release_shared_memory(creator: Optional[int], *shms: SharedMemory) -> None:
+    for shm in shms:
+        shm.close()
+        if os.getpid() == creator:
+            shm.unlink()
+
+
+class SharedMemoryCache(SampleCache):
+    r"""
+    A cache of pickled samples in shared memory, usable from all DataLoader workers at once.
+
+    Samples are appended to a ring buffer of `max_bytes`, overwriting the oldest ones, and found
+    through a set-associative index. A sample read from the older half of the ring is appended
+    again, which approximates LRU eviction. The cache must be created in the parent process before
+    the workers are started; the shared memory is released when the original cache (not a copy
+    unpickled from it) is garbage collected or closed.
+
+    The lock serialising access to the cache is handed down to the processes the cache is sent to
+    when they are started (as DataLoader workers are). A cache pickled otherwise (e.g. to bytes)
+    gets a new lock on unpickling, so it must not be written to concurrently with the original.
+
+    Args:
+        max_bytes (int): The size of the shared sample buffer
+        max_entries (int, optional): The number of index slots. Defaults to one per KiB of `max_bytes`.
+        ways (int): The associativity of the index
+    """
+
+    def __init__(self, max_bytes: int, max_entries: Optional[int] = None, ways: int = 8):
+        self.max_bytes = max_bytes
+        self.ways = ways
+        self.buckets = max(1, (max_entries or max_bytes // 1024) // ways)
+        self._creator = os.getpid()
+        self._lock = multiprocessing.get_context("spawn").Lock()
+        self._index_shm = SharedMemory(create=True, size=8 * (1 + self.buckets * ways * 3))
+        self._data_shm = SharedMemory(create=True, size=max_bytes)
+        self._attach()
+        self._index[:] = -1
+        self._head[0] = 0
+        self._finalizer = weakref.finalize(self, _release_shared_memory, self._creator, self._index_shm, self._data_shm)
+
+    def _attach(self):
+        index = np.ndarray((1 + self.buckets * self.ways * 3,), dtype=np.int64, buffer=self._index_shm.buf)
+        self._head = index[:1]
+        self._index = index[1:].reshape(self.buckets, self.ways, 3)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        h = _stable_hash(key)
+        bucket = self._index[h % self.buckets]
+        with self._lock:
+            head = int(self._head[0])
+            for way in range(self.ways):
+                entry_hash, position, length = (int(v) for v in bucket[way])
+                if entry_hash == h and position >= 0 and position >= head - self.max_bytes:
+                    offset = position % self.max_bytes
+                    payload = bytes(self._data_shm.buf[offset:offset + length])
+                    if position < head - self.max_bytes // 2:
+                        self._append(h, payload)
+                    break
+            else:
+                return default
+        stored_key, value = pickle.loads(payload)
+        return value if stored_key == key else default
+
+    def _append(self, h: int, payload: bytes) -> None:
+        head = int(self._head[0])
+        offset = head % self.max_bytes
+        if offset + len(payload) > self.max_bytes:
+            head += self.max_bytes - offset
+            offset = 0
+        self._data_shm.buf[offset:offset + len(payload)] = payload
+        position = head
+        head += len(payload)
+        self._head[0] = head
+        bucket = self._index[h % self.buckets]
+        hashes, positions = bucket[:, 0], bucket[:, 1]
+        matching = np.flatnonzero(hashes == h)
+        if len(matching):
+            way = matching[0]
+        else:
+            way = int(np.argmin(positions))
+        bucket[way] = (h, position, len(payload))
+
+    def put(self, key: Hashable, value: Any) -> None:
+        payload = pickle.dumps((key, value), protocol=pickle.HIGHEST_PROTOCOL)
+        if len(payload) > self.max_bytes // 2:
+            return
+        with self._lock:
+            self._append(_stable_hash(key), payload)
+
+    def close(self) -> None:
+        """Detaches from the shared memory, releasing it if called in the process that created the cache."""
+        del self._head, self._index
+        self._finalizer()
+
+    def __getstate__(self):
+        # multiprocessing locks can only be pickled while starting a child process
+        lock = self._lock if get_spawning_popen() is not None else None
+        return (self.max_bytes, self.ways, self.buckets, self._creator, lock, self._index_shm.name, self._data_shm.name)
+
+    def __setstate__(self, state):
+        (self.max_bytes, self.ways, self.buckets, self._creator, lock, index_name, data_name) = state
+        self._lock = lock if lock is not None else multiprocessing.get_context("spawn").Lock()
+        self._index_shm = SharedMemory(index_name)
+        self._data_shm = SharedMemory(data_name)
+        self._attach()
+        # only the original releases the shared memory, copies just detach
+        self._finalizer = weakref.finalize(self, _release_shared_memory, None, self._index_shm, self._data_shm)
@@ -1,19 +1,77 @@
 import abc
 import bisect
-import random
-from typing import Any, Callable, Iterable, Optional, Sequence, TypeVar, Generic, cast
+import collections
+import copy
+import functools
+import itertools
+import json
+import operator
+import os
+import multiprocessing
+import threading
+import time
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Iterable, Literal, Mapping, NamedTuple, Optional, Sequence, TypeVar, Generic, cast
+import numpy as np
 import torch
 from torchdata.stateful_dataloader import StatefulDataLoader
 from torch.utils.data import Dataset, DataLoader
 import torch.utils.data
 import torch.utils.data.dataloader
+from multiprocessing.context import get_spawning_popen
 import logging
+from hscitorchutil.ids import StringIdArray
+from hscitorchutil.processlocal import ProcessLocalResource
+from hscitorchutil.permutation import BlockShufflePermutation, FeistelPermutation
+from hscitorchutil.cache import ARCCache, LRUCache, SampleCache, SharedMemoryCache, approximate_size
 
+DataLoaderStage = Literal['train', 'val', 'test', 'predict']
 T_co = TypeVar('T_co', covariant=True)
 T2_co = TypeVar('T2_co', covariant=True)
 T3_co = TypeVar('T3_co', covariant=True)
 
 
+def contiguous_runs(indices: Sequence[int]) -> list[tuple[int, int]]:
+    """Splits a sequence of integer indices into maximal runs of consecutive ascending values.
+
+    Returns:
+        list[tuple[int, int]]: (start, stop) positions in `indices` of each run
+    """
+    if isinstance(indices, range) and indices.step == 1:
+        return [(0, len(indices))] if len(indices) else []
+    if len(indices) == 0:
+        return []
+    bounds = np.flatnonzero(np.diff(np.asarray(indices)) != 1) + 1
+    starts = [0] + bounds.tolist()
+    return list(zip(starts, starts[1:] + [len(indices)]))
+
+
+def as_contiguous_range(indices: Sequence[Any]) -> Optional[range]:
+    """Returns `indices` as a `range` if they are consecutive ascending integers, otherwise None.
+
+    Index-mapping wrappers pass ranges on as ranges, so that the leaf dataset can serve
+    them with a single range scan."""
+    if isinstance(indices, range):
+        return indices if indices.step == 1 else None
+    if len(indices) < 2 or not isinstance(indices[0], (int, np.integer)) or indices[-1] - indices[0] != len(indices) - 1:
+        return None
+    if not np.all(np.diff(np.asarray(indices)) == 1):
+        return None
+    return range(int(indices[0]), int(indices[-1]) + 1)
+
+
+def _as_key_array(keys: Sequence[Any]) -> Sequence[Any]:
+    # stores keys compactly without coercing them: integers as an int64 array, strings as a
+    # StringIdArray, and anything else (e.g. tuples or mixed types) as a list
+    if isinstance(keys, (np.ndarray, StringIdArray)):
+        return keys
+    if all(isinstance(key, (int, np.integer)) and not isinstance(key, bool) for key in keys):
+        return np.asarray(keys, dtype=np.int64)
+    if all(isinstance(key, str) for key in keys):
+        return StringIdArray.from_strings(keys)
+    return list(keys)
+
+
 class LinearMapSubset(Dataset[T_co], Generic[T_co]):
     r"""
     Slice a map dataset at specified indices.
@@ -37,11 +95,17 @@ class LinearMapSubset(Dataset[T_co], Generic[T_co]):
     def __getitem__(self, idx):
         return self.dataset[self.start + idx]
 
+    def _map_indices(self, indices: Sequence[int]) -> Sequence[int]:
+        run = as_contiguous_range(indices)
+        if run is not None:
+            return range(self.start + run.start, self.start + run.stop)
+        return [self.start + idx for idx in indices]
+
     def __getitems__(self, indices: list[int]) -> list[T_co]:
         # add batched sampling support when parent dataset supports it.
         # see torch.utils.data._utils.fetch._MapDatasetFetcher
         if callable(getattr(self.dataset, "__getitems__", None)):
-            return self.dataset.__getitems__([self.start + idx for idx in indices])  # type: ignore[attr-defined] # noqa
+            return self.dataset.__getitems__(self._map_indices(indices))  # type: ignore[attr-defined] # noqa
         else:
             return [self.dataset[self.start + idx] for idx in indices]
 
@@ -51,29 +115,71 @@ class LinearMapSubset(Dataset[T_co], Generic[T_co]):
 K_co = TypeVar('K_co', covariant=True)
 
 class IdBasedMapSubset(Dataset[T_co], Generic[K_co, T_co]):
-    """A dataset implementation enabling the subsetting of another dataset based on given ids"""
+    r"""A dataset implementation enabling the subsetting of another dataset based on given ids
+
+    Integer ids given as lists or tuples are stored as an int64 NumPy array and string ids as a
+    `hscitorchutil.ids.StringIdArray`, from which batches are gathered with fancy indexing. Other
+    ids (e.g. tuples, or mixed types) are kept in a list as they are. Ids can also be given
+    as the name of an `.npy` file, which is then memory-mapped lazily in each process. Only the
+    file name is pickled, so that DataLoader workers share the ids through the OS page cache.
+
+    Args:
+        dataset (Dataset[T_co]): The underlying map dataset
+        ids (Sequence[K_co] | np.ndarray | str | os.PathLike): The ids in the underlying dataset selected for the subset
+    """
 
     def __init__(self,
                  dataset: Dataset[T_co],
-                 ids: Sequence[K_co],
+                 ids: Sequence[K_co] | np.ndarray | str | os.PathLike,
                  ):
         self.dataset = dataset
-        self.ids = ids
+        if isinstance(ids, (str, os.PathLike)):
+            self.ids_file: Optional[str] = str(ids)
+            self._ids = None
+        else:
+            self.ids_file = None
+            self._ids = _as_key_array(ids) if isinstance(ids, (list, tuple)) else ids
+
+    @property
+    def ids(self) -> Sequence[K_co] | np.ndarray:
+        if self._ids is None:
+            self._ids = np.load(cast(str, self.ids_file), mmap_mode='r')
+        return self._ids
 
     def __len__(self) -> int:
         return len(self.ids)
 
+    def _map_indices(self, idxs: Sequence[int]) -> Sequence[K_co]:
+        ids = self.ids
+        if isinstance(idxs, range) and idxs.step == 1:
+            selected = ids[idxs.start:idxs.stop]
+        elif isinstance(ids, (np.ndarray, StringIdArray)):
+            selected = ids[np.asarray(idxs, dtype=np.int64)]
+        else:
+            return [ids[idx] for idx in idxs]
+        if isinstance(selected, np.ndarray):
+            # consecutive ids are passed on as a range, for the leaf dataset to scan in one go
+            run = as_contiguous_range(selected)
+            return run if run is not None else selected.tolist()  # type: ignore
+        return selected  # type: ignore
+
     def __getitem__(self, idx: int) -> T_co:
-        return self.dataset[self.ids[idx]]
+        return self.dataset[self._map_indices([idx])[0]]
 
     def __getitems__(self, idxs: Sequence[int]) -> Sequence[T_co]:
         # add batched sampling support when parent dataset supports it.
         # see torch.utils.data._utils.fetch._MapDatasetFetcher
         if callable(getattr(self.dataset, "__getitems__", None)):
-            return self.dataset.__getitems__([self.ids[idx] for idx in idxs])  # type: ignore[attr-defined] # noqa
+            return self.dataset.__getitems__(self._map_indices(idxs))  # type: ignore[attr-defined] # noqa
         else:
-            return [self.dataset[self.ids[idx]] for idx in idxs]
-        
+            return [self.dataset[idx] for idx in self._map_indices(idxs)]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.ids_file is not None:
+            state['_ids'] = None
+        return state
+
 
 K2_co = TypeVar('K2_co', covariant=True)
 T2_co = TypeVar('T2_co', covariant=True)
@@ -98,6 +204,9 @@ class KeyTransformingMapDataset(Dataset[T_co], Generic[K_co, K2_co, T_co]):
     def __getitem__(self, idx):
         return self.dataset[self.transform([idx])[0]]
 
+    def _map_indices(self, indices: Sequence[K_co]) -> Sequence[K2_co]:
+        return self.transform(indices)
+
     def __getitems__(self, indices: Sequence[K_co]) -> Sequence[T_co]:
         # add batched sampling support when parent dataset supports it.
         # see torch.utils.data._utils.fetch._MapDatasetFetcher
@@ -110,28 +219,102 @@ class KeyTransformingMapDataset(Dataset[T_co], Generic[K_co, K2_co, T_co]):
         return len(self.dataset)  # type: ignore[attr-defined]
 
 
+def _shutdown_executor(executor: Executor) -> None:
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _create_executor(kind: Literal['thread', 'process'], max_workers: int) -> Executor:
+    if kind == 'thread':
+        return ThreadPoolExecutor(max_workers=max_workers)
+    if multiprocessing.current_process().daemon:
+        raise RuntimeError(
+            "Process pools cannot be created in DataLoader worker processes. Use a thread pool, or num_workers=0.")
+    return ProcessPoolExecutor(max_workers=max_workers)
+
+
+class TransformPool:
+    r"""
+    A thread or process pool for running batch transforms in parallel, created lazily in each
+    process. One pool can be shared by several `EntryTransformingMapDataset`s.
+
+    Thread pools suit transforms that release the GIL (e.g. image decoding, zlib, many tokenisers).
+    Process pools require picklable transforms, and cannot be used inside DataLoader worker
+    processes (which are not allowed to have children).
+
+    Args:
+        kind (str): `"thread"` or `"process"`
+        max_workers (int): The number of threads or processes
+        max_pending (int, optional): The maximum number of chunks submitted but not yet finished,
+            across all users of the pool in a process. Submitting more blocks until chunks finish.
+            Defaults to `2 * max_workers`.
+    """
+
+    def __init__(self, kind: Literal['thread', 'process'] = 'thread', max_workers: int = 4, max_pending: Optional[int] = None) -> None:
+        self.kind = kind
+        self.max_workers = max_workers
+        self.max_pending = max_pending if max_pending is not None else 2 * max_workers
+        self._executor = ProcessLocalResource(functools.partial(
+            _create_executor, kind, max_workers), close=_shutdown_executor)
+        self._pending = ProcessLocalResource(functools.partial(
+            threading.BoundedSemaphore, self.max_pending))
+
+    def map(self, fn: Callable[[Any], T_co], chunks: Iterable[Any]) -> list[T_co]:
+        """Applies `fn` to each chunk in the pool, returning the results in order"""
+        executor = self._executor.get()
+        pending = self._pending.get()
+        futures = []
+        for chunk in chunks:
+            pending.acquire()
+            try:
+                future = executor.submit(fn, chunk)
+            except BaseException:
+                pending.release()
+                raise
+            future.add_done_callback(lambda _: pending.release())
+            futures.append(future)
+        return [future.result() for future in futures]
+
+    def close(self) -> None:
+        """Shuts down the pool of the current process"""
+        self._executor.close()
+
+
 class EntryTransformingMapDataset(Dataset[T2_co], Generic[T_co, T2_co]):
     r"""Create a transformed map dataset by applying a transform function to all samples.
 
     Args:
         dataset (Dataset[T_co]): The underlying map dataset
         transform (Callable[T:co,T2_co]): The transformation function to be applied to each sample
+        pool (TransformPool, optional): If given, batches are split into chunks that are
+            transformed in parallel on the pool, preserving order
+        chunk_size (int, optional): The number of samples per chunk. Defaults to splitting each
+            batch evenly between the workers of the pool.
     """
 
-    def __init__(self, dataset: Dataset[T_co], transform: Callable[[Sequence[T_co]], Sequence[T2_co]]) -> None:
+    def __init__(self, dataset: Dataset[T_co], transform: Callable[[Sequence[T_co]], Sequence[T2_co]], pool: Optional[TransformPool] = None, chunk_size: Optional[int] = None) -> None:
         self.dataset = dataset
         self.transform = transform
+        self.pool = pool
+        self.chunk_size = chunk_size
 
     def __getitem__(self, idx):
         return self.transform([self.dataset[idx]])[0]
 
+    def _transform(self, items: Sequence[T_co]) -> Sequence[T2_co]:
+        if self.pool is None:
+            return self.transform(items)
+        chunk_size = self.chunk_size or -(-len(items) // self.pool.max_workers)
+        if len(items) <= chunk_size:
+            return self.transform(items)
+        return [item for chunk in self.pool.map(self.transform, [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]) for item in chunk]
+
     def __getitems__(self, indices: Sequence[K_co]) -> Sequence[T2_co]:
         # add batched sampling support when parent dataset supports it.
         # see torch.utils.data._utils.fetch._MapDatasetFetcher
         if callable(getattr(self.dataset, "__getitems__", None)):
-            return self.transform(self.dataset.__getitems__(indices))  # type: ignore[attr-defined] # noqa
+            return self._transform(self.dataset.__getitems__(indices))  # type: ignore[attr-defined] # noqa
         else:
-            return self.transform([self.dataset[idx] for idx in indices])
+            return self._transform([self.dataset[idx] for idx in indices])
 
     def __len__(self):
         return len(self.dataset)  # type: ignore[attr-defined]
@@ -141,42 +324,83 @@ class ShuffledMapDataset(Dataset[T_co], Generic[T_co]):
     r"""
     Shuffle the input map dataset via its indices.
 
+    The shuffle is a lazily evaluated pseudo-random permutation (see
+    `hscitorchutil.permutation.FeistelPermutation`), so it takes no memory or time to set up
+    regardless of the size of the dataset, and maps indices identically in every process.
+
+    If `block_size` is given, the dataset is instead block-shuffled (see
+    `hscitorchutil.permutation.BlockShufflePermutation`): blocks of `block_size` consecutive
+    indices are permuted and then shuffled within windows of `window_size` positions. This mixes
+    less well than a full shuffle, but keeps reads from the underlying storage mostly sequential,
+    which pays off when the data is much larger than the page cache or read over the network.
+
+    The epoch given to `set_epoch` is kept in shared memory, so that it also reaches the copies of
+    the dataset in (persistent) DataLoader workers, which reshuffle on their next batch. Call it
+    before starting to iterate over an epoch, as with `DistributedSampler.set_epoch`. Copies made
+    with `copy.copy` get an epoch of their own.
+
     Args:
         dataset (Dataset): Map dataset being shuffled
         seed: (int, optional): The seed to be used for shuffling. If not provided, the current time is used.
-        indices (list[Any]): a list of indices for the parent Dataset. If not provided, we assume it uses 0-based indexing
+        indices (list[Any]): a list of indices for the parent Dataset. If not provided, we assume it uses 0-based indexing.
+            Integers are stored as a NumPy array and strings as a `hscitorchutil.ids.StringIdArray`.
+        block_size (int, optional): The number of consecutive indices kept together in block shuffle mode
+        window_size (int, optional): The number of positions shuffled together in block shuffle mode.
+            Defaults to `4 * block_size`.
     """
     dataset: Dataset[T_co]
 
-    def __init__(self, dataset: Dataset[T_co], seed: int, indices: Optional[list[Any]] = None) -> None:
+    def __init__(self, dataset: Dataset[T_co], seed: int, indices: Optional[Sequence[Any]] = None, block_size: Optional[int] = None, window_size: Optional[int] = None) -> None:
         self.dataset = dataset
         self.seed = seed
-        self.indices = indices
-        self._shuffle()
-
-    def _shuffle(self):
-        if self.indices is None:
-            rng = torch.Generator().manual_seed(self.seed)
-            self._shuffled_indices = torch.randperm(
-                len(self.dataset), generator=rng).tolist()  # type: ignore
+        self.indices = _as_key_array(indices) if indices is not None else None
+        self.block_size = block_size
+        self.window_size = window_size
+        self._shared_epoch = torch.zeros((), dtype=torch.int64).share_memory_()
+        self._shuffle(0)
+
+    def _shuffle(self, epoch: int) -> None:
+        if self.block_size is None:
+            self._permutation: FeistelPermutation | BlockShufflePermutation = FeistelPermutation(
+                len(self), self.seed, epoch)
         else:
-            rng = random.Random()
-            rng.seed(self.seed)
-            self._shuffled_indices: list = rng.sample(
-                self.indices, len(self.indices))
+            self._permutation = BlockShufflePermutation(len(self), self.block_size, self.window_size if self.window_size is not None else 4 * self.block_size,
+                                                        self.seed, epoch)
+        self.epoch = epoch
+
+    def set_epoch(self, epoch: int) -> None:
+        """Reshuffles the dataset with a permutation specific to the given epoch"""
+        self._shared_epoch.fill_(epoch)
+        self._shuffle(epoch)
+
+    def _map_indices(self, indices: Sequence[int]) -> list:
+        epoch = int(self._shared_epoch)
+        if epoch != self.epoch:
+            # set_epoch was called on another copy of the dataset
+            self._shuffle(epoch)
+        shuffled = self._permutation.permute(np.asarray(indices, dtype=np.int64))
+        if self.indices is None:
+            return shuffled.tolist()
+        if isinstance(self.indices, np.ndarray):
+            return self.indices[shuffled].tolist()
+        if isinstance(self.indices, StringIdArray):
+            return self.indices[shuffled]
+        return [self.indices[idx] for idx in shuffled.tolist()]
 
     def __getitem__(self, idx):
-        return self.dataset[self._shuffled_indices[idx]]
+        return self.dataset[self._map_indices([idx])[0]]
 
     def __getitems__(self, indices: list[int]) -> list[T_co]:
         # add batched sampling support when parent dataset supports it.
         # see torch.utils.data._utils.fetch._MapDatasetFetcher
         if callable(getattr(self.dataset, "__getitems__", None)):
-            return self.dataset.__getitems__([self._shuffled_indices[idx] for idx in indices])  # type: ignore[attr-defined] # noqa
+            return self.dataset.__getitems__(self._map_indices(indices))  # type: ignore[attr-defined] # noqa
         else:
-            return [self.dataset[self._shuffled_indices[idx]] for idx in indices]
+            return [self.dataset[idx] for idx in self._map_indices(indices)]
 
     def __len__(self) -> int:
+        if self.indices is not None:
+            return len(self.indices)
         return len(self.dataset)  # type: ignore
 
     def __getstate__(self):
@@ -184,6 +408,9 @@ class ShuffledMapDataset(Dataset[T_co], Generic[T_co]):
             self.dataset,
             self.indices,
             self.seed,
+            self._shared_epoch,
+            self.block_size,
+            self.window_size,
         )
         return state
 
@@ -192,8 +419,17 @@ class ShuffledMapDataset(Dataset[T_co], Generic[T_co]):
             self.dataset,
             self.indices,
             self.seed,
+            self._shared_epoch,
+            self.block_size,
+            self.window_size,
         ) = state
-        self._shuffle()
+        self._shuffle(int(self._shared_epoch))
+
+    def __copy__(self):
+        copied = type(self).__new__(type(self))
+        copied.__dict__.update(self.__dict__)
+        copied._shared_epoch = self._shared_epoch.clone().share_memory_()
+        return copied
 
 
 def _log_exception(ds: 'ExceptionHandlingMapDataset', idx: int, e: Exception) -> None:
@@ -204,87 +440,641 @@ def _log_exception(ds: 'ExceptionHandlingMapDataset', idx: int, e: Exception) ->
 class ExceptionHandlingMapDataset(Dataset[T_co], Generic[T_co]):
     r"""A dataset wrapper that catches exceptions and instead of bailing out, returns None.
 
+    When a batch fails, it is bisected recursively, so that the failing samples are isolated with
+    a logarithmic number of batched calls instead of falling back to one call per sample.
+
+    With `quarantine`, samples failing on their own are quarantined: later requests for them
+    return None without touching the underlying dataset. Samples are quarantined by their key
+    below the index-mapping wrappers (e.g. `ShuffledMapDataset`, `LinearMapSubset`,
+    `IdBasedMapSubset`) directly under this one, so that the quarantine stays valid across epochs
+    and shuffle seeds. Without `quarantine_file`, the quarantine is local to each process, so each
+    DataLoader worker has to run into a failing sample itself. With `quarantine_file`, quarantined
+    keys are also appended to that file, and read back from it by all processes using it, so that
+    they are shared between DataLoader workers and preserved across runs.
+
     Args:
         dataset (Dataset[T_co]): The underlying map dataset
         on_exception (Callable[[int, Exception],Any]): The function to be called when an exception is raised.
+        quarantine (bool): Whether to quarantine failing samples (implied by `quarantine_file`)
+        quarantine_file (str | os.PathLike, optional): A file in which to persist quarantined keys (one JSON value per line)
     """
 
-    def __init__(self, dataset: Dataset[T_co], on_exception: Callable[['ExceptionHandlingMapDataset', int, Exception], T_co] = _log_exception) -> None:
+    def __init__(self, dataset: Dataset[T_co], on_exception: Callable[['ExceptionHandlingMapDataset', int, Exception], T_co] = _log_exception, quarantine: bool = False, quarantine_file: Optional[str | os.PathLike] = None) -> None:
         self.dataset = dataset
         self.on_exception = on_exception
-
-    def __getitem__(self, idx):
+        self.quarantine = quarantine or quarantine_file is not None
+        self.quarantine_file = quarantine_file
+        self.quarantined: set[Any] = set()
+        self._quarantine_offset = 0
+        self.fallbacks = 0
+        self.failures = 0
+        self.skipped = 0
+
+    def _refresh_quarantine(self) -> None:
+        if self.quarantine_file is None:
+            return
+        try:
+            size = os.stat(self.quarantine_file).st_size
+        except FileNotFoundError:
+            return
+        if size <= self._quarantine_offset:
+            return
+        with open(self.quarantine_file, "rb") as f:
+            f.seek(self._quarantine_offset)
+            data = f.read(size - self._quarantine_offset)
+        # only consume complete lines, a concurrent writer may be midway through one
+        data = data[:data.rfind(b"\n") + 1]
+        self._quarantine_offset += len(data)
+        for line in data.splitlines():
+            if line:
+                key = json.loads(line)
+                self.quarantined.add(tuple(key) if isinstance(key, list) else key)
+
+    def _keys(self, indices: Sequence[Any]) -> Sequence[Any]:
+        # maps indices to the keys of the dataset under the index-mapping wrappers below this one,
+        # which do not depend on e.g. the shuffle seed
+        dataset = self.dataset
+        while True:
+            while isinstance(dataset, InstrumentedMapDataset):
+                dataset = dataset.dataset
+            if not callable(getattr(dataset, "_map_indices", None)):
+                return indices
+            indices = dataset._map_indices(indices)  # type: ignore[attr-defined]
+            dataset = dataset.dataset  # type: ignore[attr-defined]
+
+    def _quarantine(self, idx) -> None:
+        if not self.quarantine:
+            return
+        key = self._keys([idx])[0]
+        if isinstance(key, np.generic):
+            key = key.item()
+        self.quarantined.add(key)
+        if self.quarantine_file is not None:
+            # a single short write to a file opened for appending is not interleaved with other writers
+            with open(self.quarantine_file, "a") as f:
+                f.write(json.dumps(key) + "\n")
+
+    def _get(self, idx):
         try:
             return self.dataset[idx]
         except Exception as e:
+            self.failures += 1
+            self._quarantine(idx)
             return self.on_exception(self, idx, e)
 
+    def __getitem__(self, idx):
+        self._refresh_quarantine()
+        if self.quarantined and self._keys([idx])[0] in self.quarantined:
+            self.skipped += 1
+            return None
+        return self._get(idx)
+
+    def _bisect(self, indices: Sequence[Any]) -> list[T_co]:
+        # called for a failed batch: retry both halves separately
+        if len(indices) == 1:
+            return [self._get(indices[0])]
+        mid = len(indices) // 2
+        return self._fetch_isolating(indices[:mid]) + self._fetch_isolating(indices[mid:])
+
+    def _fetch_isolating(self, indices: Sequence[Any]) -> list[T_co]:
+        try:
+            return list(self.dataset.__getitems__(indices))  # type: ignore[attr-defined] # noqa
+        except Exception:
+            return self._bisect(indices)
+
     def __getitems__(self, indices: list[int]) -> list[T_co]:
+        self._refresh_quarantine()
+        if self.quarantined:
+            keys = self._keys(indices)
+            if any(key in self.quarantined for key in keys):
+                ret: list[Any] = [None] * len(indices)
+                positions = [i for i, key in enumerate(keys)
+                             if key not in self.quarantined]
+                self.skipped += len(indices) - len(positions)
+                if positions:
+                    for i, item in zip(positions, self.__getitems__([indices[i] for i in positions])):
+                        ret[i] = item
+                return ret
         # add batched sampling support when parent dataset supports it.
         # see torch.utils.data._utils.fetch._MapDatasetFetcher
         if callable(getattr(self.dataset, "__getitems__", None)):
             try:
                 return self.dataset.__getitems__(indices)  # type: ignore[attr-defined] # noqa
             except Exception:
-                return [self.__getitem__(idx) for idx in indices]
+                self.fallbacks += 1
+                return self._bisect(indices)
         else:
-            return [self.__getitem__(idx) for idx in indices]  # type: ignore
+            return [self._get(idx) for idx in indices]  # type: ignore
 
     def __len__(self):
         return len(self.dataset)  # type: ignore
 
 
+class CachingMapDataset(Dataset[T_co], Generic[T_co]):
+    r"""A dataset wrapper that caches the samples of the underlying dataset.
+
+    Batches are split into cache hits and misses, and only the misses are requested from the
+    underlying dataset. `None` samples (as returned by e.g. `ExceptionHandlingMapDataset`) are not
+    cached. Note that cached samples are shared between batches, so they must not be modified in place.
+    The cache and the counters are guarded by a lock, so the dataset can be used from several
+    threads at once (e.g. under a `PrefetchingMapDataset`), while fetching the misses is not serialised.
+
+    Args:
+        dataset (Dataset[T_co]): The underlying map dataset
+        max_bytes (int): The memory budget of the cache
+        policy (str): The eviction policy of a process-local cache, `"lru"` or `"arc"`
+        shared (bool): Keep the cache in shared memory, so that all DataLoader workers use a
+            single cache (see `hscitorchutil.cache.SharedMemoryCache`). The dataset must then be
+            created in the parent process. Shared caches always use (approximate) LRU eviction.
+        sizeof (Callable[[Any], int]): Function returning the size of a sample in bytes, for process-local caches
+    """
+
+    def __init__(self, dataset: Dataset[T_co], max_bytes: int, policy: Literal['lru', 'arc'] = 'lru', shared: bool = False, sizeof: Callable[[Any], int] = approximate_size) -> None:
+        self.dataset = dataset
+        if shared:
+            if policy != 'lru':
+                raise ValueError(
+                    "Shared caches only support the 'lru' policy")
+            self.cache: SampleCache = SharedMemoryCache(max_bytes)
+        elif policy == 'lru':
+            self.cache = LRUCache(max_bytes, sizeof)
+        elif policy == 'arc':
+            self.cache = ARCCache(max_bytes, sizeof)
+        else:
+            raise ValueError(f"Unknown cache policy {policy}")
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def __getitem__(self, idx):
+        with self._lock:
+            item = self.cache.get(idx)
+            if item is not None:
+                self.hits += 1
+                return item
+            self.misses += 1
+        item = self.dataset[idx]
+        if item is not None:
+            with self._lock:
+                self.cache.put(idx, item)
+        return item
+
+    def __getitems__(self, indices: list[Any]) -> list[T_co]:
+        with self._lock:
+            items = [self.cache.get(idx) for idx in indices]
+            misses = [pos for pos, item in enumerate(items) if item is None]
+            self.hits += len(items) - len(misses)
+            self.misses += len(misses)
+        if misses:
+            miss_indices = [indices[pos] for pos in misses]
+            # add batched sampling support when parent dataset supports it.
+            # see torch.utils.data._utils.fetch._MapDatasetFetcher
+            if callable(getattr(self.dataset, "__getitems__", None)):
+                fetched = self.dataset.__getitems__(miss_indices)  # type: ignore[attr-defined] # noqa
+            else:
+                fetched = [self.dataset[idx] for idx in miss_indices]
+            with self._lock:
+                for pos, idx, item in zip(misses, miss_indices, fetched):
+                    items[pos] = item
+                    if item is not None:
+                        self.cache.put(idx, item)
+        return items
+
+    def __len__(self):
+        return len(self.dataset)  # type: ignore
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
+class LookaheadBatch(list):
+    """A batch of indices that also carries the upcoming batches of the same DataLoader worker"""
+    upcoming: list[list[Any]]
+
+    def __init__(self, indices: Iterable[Any], upcoming: list[list[Any]]):
+        super().__init__(indices)
+        self.upcoming = upcoming
+
+
+class PrefetchBatchSampler(Iterable[LookaheadBatch]):
+    r"""
+    Wraps a batch sampler so that each batch carries the next `depth` batches that will be sent
+    to the same DataLoader worker, for use with `PrefetchingMapDataset`. Assumes the DataLoader
+    distributes batches to its workers round-robin, as PyTorch DataLoaders do.
+
+    Args:
+        batch_sampler (Iterable[list[Any]]): The wrapped batch sampler
+        depth (int): The number of upcoming batches to attach
+        num_workers (int): The number of DataLoader workers
+    """
+
+    def __init__(self, batch_sampler: Iterable[list[Any]], depth: int = 2, num_workers: int = 0):
+        self.batch_sampler = batch_sampler
+        self.depth = depth
+        self.num_workers = num_workers
+
+    @property
+    def sampler(self):
+        return getattr(self.batch_sampler, "sampler", None)
+
+    def set_epoch(self, epoch: int) -> None:
+        for target in (self.batch_sampler, self.sampler):
+            if callable(getattr(target, "set_epoch", None)):
+                target.set_epoch(epoch)  # type: ignore
+                return
+
+    def __len__(self) -> int:
+        return len(self.batch_sampler)  # type: ignore
+
+    def __iter__(self):
+        stride = max(self.num_workers, 1)
+        lookahead = self.depth * stride
+        batches = iter(self.batch_sampler)
+        buffer = collections.deque(itertools.islice(batches, lookahead + 1))
+        while buffer:
+            batch = buffer.popleft()
+            yield LookaheadBatch(batch, [buffer[i] for i in range(stride - 1, min(lookahead, len(buffer)), stride)])
+            buffer.extend(itertools.islice(batches, 1))
+
+
+class _PrefetchState:
+    def __init__(self, max_workers: int):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.pending: collections.OrderedDict[tuple, Future] = collections.OrderedDict()
+
+    def close(self):
+        for future in self.pending.values():
+            future.cancel()
+        self.pending.clear()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class PrefetchingMapDataset(Dataset[T_co], Generic[T_co]):
+    r"""A dataset wrapper that starts fetching upcoming batches from the underlying dataset
+    ahead of time, on a small I/O thread pool.
+
+    The upcoming batches are taken from the `LookaheadBatch`es produced by a `PrefetchBatchSampler`
+    (plain batches are just fetched directly). At most `depth` batches are prefetched at a time.
+    If a requested batch is not the one that was expected (as after the end of an epoch, or after
+    restoring a `StatefulDataLoader` state), all pending prefetches are cancelled.
+
+    The underlying dataset is called from the I/O threads, concurrently with the batches fetched
+    directly, so it must be thread safe. `CachingMapDataset` and the SQLite datasets are; the
+    counters of other wrappers (e.g. `ExceptionHandlingMapDataset`) may undercount.
+
+    Args:
+        dataset (Dataset[T_co]): The underlying map dataset
+        depth (int): The maximum number of batches prefetched at a time
+        max_workers (int): The number of I/O threads
+    """
+
+    def __init__(self, dataset: Dataset[T_co], depth: int = 2, max_workers: int = 2) -> None:
+        self.dataset = dataset
+        self.depth = depth
+        self.max_workers = max_workers
+        self._state = ProcessLocalResource(functools.partial(_PrefetchState, max_workers))
+        self.hits = 0
+        self.misses = 0
+
+    def _fetch(self, indices: list[Any]) -> list[T_co]:
+        # add batched sampling support when parent dataset supports it.
+        # see torch.utils.data._utils.fetch._MapDatasetFetcher
+        if callable(getattr(self.dataset, "__getitems__", None)):
+            return self.dataset.__getitems__(indices)  # type: ignore[attr-defined] # noqa
+        return [self.dataset[idx] for idx in indices]
+
+    def __getitem__(self, idx):
+        return self.dataset[idx]
+
+    def __getitems__(self, indices: list[Any]) -> list[T_co]:
+        state: _PrefetchState = self._state.get()
+        key = tuple(indices)
+        future = state.pending.pop(key, None)
+        if future is None:
+            self.misses += 1
+            for stale in state.pending.values():
+                stale.cancel()
+            state.pending.clear()
+        else:
+            self.hits += 1
+        for upcoming in getattr(indices, "upcoming", ())[:self.depth]:
+            upcoming_key = tuple(upcoming)
+            if upcoming_key not in state.pending and len(state.pending) < self.depth:
+                state.pending[upcoming_key] = state.executor.submit(
+                    self._fetch, list(upcoming))
+        if future is not None:
+            return future.result()
+        return self._fetch(list(indices))
+
+    def close(self) -> None:
+        """Cancels pending prefetches and shuts down the I/O threads of the current process"""
+        self._state.close()
+
+    def __len__(self):
+        return len(self.dataset)  # type: ignore
+
+
+def current_shard(rank: Optional[int] = None, world_size: Optional[int] = None) -> tuple[int, int]:
+    """Returns the shard of the current DataLoader worker (of the current distributed process, if
+    torch.distributed is initialized or `rank` and `world_size` are given) and the total number of shards"""
+    if rank is None or world_size is None:
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            rank, world_size = torch.distributed.get_rank(), torch.distributed.get_world_size()
+        else:
+            rank, world_size = 0, 1
+    worker_info = torch.utils.data.get_worker_info()
+    if worker_info is None:
+        return rank, world_size
+    return rank * worker_info.num_workers + worker_info.id, world_size * worker_info.num_workers
+
+
+def shard_range(n: int, shard: int, num_shards: int, sharding: Literal['contiguous', 'strided'] = 'contiguous') -> range:
+    """Returns the indices of `range(n)` belonging to a shard, either as one contiguous range per
+    shard (sizes differing by at most one) or by taking every `num_shards`th index"""
+    if sharding == 'contiguous':
+        return range(n * shard // num_shards, n * (shard + 1) // num_shards)
+    if sharding == 'strided':
+        return range(shard, n, num_shards)
+    raise ValueError(f"Unknown sharding {sharding}")
+
+
 class DatasetToIterableDataset(torch.utils.data.IterableDataset[T_co], Generic[T_co]):
-    def __init__(self, dataset: torch.utils.data.Dataset[T_co]):
+    r"""
+    Iterates over a map dataset, in batches of `chunk_size` when it supports `__getitems__`.
+
+    The indices are sharded between the DataLoader workers and distributed processes (see
+    `current_shard`), so that each sample is emitted exactly once per epoch. The position within
+    the shard is available through `state_dict`, so that a `StatefulDataLoader` can resume
+    iteration in the middle of an epoch.
+
+    Args:
+        dataset (Dataset[T_co]): The map dataset to iterate over. Iterable datasets are passed through as is.
+        sharding (str): `"contiguous"` to give each shard a contiguous range of indices, `"strided"` to interleave them
+        chunk_size (int): The number of samples requested from the dataset at a time
+        rank (int, optional): The rank of this process, if not taken from torch.distributed
+        world_size (int, optional): The number of processes, if not taken from torch.distributed
+    """
+
+    def __init__(self, dataset: torch.utils.data.Dataset[T_co], sharding: Literal['contiguous', 'strided'] = 'contiguous', chunk_size: int = 64, rank: Optional[int] = None, world_size: Optional[int] = None):
         self.dataset = dataset
+        self.sharding = sharding
+        self.chunk_size = chunk_size
+        self.rank = rank
+        self.world_size = world_size
+        self._position = 0
+        self._resume_position = 0
+
+    def _fetch(self, indices: range) -> Sequence[T_co]:
+        # add batched sampling support when parent dataset supports it.
+        # see torch.utils.data._utils.fetch._MapDatasetFetcher
+        if callable(getattr(self.dataset, "__getitems__", None)):
+            return self.dataset.__getitems__(indices)  # type: ignore[attr-defined] # noqa
+        return [self.dataset[idx] for idx in indices]
 
     def __iter__(self):
-        if hasattr(self.dataset, "__iter__"):
-            return self.dataset.__iter__()  # type: ignore
-        for i in range(len(self.dataset)):  # type: ignore
-            yield self.dataset[i]
+        if isinstance(self.dataset, torch.utils.data.IterableDataset):
+            yield from self.dataset
+            return
+        shard, num_shards = current_shard(self.rank, self.world_size)
+        indices = shard_range(len(self.dataset), shard, num_shards, self.sharding)  # type: ignore
+        self._position, self._resume_position = self._resume_position, 0
+        for chunk_start in range(self._position, len(indices), self.chunk_size):
+            for item in self._fetch(indices[chunk_start:chunk_start + self.chunk_size]):
+                self._position += 1
+                yield item
+
+    def state_dict(self) -> dict[str, Any]:
+        return {"position": self._position}
+
+    def load_state_dict(self, state_dict: dict[str, Any]) -> None:
+        self._resume_position = state_dict["position"]
 
 
 class UnionMapDataset(Dataset[T_co], Generic[T_co]):
-    def __init__(self, datasets: Sequence[Dataset[T_co]]) -> None:
+    r"""
+    Concatenate map datasets.
+
+    Batches are routed to the underlying datasets in a vectorised manner, and the sub-batches of
+    different datasets are fetched concurrently on a thread pool (created lazily in each process),
+    since SQLite and file I/O release the GIL. Datasets supporting `__getitems__` are always
+    queried in batches, even if some of the others are not.
+
+    Args:
+        datasets (Sequence[Dataset[T_co]]): The datasets to concatenate
+        max_workers (int): The maximum number of sub-batches fetched concurrently. If 0, sub-batches are fetched serially.
+    """
+
+    def __init__(self, datasets: Sequence[Dataset[T_co]], max_workers: int = 8) -> None:
         self.datasets = datasets
-        self.supports_getitems = True
+        self.max_workers = max_workers
+        self._batched = [callable(getattr(dataset, "__getitems__", None)) for dataset in datasets]
+        self.supports_getitems = all(self._batched)
         start = 0
         self.start_offsets = []
         for dataset in datasets:
-            if not callable(getattr(dataset, "__getitems__", None)):
-                self.supports_getitems = False
             self.start_offsets.append(start)
             start += len(dataset)  # type: ignore
         self._len = start
+        self._offsets = np.asarray(self.start_offsets, dtype=np.int64)
+        self._executor = ProcessLocalResource(functools.partial(
+            ThreadPoolExecutor, max_workers=max(max_workers, 1)), close=_shutdown_executor)
 
     def __getitem__(self, idx):
         dataset_idx = bisect.bisect_right(self.start_offsets, idx) - 1
         return self.datasets[dataset_idx][idx - self.start_offsets[dataset_idx]]
 
-    def __getitems__(self, indices: list[int]) -> list[T_co]:
+    def _fetch(self, dataset_idx: int, indices: Sequence[int]) -> Sequence[T_co]:
+        dataset = self.datasets[dataset_idx]
         # add batched sampling support when parent dataset supports it.
         # see torch.utils.data._utils.fetch._MapDatasetFetcher
-        if self.supports_getitems:
-            idxs_by_datasets = [[] for _ in self.datasets]
-            for idx_idx, idx in enumerate(indices):
-                dataset_idx = bisect.bisect_right(self.start_offsets, idx) - 1
-                idxs_by_datasets[dataset_idx].append(
-                    (idx - self.start_offsets[dataset_idx], idx_idx))
-            items = [None for _ in indices]
-            for dataset_idx, idxs_by_dataset in enumerate(idxs_by_datasets):
-                if idxs_by_dataset:
-                    dataset_items = self.datasets[dataset_idx].__getitems__(  # type: ignore
-                        [idx for idx, _ in idxs_by_dataset])
-                    for (_, idx), item in zip(idxs_by_dataset, dataset_items):
-                        items[idx] = item
-            return items  # type: ignore
+        if self._batched[dataset_idx]:
+            return dataset.__getitems__(indices)  # type: ignore
+        return [dataset[idx] for idx in indices]
+
+    def _route(self, indices: Sequence[int]) -> list[tuple[int, Sequence[int], Any]]:
+        """Returns (dataset index, indices in dataset, positions in batch) for each dataset in the batch"""
+        if isinstance(indices, range) and indices.step == 1:
+            if len(indices) and (indices.start < 0 or indices.stop > self._len):
+                raise IndexError("UnionMapDataset index out of range")
+            routes = []
+            position = 0
+            for dataset_idx, start_offset in enumerate(self.start_offsets):
+                start = max(indices.start - start_offset, 0)
+                stop = min(indices.stop - start_offset,
+                           len(self.datasets[dataset_idx]))  # type: ignore
+                if start < stop:
+                    routes.append((dataset_idx, range(start, stop),
+                                  slice(position, position + stop - start)))
+                    position += stop - start
+            return routes
+        idxs = np.asarray(indices, dtype=np.int64)
+        if idxs.size and (idxs.min() < 0 or idxs.max() >= self._len):
+            raise IndexError("UnionMapDataset index out of range")
+        dataset_idxs = np.searchsorted(self._offsets, idxs, side='right') - 1
+        order = np.argsort(dataset_idxs, kind='stable')
+        sorted_dataset_idxs = dataset_idxs[order]
+        bounds = [0] + (np.flatnonzero(np.diff(sorted_dataset_idxs)) + 1).tolist() + [len(idxs)]
+        routes = []
+        for start, stop in zip(bounds, bounds[1:]):
+            positions = order[start:stop]
+            dataset_idx = int(sorted_dataset_idxs[start])
+            routes.append((dataset_idx, (idxs[positions] - self._offsets[dataset_idx]).tolist(), positions.tolist()))
+        return routes
+
+    def __getitems__(self, indices: list[int]) -> list[T_co]:
+        if len(indices) == 0:
+            return []
+        routes = self._route(indices)
+        if len(routes) == 1:
+            return list(self._fetch(routes[0][0], routes[0][1]))
+        if self.max_workers > 0:
+            executor: Executor = self._executor.get()
+            futures = [executor.submit(self._fetch, dataset_idx, dataset_indices)
+                       for dataset_idx, dataset_indices, _ in routes]
+            results = [future.result() for future in futures]
         else:
-            return [self.__getitem__(idx) for idx in indices]
+            results = [self._fetch(dataset_idx, dataset_indices)
+                       for dataset_idx, dataset_indices, _ in routes]
+        items: list = [None] * len(indices)
+        for (_, _, positions), result in zip(routes, results):
+            if isinstance(positions, slice):
+                items[positions] = result
+            else:
+                for position, item in zip(positions, result):
+                    items[position] = item
+        return items
 
     def __len__(self):
         return self._len
 
+
+# wrappers mapping positions to the keys of the dataset below them. KeyTransformingMapDataset
+# takes arbitrary keys instead, so it cannot be folded into a materialized map of positions.
+_INDEX_MAPPING_DATASETS = (LinearMapSubset, ShuffledMapDataset, IdBasedMapSubset)
+_ENTRY_WRAPPING_DATASETS = (EntryTransformingMapDataset, ExceptionHandlingMapDataset,
+                            CachingMapDataset, KeyTransformingMapDataset)
+
+
+class FusedIndexMapDataset(Dataset[T_co], Generic[T_co]):
+    r"""
+    A map dataset remapping indices through a chain of index-mapping wrappers at once.
+    Created by `fuse_index_maps`.
+
+    Args:
+        dataset (Dataset[T_co]): The dataset under the fused wrappers
+        layers (Sequence[Dataset]): The fused index-mapping wrappers, outermost first
+        length (int): The length of the outermost fused wrapper
+        max_materialized (int): If the length is at most this, the composed index map is
+            precomputed into an array, making the cost per batch independent of the number of
+            fused layers. Otherwise (or if the mapped keys are not integers or strings), the
+            index maps of the layers are applied in turn. Only the layers are pickled, and the
+            array is recomputed in each process on first use, and whenever the epoch of a fused
+            `ShuffledMapDataset` changes (including through `set_epoch` on a copy of the dataset in
+            another process, e.g. in persistent DataLoader workers).
+    """
+
+    def __init__(self, dataset: Dataset[T_co], layers: Sequence[Dataset], length: int, max_materialized: int = 1 << 22) -> None:
+        self.dataset = dataset
+        self.layers = list(layers)
+        self.length = length
+        self.max_materialized = max_materialized
+        self._materialize()
+
+    def _epochs(self) -> tuple[int, ...]:
+        # the shared epochs of the fused layers, which set_epoch may change from another process
+        return tuple(int(layer._shared_epoch) for layer in self.layers if hasattr(layer, "_shared_epoch"))
+
+    def _materialize(self) -> None:
+        self._built_epochs: Optional[tuple[int, ...]] = self._epochs()
+        self.index_map: Optional[np.ndarray] = None
+        if self.length > self.max_materialized:
+            return
+        chunks = []
+        for start in range(0, self.length, 65536):
+            chunk = np.asarray(self._compose(range(start, min(start + 65536, self.length))))
+            if chunk.ndim != 1 or chunk.dtype.kind not in 'iuU':
+                # keys that do not fit in a flat array are mapped lazily
+                return
+            chunks.append(chunk)
+        self.index_map = np.concatenate(chunks) if chunks else np.zeros(0, dtype=np.int64)
+
+    def _compose(self, indices: Sequence[Any]) -> Sequence[Any]:
+        for layer in self.layers:
+            indices = layer._map_indices(indices)  # type: ignore[attr-defined]
+        return indices
+
+    def set_epoch(self, epoch: int) -> None:
+        """Calls `set_epoch` on the fused layers supporting it, and recomputes the index map"""
+        for layer in self.layers:
+            if callable(getattr(layer, "set_epoch", None)):
+                layer.set_epoch(epoch)  # type: ignore[attr-defined]
+        self._materialize()
+
+    def _map_indices(self, indices: Sequence[int]) -> Sequence[Any]:
+        if self._built_epochs is None or self._epochs() != self._built_epochs:
+            self._materialize()
+        if self.index_map is not None:
+            return self.index_map[np.asarray(indices, dtype=np.int64)].tolist()
+        return self._compose(indices)
+
+    def __getitem__(self, idx):
+        return self.dataset[self._map_indices([idx])[0]]
+
+    def __getitems__(self, indices: list[int]) -> list[T_co]:
+        # add batched sampling support when parent dataset supports it.
+        # see torch.utils.data._utils.fetch._MapDatasetFetcher
+        if callable(getattr(self.dataset, "__getitems__", None)):
+            return self.dataset.__getitems__(self._map_indices(indices))  # type: ignore[attr-defined] # noqa
+        else:
+            return [self.dataset[idx] for idx in self._map_indices(indices)]
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __getstate__(self):
+        return (self.dataset, self.layers, self.length, self.max_materialized)
+
+    def __setstate__(self, state):
+        (self.dataset, self.layers, self.length, self.max_materialized) = state
+        self.index_map = None
+        self._built_epochs = None
+
+
+def fuse_index_maps(dataset: Dataset[T_co], max_materialized: int = 1 << 22) -> Dataset[T_co]:
+    """Collapses chains of wrappers mapping positions to keys (`LinearMapSubset`,
+    `ShuffledMapDataset` and `IdBasedMapSubset`) in a dataset pipeline into single
+    `FusedIndexMapDataset`s with identical semantics. Other wrappers (`EntryTransformingMapDataset`,
+    `ExceptionHandlingMapDataset`, `CachingMapDataset`, and `KeyTransformingMapDataset`, whose
+    keys need not be positions) are kept in place, and the datasets of a `UnionMapDataset` are
+    fused separately. The fused layers are copies, so the original pipeline is left untouched
+    (also by `FusedIndexMapDataset.set_epoch`).
+
+    Args:
+        dataset (Dataset[T_co]): The outermost dataset of the pipeline
+        max_materialized (int): See `FusedIndexMapDataset`
+    """
+    layers = []
+    inner: Dataset = dataset
+    while isinstance(inner, _INDEX_MAPPING_DATASETS):
+        layers.append(copy.copy(inner))
+        inner = inner.dataset
+    if isinstance(inner, _ENTRY_WRAPPING_DATASETS):
+        inner = copy.copy(inner)
+        inner.dataset = fuse_index_maps(inner.dataset, max_materialized)  # type: ignore
+    elif isinstance(inner, UnionMapDataset):
+        inner = UnionMapDataset([fuse_index_maps(child, max_materialized)
+                                for child in inner.datasets], max_workers=inner.max_workers)
+    if not layers:
+        return inner
+    return FusedIndexMapDataset(inner, layers, len(dataset), max_materialized)  # type: ignore
+
+
 class TypedDataLoader(Iterable[T_co], DataLoader[T_co], Generic[T_co]):
     pass
 
@@ -305,7 +1095,470 @@ def remove_nones_from_batch(batch: Sequence[T_co], collate_fn: Callable[[Any], A
     return ()
 
 
+def collate_columns(batch: Any, fallback: Callable[[Any], Any] = remove_nones_from_batch) -> Any:
+    """Collates a columnar batch (a mapping of column names to batch columns, as returned by e.g.
+    `SQLiteDataset(..., columnar="numpy")`) by converting NumPy columns into tensors without copying.
+    Other columns are passed through as is. Batches that are not mappings are handed to `fallback`."""
+    if not isinstance(batch, Mapping):
+        return fallback(batch)
+    return {name: torch.from_numpy(column) if isinstance(column, np.ndarray) else column for name, column in batch.items()}
+
+
+# python scalar types in order of promotion, as in `default_collate` of a mixed column
+_SCALAR_PROMOTION = (bool, int, float)
+
+
+class _Field(NamedTuple):
+    kind: Literal['tensor', 'numpy', 'scalar', 'nested', 'list']
+    dtype: Any = None
+    shape: tuple[int, ...] = ()
+    types: tuple[type, ...] = ()
+
+    @staticmethod
+    def of(value: Any) -> '_Field':
+        if isinstance(value, torch.Tensor):
+            return _Field('tensor', value.dtype, tuple(value.shape))
+        if isinstance(value, np.ndarray) and value.dtype.kind in 'biufc':
+            return _Field('numpy', value.dtype, value.shape)
+        if type(value) is bool:
+            return _Field('scalar', np.dtype(np.bool_), types=(bool,))
+        if type(value) is int:
+            return _Field('scalar', np.dtype(np.int64), types=(int, bool))
+        if type(value) is float:
+            return _Field('scalar', np.dtype(np.float64), types=(float, int, bool))
+        if isinstance(value, (np.bool_, np.number)):
+            return _Field('scalar', value.dtype, types=(type(value),))
+        if isinstance(value, (Mapping, tuple, list)):
+            return _Field('nested')
+        return _Field('list')
+
+    def promoted(self, column: Sequence[Any]) -> '_Field':
+        # widens a python scalar field to the widest scalar type in the column (e.g. an integer
+        # column of a dynamically typed SQLite table holding some reals)
+        if self.kind != 'scalar' or self.types[0] not in _SCALAR_PROMOTION:
+            return self
+        types = set(map(type, column))
+        if types.issubset(self.types) or not types.issubset(_SCALAR_PROMOTION):
+            return self
+        return _Field.of(max(types, key=_SCALAR_PROMOTION.index)())
+
+    def _valid(self, value: Any) -> bool:
+        if self.kind == 'tensor':
+            return isinstance(value, torch.Tensor) and value.dtype == self.dtype and value.shape == self.shape
+        if self.kind == 'numpy':
+            return isinstance(value, np.ndarray) and value.dtype == self.dtype and value.shape == self.shape
+        if self.kind == 'scalar':
+            return type(value) in self.types
+        return True
+
+    def invalid(self, column: Sequence[Any]) -> list[int]:
+        # check the whole column at once with C-level map/set, and only look for the culprits on failure
+        if self.kind == 'list':
+            return []
+        types = set(map(type, column))
+        if self.kind == 'scalar':
+            if types.issubset(self.types):
+                return []
+        elif types == {torch.Tensor if self.kind == 'tensor' else np.ndarray} \
+                and set(map(operator.attrgetter('dtype'), column)) == {self.dtype} \
+                and set(map(tuple, map(operator.attrgetter('shape'), column))) == {self.shape}:
+            return []
+        return [i for i, v in enumerate(column) if not self._valid(v)]
+
+
+class _Schema(NamedTuple):
+    structure: type
+    keys: Optional[tuple[Any, ...]]
+    fields: tuple[_Field, ...]
+
+    @staticmethod
+    def of(sample: Any) -> '_Schema':
+        if isinstance(sample, Mapping):
+            return _Schema(type(sample), tuple(sample.keys()), tuple(_Field.of(v) for v in sample.values()))
+        if isinstance(sample, (tuple, list)):
+            return _Schema(type(sample), None, tuple(_Field.of(v) for v in sample))
+        return _Schema(object, None, (_Field.of(sample),))
+
+    def columns(self, samples: Sequence[Any]) -> list[Sequence[Any]]:
+        if self.keys is not None:
+            return [[sample[key] for sample in samples] for key in self.keys]
+        if self.structure is object:
+            return [samples]
+        return list(zip(*samples))
+
+    def malformed(self, samples: Sequence[Any]) -> list[int]:
+        if set(map(type, samples)) == {self.structure} and (self.keys is not None or set(map(len, samples)) == {len(self.fields)}):
+            if self.keys is None or all(tuple(s.keys()) == self.keys for s in samples):
+                return []
+        if self.keys is not None:
+            return [i for i, s in enumerate(samples) if type(s) is not self.structure or tuple(s.keys()) != self.keys]
+        if self.structure is not object:
+            return [i for i, s in enumerate(samples) if type(s) is not self.structure or len(s) != len(self.fields)]
+        return []
+
+
+class FastCollate:
+    r"""
+    A collate function producing the same batches as `default_collate` for tuple, list, named
+    tuple, mapping and single-value samples, but with the sample structure inferred once (from
+    the most common structure of the first batch) instead of being checked recursively for every
+    element. Tensor, NumPy array and numeric scalar fields are written directly into one newly
+    allocated tensor per field (in shared memory when called in a DataLoader worker, so that the
+    batch is not copied again on its way to the main process). Python scalar fields are promoted
+    within a batch (bool to int to float), so e.g. reals in a column that started out with
+    integers are kept. Nested tuple, list and mapping fields are collated by `default_collate`.
+    Other fields (e.g. strings) are returned as sequences of values, like `default_collate` does.
+
+    `None` samples are skipped, as are samples not matching the inferred structure (with a
+    warning), instead of dropping the whole batch as `remove_nones_from_batch` does. Fields of
+    varying shape must therefore be padded (or converted to lists) beforehand.
+
+    Args:
+        pin_memory (bool): Allocate batches in pinned memory when called in the main process and CUDA is available
+    """
+
+    def __init__(self, pin_memory: bool = False):
+        self.pin_memory = pin_memory
+        self.schema: Optional[_Schema] = None
+        self.dropped = 0
+
+    def _empty(self, shape: tuple[int, ...], dtype: torch.dtype) -> torch.Tensor:
+        if torch.utils.data.get_worker_info() is not None:
+            return torch.empty(shape, dtype=dtype).share_memory_()
+        if self.pin_memory and torch.cuda.is_available():
+            return torch.empty(shape, dtype=dtype, pin_memory=True)
+        return torch.empty(shape, dtype=dtype)
+
+    def _collate_column(self, field: _Field, column: Sequence[Any]) -> Any:
+        n = len(column)
+        if field.kind == 'tensor':
+            if torch.utils.data.get_worker_info() is None and not self.pin_memory:
+                # stacking into a given output tensor is slower for small tensors
+                return torch.stack(column)  # type: ignore
+            return torch.stack(column, out=self._empty((n, *field.shape), field.dtype))  # type: ignore
+        if field.kind == 'numpy':
+            out = self._empty((n, *field.shape), torch.from_numpy(np.empty(0, field.dtype)).dtype)
+            np.stack(column, out=out.numpy())  # type: ignore
+            return out
+        if field.kind == 'scalar':
+            out = self._empty((n,), torch.from_numpy(np.empty(0, field.dtype)).dtype)
+            out.numpy()[:] = column
+            return out
+        if field.kind == 'nested':
+            return torch.utils.data.default_collate(list(column))
+        return column
+
+    def _drop(self, samples: Sequence[Any], bad: set[int]) -> tuple[Sequence[Any], list[Sequence[Any]]]:
+        assert self.schema is not None
+        self.dropped += len(bad)
+        logging.warning(f"Dropped {len(bad)} malformed samples from batch")
+        samples = [s for i, s in enumerate(samples) if i not in bad]
+        return samples, self.schema.columns(samples)
+
+    def __call__(self, batch: Sequence[Any]) -> Any:
+        is_none = list(map(functools.partial(operator.is_, None), batch))
+        samples = [s for s, none in zip(batch, is_none) if not none] if any(is_none) else batch
+        if not samples:
+            logging.warning("Batch is empty")
+            return ()
+        if self.schema is None:
+            self.schema = collections.Counter(_Schema.of(s) for s in samples).most_common(1)[0][0]
+        schema = self.schema
+        bad = set(schema.malformed(samples))
+        if bad:
+            samples, columns = self._drop(samples, bad)
+        else:
+            columns = schema.columns(samples)
+        if any(field.kind == 'scalar' for field in schema.fields):
+            # promote scalar fields for this batch only, as default_collate decides per batch
+            schema = schema._replace(fields=tuple(field.promoted(column) for field, column in zip(schema.fields, columns)))
+        # scalars would be silently converted, so their types are checked up front. Arrays of the
+        # wrong shape make stacking fail, and are only looked for then.
+        bad = set(i for field, column in zip(schema.fields, columns) if field.kind == 'scalar' for i in field.invalid(column))
+        if bad:
+            samples, columns = self._drop(samples, bad)
+        if not samples:
+            return ()
+        try:
+            collated = [self._collate_column(field, column) for field, column in zip(schema.fields, columns)]
+        except (RuntimeError, TypeError, ValueError):
+            bad = set(i for field, column in zip(schema.fields, columns) for i in field.invalid(column))
+            if not bad:
+                raise
+            samples, columns = self._drop(samples, bad)
+            if not samples:
+                return ()
+            collated = [self._collate_column(field, column) for field, column in zip(schema.fields, columns)]
+        if schema.keys is not None:
+            return dict(zip(schema.keys, collated))
+        if schema.structure is object:
+            return collated[0]
+        if hasattr(schema.structure, "_fields"):
+            return schema.structure(*collated)
+        return collated
+
+
+_LATENCY_BUCKETS = 32
+_LAYER_COUNTERS = ("hits", "misses", "fallbacks", "failures", "skipped", "dropped")
+
+
+class PipelineMetrics:
+    r"""
+    Per-layer metrics of instrumented dataset pipelines (see `instrument_pipeline`): call counts,
+    numbers of samples, total and histogrammed latencies, and the counters kept by the layers
+    themselves (cache and prefetch `hits` and `misses`, exception handling `fallbacks`,
+    `failures` and `skipped`, and samples `dropped` by `FastCollate`).
+
+    The metrics are kept in shared memory tensors with one row per process (the main process and
+    each DataLoader worker), so that they are aggregated across workers without any communication.
+    They must therefore be created in the main process before the DataLoader workers start.
+    Workers of different DataLoaders (e.g. the persistent training and validation workers) share
+    the row of their worker id, so each row is guarded by a lock handed down to the processes the
+    metrics are sent to when they are started. Latencies are histogrammed in power of two buckets of microseconds.
+
+    Args:
+        max_layers (int): The maximum number of instrumented layers
+        max_workers (int): The maximum number of workers of a DataLoader
+    """
+
+    def __init__(self, max_layers: int = 64, max_workers: int = 64) -> None:
+        self.max_layers = max_layers
+        self.max_workers = max_workers
+        self.layers: list[str] = []
+        self.parents: list[Optional[int]] = []
+        self.counters: list[tuple[str, ...]] = []
+        rows = max_workers + 1
+        self.calls = torch.zeros((rows, max_layers), dtype=torch.int64).share_memory_()
+        self.samples = torch.zeros((rows, max_layers), dtype=torch.int64).share_memory_()
+        self.nanoseconds = torch.zeros((rows, max_layers), dtype=torch.int64).share_memory_()
+        self.latency = torch.zeros((rows, max_layers, _LATENCY_BUCKETS), dtype=torch.int64).share_memory_()
+        self.counts = torch.zeros((rows, max_layers, len(_LAYER_COUNTERS)), dtype=torch.int64).share_memory_()
+        self._locks = self._new_locks()
+        self._pid: Optional[int] = None
+        self._views()
+
+    def _new_locks(self) -> list[Any]:
+        context = multiprocessing.get_context("spawn")
+        return [context.Lock() for _ in range(self.max_workers + 1)]
+
+    def _process_state(self) -> None:
+        # the row and counter values seen are per process, and re-created after a fork
+        if self._pid != os.getpid():
+            worker_info = torch.utils.data.get_worker_info()
+            self._row = 0 if worker_info is None else worker_info.id + 1
+            self._lock = self._locks[self._row]
+            self._seen: dict[int, list[int]] = {}
+            self._pid = os.getpid()
+
+    def _views(self) -> None:
+        # NumPy views of the shared tensors, as updating single elements of tensors is slow
+        self._calls, self._samples, self._nanoseconds, self._latency, self._counts = (
+            self.calls.numpy(), self.samples.numpy(), self.nanoseconds.numpy(), self.latency.numpy(), self.counts.numpy())
+
+    def register(self, name: str, layer: Any, parent: Optional[int] = None) -> int:
+        """Registers a layer, returning its number. The layer is inspected for the counters it keeps."""
+        if len(self.layers) == self.max_layers:
+            raise ValueError(f"Cannot instrument more than {self.max_layers} layers")
+        self.layers.append(name)
+        self.parents.append(parent)
+        self.counters.append(tuple(counter for counter in _LAYER_COUNTERS
+                                   if isinstance(getattr(layer, counter, None), int)))
+        return len(self.layers) - 1
+
+    def start(self, number: int, layer: Any) -> int:
+        """Called before a call to a layer, returning the start time"""
+        self._process_state()
+        if self.counters[number] and number not in self._seen:
+            # the counters of a layer start from wherever they were when it was copied into this process
+            self._seen[number] = [getattr(layer, counter) for counter in self.counters[number]]
+        return time.perf_counter_ns()
+
+    def record(self, number: int, layer: Any, samples: int, start: int) -> None:
+        """Called after a call to a layer on `samples` samples, started at `start`"""
+        elapsed = time.perf_counter_ns() - start
+        self._process_state()
+        row = self._row
+        with self._lock:
+            self._calls[row, number] += 1
+            self._samples[row, number] += samples
+            self._nanoseconds[row, number] += elapsed
+            self._latency[row, number, min((elapsed // 1000).bit_length(), _LATENCY_BUCKETS - 1)] += 1
+            if self.counters[number]:
+                seen = self._seen[number]
+                for i, counter in enumerate(self.counters[number]):
+                    value = getattr(layer, counter)
+                    self._counts[row, number, _LAYER_COUNTERS.index(counter)] += value - seen[i]
+                    seen[i] = value
+
+    def reset(self) -> None:
+        """Zeroes all metrics"""
+        for tensor in (self.calls, self.samples, self.nanoseconds, self.latency, self.counts):
+            tensor.zero_()
+
+    def _percentile(self, histogram: np.ndarray, q: float) -> float:
+        # the upper bound of the bucket holding the q-quantile, in milliseconds
+        bucket = int(np.searchsorted(np.cumsum(histogram), q * histogram.sum()))
+        return (1 << bucket) / 1000
+
+    def summary(self) -> dict[str, float]:
+        r"""
+        Returns the metrics aggregated over all processes as a flat dictionary, suitable for e.g.
+        `lightning.pytorch.loggers.Logger.log_metrics`. For each layer that has been called, the
+        keys `<layer>/calls`, `<layer>/samples`, `<layer>/batch_size`, `<layer>/seconds`,
+        `<layer>/self_seconds` (excluding the time spent in the layers below it, which overlaps
+        with it if they are called concurrently), `<layer>/latency_p50_ms`, `<layer>/latency_p90_ms`
+        and `<layer>/latency_p99_ms` are included, along with the counters of the layer and its
+        hit rate if it counts hits and misses.
+        """
+        n = len(self.layers)
+        calls = self._calls[:, :n].sum(axis=0)
+        samples = self._samples[:, :n].sum(axis=0)
+        seconds = self._nanoseconds[:, :n].sum(axis=0) / 1e9
+        latency = self._latency[:, :n].sum(axis=0)
+        counts = self._counts[:, :n].sum(axis=0)
+        child_seconds = np.zeros(n)
+        for number, parent in enumerate(self.parents):
+            if parent is not None:
+                child_seconds[parent] += seconds[number]
+        metrics: dict[str, float] = {}
+        for number, name in enumerate(self.layers):
+            if calls[number] == 0:
+                continue
+            metrics[f"{name}/calls"] = int(calls[number])
+            metrics[f"{name}/samples"] = int(samples[number])
+            metrics[f"{name}/batch_size"] = samples[number] / calls[number]
+            metrics[f"{name}/seconds"] = float(seconds[number])
+            metrics[f"{name}/self_seconds"] = max(float(seconds[number] - child_seconds[number]), 0.0)
+            for q in (50, 90, 99):
+                metrics[f"{name}/latency_p{q}_ms"] = self._percentile(latency[number], q / 100)
+            for counter in self.counters[number]:
+                metrics[f"{name}/{counter}"] = int(counts[number, _LAYER_COUNTERS.index(counter)])
+            if "hits" in self.counters[number] and "misses" in self.counters[number]:
+                lookups = metrics[f"{name}/hits"] + metrics[f"{name}/misses"]
+                if lookups:
+                    metrics[f"{name}/hit_rate"] = metrics[f"{name}/hits"] / lookups
+        return metrics
+
+    def __getstate__(self):
+        # multiprocessing locks can only be pickled while starting a child process
+        locks = self._locks if get_spawning_popen() is not None else None
+        return (self.max_layers, self.max_workers, self.layers, self.parents, self.counters,
+                self.calls, self.samples, self.nanoseconds, self.latency, self.counts, locks)
+
+    def __setstate__(self, state):
+        (self.max_layers, self.max_workers, self.layers, self.parents, self.counters,
+         self.calls, self.samples, self.nanoseconds, self.latency, self.counts, locks) = state
+        self._locks = locks if locks is not None else self._new_locks()
+        self._pid = None
+        self._views()
+
+
+class InstrumentedMapDataset(Dataset[T_co], Generic[T_co]):
+    r"""A transparent dataset wrapper recording the calls to a layer of a pipeline (including
+    failed ones) in a `PipelineMetrics`. Other attributes are looked up from the wrapped layer. See `instrument_pipeline`.
+
+    Args:
+        dataset (Dataset[T_co]): The layer
+        metrics (PipelineMetrics): The metrics to record to
+        layer (int): The number of the layer in `metrics`
+    """
+
+    def __init__(self, dataset: Dataset[T_co], metrics: PipelineMetrics, layer: int) -> None:
+        self.dataset = dataset
+        self.metrics = metrics
+        self.layer = layer
+
+    def __getitem__(self, idx):
+        start = self.metrics.start(self.layer, self.dataset)
+        try:
+            return self.dataset[idx]
+        finally:
+            self.metrics.record(self.layer, self.dataset, 1, start)
+
+    def __getitems__(self, indices: Sequence[Any]) -> list[T_co]:
+        start = self.metrics.start(self.layer, self.dataset)
+        try:
+            # add batched sampling support when parent dataset supports it.
+            # see torch.utils.data._utils.fetch._MapDatasetFetcher
+            if callable(getattr(self.dataset, "__getitems__", None)):
+                return self.dataset.__getitems__(indices)  # type: ignore[attr-defined] # noqa
+            return [self.dataset[idx] for idx in indices]
+        finally:
+            self.metrics.record(self.layer, self.dataset, len(indices), start)
+
+    def __len__(self):
+        return len(self.dataset)  # type: ignore
+
+    def __getattr__(self, name: str) -> Any:
+        # expose e.g. set_epoch and start_offsets of the wrapped layer
+        if name.startswith("__") or name in ("dataset", "metrics", "layer"):
+            raise AttributeError(name)
+        return getattr(self.dataset, name)
+
+
+class InstrumentedCollate:
+    r"""A collate function wrapper recording its calls in a `PipelineMetrics`. See `instrument_pipeline`.
+
+    Args:
+        collate_fn (Callable[[Sequence[Any]], Any]): The collate function
+        metrics (PipelineMetrics): The metrics to record to
+        layer (int): The number of the collate function in `metrics`
+    """
+
+    def __init__(self, collate_fn: Callable[[Sequence[Any]], Any], metrics: PipelineMetrics, layer: int) -> None:
+        self.collate_fn = collate_fn
+        self.metrics = metrics
+        self.layer = layer
+
+    def __call__(self, batch: Sequence[Any]) -> Any:
+        start = self.metrics.start(self.layer, self.collate_fn)
+        try:
+            return self.collate_fn(batch)
+        finally:
+            self.metrics.record(self.layer, self.collate_fn, len(batch), start)
+
+
+def instrument_pipeline(dataset: Any, metrics: PipelineMetrics, name: str = "", parent: Optional[int] = None) -> Any:
+    """Wraps every map dataset layer of a pipeline (followed through the `dataset` attribute of
+    wrappers and the `datasets` of a `UnionMapDataset`) in an `InstrumentedMapDataset` registered
+    in `metrics` as `<name>/<class name>/...`, and returns the instrumented outermost layer.
+    Iterable datasets are not instrumented themselves, but the map datasets they wrap are.
+
+    The inner layers are instrumented in place, so the original pipeline keeps working on the
+    same layers (e.g. `set_epoch` on it reaches the instrumented pipeline). Layers that are already
+    instrumented are left as they are, so a layer shared by several pipelines is recorded once."""
+    if isinstance(dataset, InstrumentedMapDataset):
+        return dataset
+    path = f"{name}/{type(dataset).__name__}" if name else type(dataset).__name__
+    mapped = isinstance(dataset, Dataset) and not isinstance(dataset, torch.utils.data.IterableDataset)
+    layer = metrics.register(path, dataset, parent) if mapped else parent
+    if isinstance(dataset, UnionMapDataset):
+        dataset.datasets = [instrument_pipeline(child, metrics, f"{path}[{i}]", layer)
+                            for i, child in enumerate(dataset.datasets)]
+    elif isinstance(getattr(dataset, "dataset", None), Dataset):
+        dataset.dataset = instrument_pipeline(dataset.dataset, metrics, path, layer)
+    if not mapped:
+        return dataset
+    return InstrumentedMapDataset(dataset, metrics, cast(int, layer))
+
+
 class ABaseDataModule(Generic[T_co, T2_co], abc.ABC):
+    r"""
+    Base class for data modules creating `StatefulDataLoader`s for their datasets.
+
+    Args:
+        sampler_factory (Callable[[Dataset, str], Optional[Sampler]], optional): Called with the dataset
+            and the stage (`"train"`, `"val"`, `"test"` or `"predict"`) to create the sampler of a
+            dataloader (e.g. a `hscitorchutil.sampler.PartitionedDistributedSampler`). If it returns
+            None, training data is shuffled and other data is read in order.
+        batch_sampler_factory (Callable[[Dataset, str], Optional[Iterable[list]]], optional): Like
+            `sampler_factory`, but creates a batch sampler, which takes precedence over the sampler
+            and `batch_size`.
+        instrument (bool): Record per-layer metrics of the dataset pipelines and the collate function
+            (see `instrument_pipeline`), available from `data_metrics()`. Without it, the
+            dataloaders are not touched at all.
+    """
+
     def __init__(self,
                  batch_size: int = 64,
                  num_train_workers: int = 0,
@@ -316,7 +1569,10 @@ class ABaseDataModule(Generic[T_co, T2_co], abc.ABC):
                  pin_memory: bool = True,
                  persistent_workers: Optional[bool] = None,
                  prefetch_factor: int = 2,
-                 collate_fn: Optional[Callable[[Sequence[T_co]], T2_co]] = remove_nones_from_batch):
+                 collate_fn: Optional[Callable[[Sequence[T_co]], T2_co]] = remove_nones_from_batch,
+                 sampler_factory: Optional[Callable[[Dataset[T_co], DataLoaderStage], Optional[torch.utils.data.Sampler]]] = None,
+                 batch_sampler_factory: Optional[Callable[[Dataset[T_co], DataLoaderStage], Optional[Iterable[list[Any]]]]] = None,
+                 instrument: bool = False):
         self.batch_size = batch_size
         self.num_train_workers = num_train_workers
         self.num_val_workers = num_val_workers
@@ -327,6 +1583,10 @@ class ABaseDataModule(Generic[T_co, T2_co], abc.ABC):
         self.pin_memory = pin_memory
         self.persistent_workers = persistent_workers
         self.prefetch_factor = prefetch_factor
+        self.sampler_factory = sampler_factory
+        self.batch_sampler_factory = batch_sampler_factory
+        self.pipeline_metrics: Optional[PipelineMetrics] = PipelineMetrics(max_workers=max(
+            num_train_workers, num_val_workers, num_test_workers, num_predict_workers)) if instrument else None
         self.train_dataset: Optional[Dataset[T_co]] = None
         self.val_dataset: Optional[Dataset[T_co]] = None
         self.test_dataset: Optional[Dataset[T_co]] = None
@@ -337,34 +1597,61 @@ class ABaseDataModule(Generic[T_co, T2_co], abc.ABC):
         self._predict_dataloader = None
         super().__init__()
 
+    def _sampling(self, dataset: Dataset[T_co], stage: DataLoaderStage) -> dict[str, Any]:
+        if self.batch_sampler_factory is not None:
+            batch_sampler = self.batch_sampler_factory(dataset, stage)
+            if batch_sampler is not None:
+                return dict(batch_sampler=batch_sampler)
+        if self.sampler_factory is not None:
+            sampler = self.sampler_factory(dataset, stage)
+            if sampler is not None:
+                return dict(sampler=sampler, batch_size=self.batch_size)
+        return dict(shuffle=stage == "train", batch_size=self.batch_size)
+
+    def _pipeline(self, dataset: Dataset[T_co], stage: DataLoaderStage) -> dict[str, Any]:
+        if self.pipeline_metrics is None:
+            return dict(dataset=dataset, collate_fn=self.collate_fn)
+        collate_fn = self.collate_fn
+        if collate_fn is not None:
+            collate_fn = InstrumentedCollate(collate_fn, self.pipeline_metrics, self.pipeline_metrics.register(
+                f"{stage}/collate/{getattr(collate_fn, '__name__', type(collate_fn).__name__)}", collate_fn))
+        return dict(dataset=instrument_pipeline(dataset, self.pipeline_metrics, stage), collate_fn=collate_fn)
+
+    def data_metrics(self) -> dict[str, float]:
+        """Returns the metrics recorded with `instrument` (see `PipelineMetrics.summary`), with keys
+        prefixed by the stage, or an empty dictionary. Can be passed to e.g. `logger.log_metrics`."""
+        if self.pipeline_metrics is None:
+            return {}
+        return self.pipeline_metrics.summary()
+
     def train_dataloader(self) -> TypedStatefulDataLoader[T2_co]:
         if self._train_dataloader is None:
             if self.train_dataset is None:
                 raise ValueError("Training dataset not available")
-            self._train_dataloader = cast(TypedStatefulDataLoader[T2_co], StatefulDataLoader(self.train_dataset, shuffle=True, batch_size=self.batch_size, num_workers=self.num_train_workers,
-                                          persistent_workers=self.persistent_workers or self.num_train_workers > 0, collate_fn=self.collate_fn, pin_memory=self.pin_memory, prefetch_factor=self.prefetch_factor if self.num_train_workers > 0 else None))
+            self._train_dataloader = cast(TypedStatefulDataLoader[T2_co], StatefulDataLoader(**self._pipeline(self.train_dataset, "train"), **self._sampling(self.train_dataset, "train"), num_workers=self.num_train_workers,
+                                          persistent_workers=self.persistent_workers or self.num_train_workers > 0, pin_memory=self.pin_memory, prefetch_factor=self.prefetch_factor if self.num_train_workers > 0 else None))
         return self._train_dataloader
 
     def val_dataloader(self) -> TypedStatefulDataLoader[T2_co]:
         if self._val_dataloader is None:
             if self.val_dataset is None:
                 raise ValueError("Validation dataset not available")
-            self._val_dataloader = cast(TypedStatefulDataLoader[T2_co], StatefulDataLoader(self.val_dataset, batch_size=self.batch_size, num_workers=self.num_val_workers,
-                                        persistent_workers=self.persistent_workers or self.num_val_workers > 0, collate_fn=self.collate_fn, pin_memory=self.pin_memory, prefetch_factor=self.prefetch_factor if self.num_val_workers > 0 else None))
+            self._val_dataloader = cast(TypedStatefulDataLoader[T2_co], StatefulDataLoader(**self._pipeline(self.val_dataset, "val"), **self._sampling(self.val_dataset, "val"), num_workers=self.num_val_workers,
+                                        persistent_workers=self.persistent_workers or self.num_val_workers > 0, pin_memory=self.pin_memory, prefetch_factor=self.prefetch_factor if self.num_val_workers > 0 else None))
         return self._val_dataloader
 
     def test_dataloader(self) -> TypedStatefulDataLoader[T2_co]:
         if self._test_dataloader is None:
             if self.test_dataset is None:
                 raise ValueError("Test dataset not available")
-            self._test_dataloader = cast(TypedStatefulDataLoader[T2_co], StatefulDataLoader(self.test_dataset, batch_size=self.batch_size, num_workers=self.num_test_workers,
-                                         persistent_workers=self.persistent_workers or self.num_test_workers > 0, collate_fn=self.collate_fn, pin_memory=self.pin_memory, prefetch_factor=self.prefetch_factor if self.num_test_workers > 0 else None))
+            self._test_dataloader = cast(TypedStatefulDataLoader[T2_co], StatefulDataLoader(**self._pipeline(self.test_dataset, "test"), **self._sampling(self.test_dataset, "test"), num_workers=self.num_test_workers,
+                                         persistent_workers=self.persistent_workers or self.num_test_workers > 0, pin_memory=self.pin_memory, prefetch_factor=self.prefetch_factor if self.num_test_workers > 0 else None))
         return self._test_dataloader
 
     def predict_dataloader(self) -> TypedStatefulDataLoader[T2_co]:
         if self._predict_dataloader is None:
             if self.predict_dataset is None:
                 raise ValueError("Predict dataset not available")
-            self._predict_dataloader = cast(TypedStatefulDataLoader[T2_co], StatefulDataLoader(self.predict_dataset, batch_size=self.batch_size, num_workers=self.num_predict_workers,
-                                            persistent_workers=self.persistent_workers or self.num_predict_workers > 0, collate_fn=self.collate_fn, pin_memory=self.pin_memory))
+            self._predict_dataloader = cast(TypedStatefulDataLoader[T2_co], StatefulDataLoader(**self._pipeline(self.predict_dataset, "predict"), **self._sampling(self.predict_dataset, "predict"), num_workers=self.num_predict_workers,
+                                            persistent_workers=self.persistent_workers or self.num_predict_workers > 0, pin_memory=self.pin_memory))
         return self._predict_dataloader
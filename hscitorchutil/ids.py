@@ -0,0 +1,77 @@
+import os
+from typing import Iterable, Optional, Sequence, overload
+
+import numpy as np
+
+
+class StringIdArray(Sequence[str]):
+    r"""
+    A compact sequence of string ids, stored as one UTF-8 byte buffer and an offsets table.
+
+    When loaded with `load`, both arrays are memory-mapped, so that all processes share the same
+    pages through the OS page cache, and pickling only transfers the file names.
+
+    Args:
+        data (np.ndarray): The concatenated UTF-8 encoded ids, as a uint8 array
+        offsets (np.ndarray): The start offset of each id in `data`, followed by the total length
+    """
+
+    def __init__(self, data: np.ndarray, offsets: np.ndarray):
+        self.data = data
+        self.offsets = offsets
+        self._prefix: Optional[str] = None
+
+    @classmethod
+    def from_strings(cls, ids: Iterable[str]) -> 'StringIdArray':
+        encoded = [id.encode() for id in ids]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(e) for e in encoded], out=offsets[1:])
+        return cls(np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets)
+
+    def save(self, prefix: str | os.PathLike) -> None:
+        """Saves the ids into `{prefix}.data.npy` and `{prefix}.offsets.npy`"""
+        np.save(f"{prefix}.data.npy", self.data)
+        np.save(f"{prefix}.offsets.npy", self.offsets)
+
+    @classmethod
+    def load(cls, prefix: str | os.PathLike) -> 'StringIdArray':
+        """Memory-maps ids saved with `save`"""
+        ret = cls(np.load(f"{prefix}.data.npy", mmap_mode='r'),
+                  np.load(f"{prefix}.offsets.npy", mmap_mode='r'))
+        ret._prefix = str(prefix)
+        return ret
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    @overload
+    def __getitem__(self, idx: int) -> str: ...
+
+    @overload
+    def __getitem__(self, idx: slice | Sequence[int] | np.ndarray) -> list[str]: ...
+
+    def __getitem__(self, idx):
+        if isinstance(idx, (int, np.integer)):
+            if idx < 0:
+                idx += len(self)
+            return bytes(self.data[self.offsets[idx]:self.offsets[idx + 1]]).decode()
+        if isinstance(idx, slice):
+            idx = np.arange(*idx.indices(len(self)))
+        idx = np.asarray(idx, dtype=np.int64)
+        starts = self.offsets[idx].tolist()
+        ends = self.offsets[idx + 1].tolist()
+        data = self.data
+        return [bytes(data[start:end]).decode() for start, end in zip(starts, ends)]
+
+    def __getstate__(self):
+        if self._prefix is not None:
+            return (self._prefix,)
+        return (self.data, self.offsets)
+
+    def __setstate__(self, state):
+        if len(state) == 1:
+            loaded = StringIdArray.load(state[0])
+            self.data, self.offsets, self._prefix = loaded.data, loaded.offsets, loaded._prefix
+        else:
+            (self.data, self.offsets) = state
+            self._prefix = None
@@ -0,0 +1,148 @@
+from typing import Sequence
+
+import numpy as np
+
+_MASK64 = 0xFFFFFFFFFFFFFFFF
+
+
+def _mix64(x: int) -> int:
+    x = (x + 0x9E3779B97F4A7C15) & _MASK64
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & _MASK64
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & _MASK64
+    return x ^ (x >> 31)
+
+
+class FeistelPermutation(Sequence[int]):
+    r"""
+    A pseudo-random permutation of `range(n)` that is computed on demand instead of being stored.
+
+    The permutation is an unbalanced Feistel network over the smallest power of two covering `n`,
+    with rounds alternately mixing the high half of the bits into the low half and vice versa.
+    It is restricted to `range(n)` by cycle walking (re-encrypting values that fall outside the
+    range, on average less than twice). It uses no memory proportional to `n`, and gives the same
+    result in every process for the same `n`, `seed` and `epoch`.
+
+    Args:
+        n (int): The size of the permuted range
+        seed (int): The seed of the permutation
+        epoch (int): Further distinguishes permutations with the same seed
+        rounds (int): The number of Feistel rounds
+    """
+
+    def __init__(self, n: int, seed: int, epoch: int = 0, rounds: int = 8):
+        self.n = n
+        self.seed = seed
+        self.epoch = epoch
+        self.rounds = rounds
+        bits = max(2, (n - 1).bit_length())
+        self._low_bits = bits // 2
+        self._high_bits = bits - self._low_bits
+        base = _mix64(_mix64(seed & _MASK64) ^ (epoch & _MASK64))
+        self._keys = [np.uint64(_mix64(base + r)) for r in range(rounds)]
+
+    def __len__(self) -> int:
+        return self.n
+
+    def _encrypt(self, x: np.ndarray) -> np.ndarray:
+        low_bits = np.uint64(self._low_bits)
+        low_shift = np.uint64(64 - self._low_bits)
+        high_shift = np.uint64(64 - self._high_bits)
+        multiplier = np.uint64(0x9E3779B97F4A7C15)
+        high = x >> low_bits
+        low = x & np.uint64((1 << self._low_bits) - 1)
+        for r, key in enumerate(self._keys):
+            # multiplicative hashing: the top bits of the product are well mixed
+            if r % 2 == 0:
+                low ^= ((high ^ key) * multiplier) >> low_shift
+            else:
+                high ^= ((low ^ key) * multiplier) >> high_shift
+        return (high << low_bits) | low
+
+    def permute(self, indices: np.ndarray) -> np.ndarray:
+        """Maps an array of indices in `range(n)` to their permuted values"""
+        indices = np.asarray(indices)
+        if indices.size and (indices.min() < 0 or indices.max() >= self.n):
+            raise IndexError("permutation index out of range")
+        result = self._encrypt(indices.astype(np.uint64))
+        outside = np.flatnonzero(result >= self.n)
+        while len(outside):
+            result[outside] = self._encrypt(result[outside])
+            outside = outside[result[outside] >= self.n]
+        return result.astype(np.int64)
+
+    def __getitem__(self, idx):  # type: ignore[override]
+        if isinstance(idx, slice):
+            return self.permute(np.arange(*idx.indices(self.n))).tolist()
+        if idx < 0:
+            idx += self.n
+        return int(self.permute(np.array([idx]))[0])
+
+
+class BlockShufflePermutation(Sequence[int]):
+    r"""
+    A locality-preserving pseudo-random permutation of `range(n)`, computed on demand.
+
+    `range(n)` is cut into blocks of `block_size` consecutive indices, and the blocks are
+    permuted (a final partial block stays in place). The result is then cut into windows of
+    `window_size` consecutive positions, and positions are shuffled within each window. So any
+    `window_size` consecutive positions of the permutation draw from about
+    `window_size / block_size` blocks, each of which is read completely.
+
+    The trade-off: larger blocks mean fewer, longer sequential reads (each block is one
+    contiguous region of the underlying storage), but samples of a block are never more than
+    `window_size` positions apart, so correlated neighbouring samples stay correlated within
+    batches. Larger windows mix more blocks together at the cost of keeping more blocks in use
+    at once (for good page cache behaviour, `window_size` samples should comfortably fit in cache).
+    With `block_size=1`, this is a full shuffle restricted to windows; with `window_size=n` it is
+    a full shuffle.
+
+    Args:
+        n (int): The size of the permuted range
+        block_size (int): The number of consecutive indices kept together
+        window_size (int): The number of consecutive positions shuffled together
+        seed (int): The seed of the permutation
+        epoch (int): Further distinguishes permutations with the same seed
+    """
+
+    def __init__(self, n: int, block_size: int, window_size: int, seed: int, epoch: int = 0):
+        if block_size < 1 or window_size < 1:
+            raise ValueError("block_size and window_size must be positive")
+        self.n = n
+        self.block_size = block_size
+        self.window_size = window_size
+        self.seed = seed
+        self.epoch = epoch
+        self._full_blocks = n // block_size
+        self._blocks = FeistelPermutation(
+            self._full_blocks, seed, epoch << 32) if self._full_blocks > 1 else None
+
+    def __len__(self) -> int:
+        return self.n
+
+    def _window(self, window: int) -> FeistelPermutation:
+        start = window * self.window_size
+        return FeistelPermutation(min(self.window_size, self.n - start), self.seed, (self.epoch << 32) + window + 1)
+
+    def permute(self, indices: np.ndarray) -> np.ndarray:
+        """Maps an array of indices in `range(n)` to their permuted values"""
+        indices = np.asarray(indices, dtype=np.int64)
+        if indices.size and (indices.min() < 0 or indices.max() >= self.n):
+            raise IndexError("permutation index out of range")
+        windows = indices // self.window_size
+        result = indices.copy()
+        for window in np.unique(windows).tolist():
+            members = windows == window
+            result[members] = window * self.window_size + \
+                self._window(window).permute(indices[members] % self.window_size)
+        if self._blocks is not None:
+            blocks = result // self.block_size
+            full = blocks < self._full_blocks
+            result[full] = self._blocks.permute(blocks[full]) * self.block_size + result[full] % self.block_size
+        return result
+
+    def __getitem__(self, idx):  # type: ignore[override]
+        if isinstance(idx, slice):
+            return self.permute(np.arange(*idx.indices(self.n))).tolist()
+        if idx < 0:
+            idx += self.n
+        return int(self.permute(np.array([idx]))[0])
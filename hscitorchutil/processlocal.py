@@ -1,5 +1,8 @@
 import os
+import threading
+from contextlib import nullcontext
 from types import SimpleNamespace
+from typing import Any, Callable, ContextManager, Generic, Optional, TypeVar
 
 
 class ProcessLocal(object):
@@ -27,3 +30,76 @@ class ProcessLocal(object):
         else:
             self._thread_init()
             setattr(self._local, item, value)
+
+
+T = TypeVar('T')
+
+
+def _close(resource: Any) -> None:
+    close = getattr(resource, "close", None)
+    if callable(close):
+        close()
+
+
+class ProcessLocalResource(Generic[T]):
+    r"""
+    A lazily created resource (such as a database connection or file handle) that is never shared
+    between processes.
+
+    The resource is created by calling `factory` on first use in each process, or in each thread if
+    `per_thread` is set. Forked children thus never reuse the resources of their parent, and
+    pickling only transfers the factory, so that unpickling in a spawned worker costs nothing
+    until the resource is actually used.
+
+    Args:
+        factory (Callable[[], T]): Creates a new resource. Must be picklable.
+        per_thread (bool): Create a separate resource for each thread
+        close (Callable[[T], Any]): Releases a resource. By default, calls its `close()` method if it has one.
+    """
+
+    def __init__(self, factory: Callable[[], T], per_thread: bool = False, close: Callable[[T], Any] = _close):
+        self.factory = factory
+        self.per_thread = per_thread
+        self.closer = close
+        self._local = ProcessLocal()
+
+    def _resources(self) -> dict[Optional[int], T]:
+        try:
+            return self._local.resources
+        except AttributeError:
+            self._local.resources = dict()
+            self._local.lock = nullcontext() if self.per_thread else threading.RLock()
+            return self._local.resources
+
+    def get(self) -> T:
+        """Returns the resource of the current process (or thread), creating it if necessary"""
+        resources = self._resources()
+        key = threading.get_ident() if self.per_thread else None
+        resource = resources.get(key)
+        if resource is None:
+            resource = self.factory()
+            existing = resources.setdefault(key, resource)
+            if existing is not resource:
+                self.closer(resource)
+                resource = existing
+        return resource
+
+    @property
+    def lock(self) -> ContextManager:
+        """A lock serialising the use of a resource shared between threads. A no-op if resources are per thread."""
+        self._resources()
+        return self._local.lock
+
+    def close(self) -> None:
+        """Releases all resources created in the current process"""
+        resources = self._resources()
+        while resources:
+            _, resource = resources.popitem()
+            self.closer(resource)
+
+    def __getstate__(self):
+        return (self.factory, self.per_thread, self.closer)
+
+    def __setstate__(self, state):
+        (self.factory, self.per_thread, self.closer) = state
+        self._local = ProcessLocal()
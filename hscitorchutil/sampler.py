@@ -0,0 +1,254 @@
+import bisect
+from typing import Any, Iterator, Literal, Optional, Sequence, Sized
+
+import numpy as np
+import torch
+import torch.distributed
+from torch.utils.data import Sampler
+
+from hscitorchutil.dataset import shard_range
+from hscitorchutil.permutation import BlockShufflePermutation, FeistelPermutation
+
+
+def _assign_shards(boundaries: Sequence[int], num_replicas: int) -> list[list[tuple[int, int]]]:
+    # greedily give the largest remaining shard to the least loaded rank, so that every rank
+    # computes the same assignment
+    shards = [(boundaries[i], boundaries[i + 1]) for i in range(len(boundaries) - 1)]
+    if len(shards) < num_replicas:
+        raise ValueError(
+            f"Cannot assign {len(shards)} shards to {num_replicas} ranks")
+    loads = [0] * num_replicas
+    assignment: list[list[tuple[int, int]]] = [[] for _ in range(num_replicas)]
+    for start, stop in sorted(shards, key=lambda shard: (shard[0] - shard[1], shard[0])):
+        rank = loads.index(min(loads))
+        assignment[rank].append((start, stop))
+        loads[rank] += stop - start
+    return [sorted(ranges) for ranges in assignment]
+
+
+class PartitionedDistributedSampler(Sampler[int]):
+    r"""
+    A distributed sampler giving each rank a fixed partition of the dataset, so that the page
+    cache of each node only needs to hold its own partition.
+
+    With `partition="contiguous"`, each rank gets one contiguous range of indices. With
+    `partition="shards"`, each rank gets whole shards (e.g. the SQLite databases concatenated by a
+    `UnionMapDataset`, whose `start_offsets` are used by default), balanced by size. The indices of
+    the partition are shuffled lazily by a permutation seeded with `seed` and the epoch (see
+    `hscitorchutil.permutation`), optionally block-wise for locality. To keep ranks in step,
+    partitions are padded by repeating indices (or truncated with `drop_last`) to the same length.
+
+    The number of indices yielded is available through `state_dict`, so that a
+    `StatefulDataLoader` resumes mid-epoch without replaying the sampler.
+
+    Args:
+        dataset (Sized): The dataset to sample from
+        num_replicas (int, optional): The number of ranks. Defaults to the torch.distributed world size.
+        rank (int, optional): The rank of this process. Defaults to the torch.distributed rank.
+        shuffle (bool): Whether to shuffle the indices of the partition
+        seed (int): The seed of the shuffle
+        drop_last (bool): Truncate partitions to the shortest one instead of padding them to the longest one
+        partition (str): `"contiguous"` or `"shards"`
+        shard_offsets (Sequence[int], optional): The start index of each shard, for `partition="shards"`
+        block_size (int, optional): Shuffle blocks of this many consecutive indices (see `BlockShufflePermutation`)
+        window_size (int, optional): The window of the block shuffle. Defaults to 4 * `block_size`.
+    """
+
+    def __init__(self, dataset: Sized, num_replicas: Optional[int] = None, rank: Optional[int] = None,
+                 shuffle: bool = True, seed: int = 0, drop_last: bool = False,
+                 partition: Literal['contiguous', 'shards'] = 'contiguous', shard_offsets: Optional[Sequence[int]] = None,
+                 block_size: Optional[int] = None, window_size: Optional[int] = None):
+        if num_replicas is None or rank is None:
+            if torch.distributed.is_available() and torch.distributed.is_initialized():
+                num_replicas = torch.distributed.get_world_size() if num_replicas is None else num_replicas
+                rank = torch.distributed.get_rank() if rank is None else rank
+            else:
+                num_replicas = 1 if num_replicas is None else num_replicas
+                rank = 0 if rank is None else rank
+        if not 0 <= rank < num_replicas:
+            raise ValueError(f"Invalid rank {rank} for {num_replicas} ranks")
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.seed = seed
+        self.drop_last = drop_last
+        self.block_size = block_size
+        self.window_size = window_size
+        n = len(dataset)
+        if partition == 'contiguous':
+            partitions = [[(r.start, r.stop)] for r in (shard_range(
+                n, rank, num_replicas) for rank in range(num_replicas))]
+        elif partition == 'shards':
+            if shard_offsets is None:
+                shard_offsets = getattr(dataset, "start_offsets", None)
+                if shard_offsets is None:
+                    raise ValueError(
+                        "shard_offsets must be given for datasets without start_offsets")
+            partitions = _assign_shards(list(shard_offsets) + [n], num_replicas)
+        else:
+            raise ValueError(f"Unknown partition {partition}")
+        sizes = [sum(stop - start for start, stop in ranges) for ranges in partitions]
+        self.num_samples = min(sizes) if drop_last else max(sizes)
+        ranges = partitions[rank]
+        self._starts = np.array([start for start, _ in ranges], dtype=np.int64)
+        self._cumulative = np.cumsum([0] + [stop - start for start, stop in ranges])
+        self.partition_size = sizes[rank]
+        self.epoch = 0
+        self.yielded = 0
+        self._next_yielded: Optional[int] = None
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+
+    def _permutation(self):
+        if not self.shuffle or self.partition_size < 2:
+            return None
+        if self.block_size is not None:
+            return BlockShufflePermutation(self.partition_size, self.block_size, self.window_size or 4 * self.block_size, self.seed, self.epoch)
+        return FeistelPermutation(self.partition_size, self.seed, self.epoch)
+
+    def _indices(self, positions: np.ndarray) -> np.ndarray:
+        positions = positions % self.partition_size
+        permutation = self._permutation()
+        if permutation is not None:
+            positions = permutation.permute(positions)
+        ranges = np.searchsorted(self._cumulative, positions, side='right') - 1
+        return self._starts[ranges] + positions - self._cumulative[ranges]
+
+    def __iter__(self) -> Iterator[int]:
+        self.yielded = 0
+        if self._next_yielded is not None:
+            self.yielded, self._next_yielded = self._next_yielded, None
+        if self.partition_size == 0:
+            return
+        for chunk_start in range(self.yielded, self.num_samples, 4096):
+            for idx in self._indices(np.arange(chunk_start, min(chunk_start + 4096, self.num_samples))).tolist():
+                self.yielded += 1
+                yield idx
+
+    def __len__(self) -> int:
+        return self.num_samples
+
+    def state_dict(self) -> dict[str, Any]:
+        return {"epoch": self.epoch, "yielded": self.yielded}
+
+    def load_state_dict(self, state_dict: dict[str, Any]) -> None:
+        self.epoch = state_dict["epoch"]
+        self._next_yielded = state_dict["yielded"]
+
+
+class LengthBucketBatchSampler(Sampler[list[int]]):
+    r"""
+    A batch sampler forming batches of samples of similar length, bounded by a total budget of
+    tokens (or bytes) instead of a number of samples.
+
+    Each epoch, the indices are shuffled and cut into pools of `pool_size` samples. Each pool is
+    sorted by length and cut greedily into batches whose padded size (number of samples times
+    the longest length) stays within `max_tokens` (or, with `padded=False`, whose total length
+    does). The batches are then shuffled. A sample longer than `max_tokens` forms a batch by itself.
+    Larger pools waste less padding but make batches less random.
+
+    The number of batches yielded is available through `state_dict`, so that a
+    `StatefulDataLoader` resumes mid-epoch without replaying the sampler.
+
+    Args:
+        lengths (np.ndarray | Sequence[int]): The length of each sample (see e.g. `SQLiteDataset.read_column`)
+        max_tokens (int): The budget of a batch
+        pool_size (int): The number of samples sorted together
+        max_batch_size (int, optional): The maximum number of samples in a batch
+        padded (bool): Whether the budget bounds the padded size of a batch or the total length of its samples
+        shuffle (bool): Whether to shuffle the samples and the batches. Otherwise, batches are formed and returned in index order.
+        seed (int): The seed of the shuffle
+        num_replicas (int): The number of ranks to divide the batches between
+        rank (int): The rank of this process
+    """
+
+    def __init__(self, lengths: np.ndarray | Sequence[int], max_tokens: int, pool_size: int = 65536,
+                 max_batch_size: Optional[int] = None, padded: bool = True, shuffle: bool = True, seed: int = 0,
+                 num_replicas: int = 1, rank: int = 0):
+        self.lengths = np.asarray(lengths)
+        self.max_tokens = max_tokens
+        self.pool_size = pool_size
+        self.max_batch_size = max_batch_size
+        self.padded = padded
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+        self.yielded = 0
+        self._next_yielded: Optional[int] = None
+        self._batches: Optional[tuple[int, np.ndarray, np.ndarray]] = None
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+
+    def _cut(self, lengths: np.ndarray) -> list[int]:
+        # returns the end of each batch in a pool sorted by length
+        ends = []
+        start = 0
+        n = len(lengths)
+        cumulative = None if self.padded else np.cumsum(lengths)
+        while start < n:
+            limit = n if self.max_batch_size is None else min(n, start + self.max_batch_size)
+            if self.padded:
+                end = bisect.bisect_right(range(start, limit), self.max_tokens,
+                                          key=lambda e: (e - start + 1) * int(lengths[e])) + start
+            else:
+                assert cumulative is not None
+                end = int(np.searchsorted(cumulative[start:limit], (cumulative[start - 1] if start else 0) + self.max_tokens, side='right')) + start
+            end = max(end, start + 1)
+            ends.append(end)
+            start = end
+        return ends
+
+    def _epoch_batches(self) -> tuple[np.ndarray, np.ndarray]:
+        # the samples of all batches of this rank in order, and the end of each batch
+        if self._batches is not None and self._batches[0] == self.epoch:
+            return self._batches[1], self._batches[2]
+        rng = np.random.default_rng((self.seed, self.epoch))
+        n = len(self.lengths)
+        order = rng.permutation(n) if self.shuffle else np.arange(n)
+        pools = []
+        starts_list: list[int] = []
+        stops_list: list[int] = []
+        for offset in range(0, n, self.pool_size):
+            pool = order[offset:offset + self.pool_size]
+            pool = pool[np.argsort(self.lengths[pool], kind='stable')]
+            ends = self._cut(self.lengths[pool])
+            starts_list.extend(offset + start for start in [0] + ends[:-1])
+            stops_list.extend(offset + end for end in ends)
+            pools.append(pool)
+        all_samples = np.concatenate(pools) if pools else np.zeros(0, dtype=np.int64)
+        starts = np.array(starts_list, dtype=np.int64)
+        stops = np.array(stops_list, dtype=np.int64)
+        if self.shuffle:
+            batch_order = rng.permutation(len(starts))
+            starts, stops = starts[batch_order], stops[batch_order]
+        per_rank = len(starts) // self.num_replicas
+        starts = starts[self.rank::self.num_replicas][:per_rank]
+        stops = stops[self.rank::self.num_replicas][:per_rank]
+        ends = np.cumsum(stops - starts)
+        rank_samples = np.concatenate([all_samples[start:stop] for start, stop in zip(starts, stops)]) if len(starts) else all_samples[:0]
+        self._batches = (self.epoch, rank_samples, ends)
+        return rank_samples, ends
+
+    def __iter__(self) -> Iterator[list[int]]:
+        self.yielded = 0
+        if self._next_yielded is not None:
+            self.yielded, self._next_yielded = self._next_yielded, None
+        samples, ends = self._epoch_batches()
+        for batch in range(self.yielded, len(ends)):
+            start = ends[batch - 1] if batch else 0
+            self.yielded += 1
+            yield samples[start:ends[batch]].tolist()
+
+    def __len__(self) -> int:
+        return len(self._epoch_batches()[1])
+
+    def state_dict(self) -> dict[str, Any]:
+        return {"epoch": self.epoch, "yielded": self.yielded}
+
+    def load_state_dict(self, state_dict: dict[str, Any]) -> None:
+        self.epoch = state_dict["epoch"]
+        self._next_yielded = state_dict["yielded"]
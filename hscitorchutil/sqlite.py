@@ -1,48 +1,274 @@
+import functools
 import os
 import sqlite3
-from typing import Callable, Generic, Iterable, Literal, Optional, TypeVar, Sequence
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Generic, Iterable, Literal, Optional, TypeVar, Sequence
 from typing_extensions import TypeVarTuple, Unpack
-from zipfile import ZipFile
+from urllib.request import pathname2url
 import click
-import fsspec
+import numpy as np
+import torch
 from contextlib import closing
-from torch.utils.data import Dataset, DataLoader
-from edzip.sqlite import create_sqlite_directory_from_zip
-from hscitorchutil.dataset import ABaseDataModule, identity_transformation
-from hscifsspecutil import get_s3fs_credentials, cache_locally_if_remote
+from torch.utils.data import Dataset, DataLoader, IterableDataset
+from hscitorchutil.dataset import ABaseDataModule, contiguous_runs, current_shard, identity_transformation, shard_range
+from hscitorchutil.processlocal import ProcessLocalResource
+from hscitorchutil.staging import stage_file, stage_files
+from hscitorchutil.zipdirectory import create_sqlite_directory
+from hscifsspecutil import get_s3fs_credentials
 
 Ts = TypeVarTuple("Ts")
 T_co = TypeVar('T_co', covariant=True)
 T2_co = TypeVar('T2_co', covariant=True)
 
 
+def _connect(sqlite_filename: str, read_only: bool, immutable: bool, mmap_size: Optional[int], cache_size: Optional[int], check_same_thread: bool = True) -> sqlite3.Connection:
+    if read_only or immutable:
+        uri = "file:" + pathname2url(os.path.abspath(sqlite_filename)) + "?mode=ro"
+        if immutable:
+            uri += "&immutable=1"
+        con = sqlite3.connect(uri, uri=True, isolation_level=None,
+                              check_same_thread=check_same_thread)
+    else:
+        con = sqlite3.connect(sqlite_filename, isolation_level=None,
+                              check_same_thread=check_same_thread)
+    if mmap_size is not None:
+        con.execute(f"PRAGMA mmap_size = {int(mmap_size)}")
+    if cache_size is not None:
+        con.execute(f"PRAGMA cache_size = {int(cache_size)}")
+    return con
+
+
+def _decode_column(values: tuple, columnar: Optional[str]) -> Any:
+    # SQLite columns are dynamically typed, so every value is checked, not just the first one
+    types = set(map(type, values))
+    types.discard(type(None))
+    if types and types <= {int, float}:
+        if types == {int} and None not in values:
+            array = np.fromiter(values, dtype=np.int64, count=len(values))
+        else:
+            array = np.array(values, dtype=np.float64)
+        return torch.from_numpy(array) if columnar == 'torch' else array
+    if types == {bytes}:
+        return [memoryview(value) if value is not None else None for value in values]
+    return list(values)
+
+
+def _bucket_size(n: int, max_size: int) -> int:
+    return min(1 << (n - 1).bit_length(), max_size)
+
+
 class SQLiteDataset(Dataset[T_co], Generic[Unpack[Ts], T_co]):
-    def __init__(self, sqlite_filename: str, table_name: str, index_column: str, columns_to_return: str, id_column: str):
+    r"""
+    A map dataset backed by an SQLite table.
+
+    Integer keys are looked up from `index_column`, string keys from `id_column`. Batched lookups
+    return rows in the order of the requested keys (duplicates included) and raise `KeyError` if
+    a key is not found. Batches of up to `max_query_parameters` keys are served by an `IN (...)`
+    query padded to the next power of two, so that only a handful of distinct statements are ever
+    compiled (and then reused from the connection statement cache). Larger batches are joined
+    against a temporary key table instead. Runs of at least `min_range_scan` consecutive integer
+    keys (and `range` batches, as passed on by e.g. `LinearMapSubset`) are served by
+    `BETWEEN` range scans.
+
+    Connections are opened lazily on first use in each process (see
+    `hscitorchutil.processlocal.ProcessLocalResource`), so DataLoader workers never share the
+    connection of their parent and cost nothing to start up until they actually read.
+
+    Args:
+        sqlite_filename (str): The SQLite database file
+        table_name (str): The table to read
+        index_column (str): The column holding integer keys
+        columns_to_return (str): The columns to return, as an SQL column list
+        id_column (str): The column holding string keys
+        read_only (bool): Open the database in read-only mode
+        immutable (bool): Open the database as immutable, disabling all locking and change detection.
+            Only use this if the database file is not modified while the dataset is in use.
+        mmap_size (int, optional): Value for `PRAGMA mmap_size`, in bytes
+        cache_size (int, optional): Value for `PRAGMA cache_size` (pages if positive, KiB if negative)
+        max_query_parameters (int): The largest batch served by an `IN (...)` query
+        min_range_scan (int): The shortest run of consecutive integer keys served by a range scan
+        columnar (str, optional): If `"numpy"` or `"torch"`, `__getitems__` returns a dict mapping each
+            returned column name to the column values of the batch instead of a list of row tuples.
+            Integer and real columns are decoded in bulk into int64/float64 arrays or tensors (NULLs
+            in integer columns, and columns mixing integers and reals, are decoded into float64, with
+            NaNs for NULLs), BLOB columns into lists of memoryviews over the fetched buffers, and
+            other columns (including ones mixing other types) into plain lists.
+            See `hscitorchutil.dataset.collate_columns` for a matching collate function.
+        per_thread_connections (bool): Open a separate connection for each thread. Otherwise, threads
+            of a process share a single connection and take turns using it.
+    """
+
+    def __init__(self, sqlite_filename: str, table_name: str, index_column: str, columns_to_return: str, id_column: str,
+                 read_only: bool = True, immutable: bool = True, mmap_size: Optional[int] = None, cache_size: Optional[int] = None,
+                 max_query_parameters: int = 999, columnar: Optional[Literal['numpy', 'torch']] = None,
+                 per_thread_connections: bool = False, min_range_scan: int = 16):
         self.sqlite_filename = sqlite_filename
         self.table_name = table_name
         self.index_column = index_column
         self.id_column = id_column
         self.columns_to_return = columns_to_return
-        self.sqlite = sqlite3.connect(sqlite_filename)
+        self.read_only = read_only
+        self.immutable = immutable
+        self.mmap_size = mmap_size
+        self.cache_size = cache_size
+        self.max_query_parameters = max_query_parameters
+        self.columnar = columnar
+        self.per_thread_connections = per_thread_connections
+        self.min_range_scan = min_range_scan
+        self._queries: dict[tuple[str, int], str] = dict()
+        self._column_names: Optional[list[str]] = None
+        self._connections = self._connection_pool()
         self._len = None
 
+    def _connection_pool(self) -> ProcessLocalResource[sqlite3.Connection]:
+        return ProcessLocalResource(functools.partial(
+            _connect, self.sqlite_filename, self.read_only, self.immutable, self.mmap_size, self.cache_size,
+            self.per_thread_connections), per_thread=self.per_thread_connections)
+
+    @property
+    def sqlite(self) -> sqlite3.Connection:
+        """The SQLite connection of the current process (or thread)"""
+        return self._connections.get()
+
+    def close(self) -> None:
+        """Closes the connections opened by the current process"""
+        self._connections.close()
+
     def __len__(self):
         if self._len is None:
-            with closing(self.sqlite.execute(
+            with self._connections.lock, closing(self.sqlite.execute(
                     f"SELECT COUNT(*) FROM {self.table_name}")) as cur:
                 self._len = cur.fetchall()[0][0]
         return self._len
 
     def __getitem__(self, idx: int | str) -> T_co:
-        return self.__getitems__([idx])[0]
+        return self._fetch_rows([idx])[0]
 
     def __getitems__(self, idxs: Sequence[int | str]) -> Sequence[T_co]:
-        if isinstance(idxs[0], int):
-            return self.sqlite.execute(f"SELECT {self.columns_to_return} FROM {self.table_name} WHERE {self.index_column} IN (%s)" % ','.join(
-                '?' * len(idxs)), idxs).fetchall()
-        else:
-            return self.sqlite.execute(f"SELECT {self.columns_to_return} FROM {self.table_name} WHERE {self.id_column} IN (%s)" % ','.join(
-                '?' * len(idxs)), idxs).fetchall()
+        rows = self._fetch_rows(idxs)
+        if self.columnar is not None:
+            return self._to_columns(rows)  # type: ignore
+        return rows
+
+    def _fetch_rows(self, idxs: Sequence[int | str]) -> list[T_co]:
+        if len(idxs) == 0:
+            return []
+        with self._connections.lock:
+            if isinstance(idxs[0], int):
+                return self._fetch_runs(idxs)
+            else:
+                return self._fetch(self.id_column, idxs)
+
+    def _fetch_runs(self, idxs: Sequence[int]) -> list[T_co]:
+        runs = [(start, stop) for start, stop in contiguous_runs(
+            idxs) if stop - start >= self.min_range_scan]
+        if not runs:
+            return self._fetch(self.index_column, idxs)
+        if len(runs) == 1 and runs[0] == (0, len(idxs)):
+            return self._fetch_range(idxs[0], idxs[-1])
+        rows: list = [None] * len(idxs)
+        scattered = []
+        position = 0
+        for start, stop in runs:
+            scattered.extend(range(position, start))
+            rows[start:stop] = self._fetch_range(idxs[start], idxs[stop - 1])
+            position = stop
+        scattered.extend(range(position, len(idxs)))
+        if scattered:
+            for pos, row in zip(scattered, self._fetch(self.index_column, [idxs[pos] for pos in scattered])):
+                rows[pos] = row
+        return rows
+
+    def _fetch_range(self, first: int, last: int) -> list[T_co]:
+        rows = self.sqlite.execute(
+            f"SELECT {self.index_column}, {self.columns_to_return} FROM {self.table_name} WHERE {self.index_column} BETWEEN ? AND ? ORDER BY {self.index_column}",
+            (first, last)).fetchall()
+        if len(rows) != last - first + 1:
+            missing = next(key for key, row in zip(
+                range(first, last + 2), rows + [(None,)]) if row[0] != key)
+            raise KeyError(
+                f"{missing!r} not found in {self.table_name}.{self.index_column}")
+        return [row[1:] for row in rows]
+
+    @property
+    def column_names(self) -> list[str]:
+        """The names of the columns returned by the dataset"""
+        if self._column_names is None:
+            with self._connections.lock, closing(self.sqlite.execute(
+                    f"SELECT {self.columns_to_return} FROM {self.table_name} LIMIT 0")) as cur:
+                self._column_names = [d[0] for d in cur.description]
+        return self._column_names
+
+    def read_column(self, column: str, dtype: np.typing.DTypeLike = np.int32, fetch_size: int = 65536, fill_value: Optional[Any] = None) -> np.ndarray:
+        """Reads a numeric column (or SQL expression, e.g. `length(text)`) of the whole table into
+        an array of `dtype` indexed like the dataset, e.g. sample lengths for a `LengthBucketBatchSampler`.
+        NULLs are read as `fill_value` if given, as NaN for floating point dtypes, and raise a
+        `ValueError` otherwise."""
+        out = np.zeros(len(self), dtype=dtype)
+        null = fill_value if fill_value is not None else np.nan if out.dtype.kind in 'fc' else None
+        with self._connections.lock, closing(self.sqlite.execute(
+                f"SELECT {self.index_column}, {column} FROM {self.table_name}")) as cur:
+            while rows := cur.fetchmany(fetch_size):
+                keys = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+                values = [row[1] for row in rows]
+                if any(value is None for value in values):
+                    if null is None:
+                        raise ValueError(
+                            f"{column} is NULL in some rows of {self.table_name}, pass a fill_value or a floating point dtype")
+                    values = [null if value is None else value for value in values]
+                if keys.min() < 0 or keys.max() >= len(out):
+                    raise IndexError(
+                        f"{self.table_name}.{self.index_column} values are not in range({len(out)})")
+                out[keys] = np.asarray(values, dtype=out.dtype)
+        return out
+
+    def _to_columns(self, rows: list) -> dict[str, Any]:
+        if not rows:
+            return {name: [] for name in self.column_names}
+        return {name: _decode_column(values, self.columnar) for name, values in zip(self.column_names, zip(*rows))}
+
+    def _in_query(self, column: str, size: int) -> str:
+        query = self._queries.get((column, size))
+        if query is None:
+            query = f"SELECT {column}, {self.columns_to_return} FROM {self.table_name} WHERE {column} IN (%s)" % ','.join(
+                '?' * size)
+            self._queries[(column, size)] = query
+        return query
+
+    def _fetch(self, column: str, keys: Sequence[int | str]) -> list[T_co]:
+        if len(keys) > self.max_query_parameters:
+            return self._fetch_through_temp_table(column, keys)
+        size = _bucket_size(len(keys), self.max_query_parameters)
+        params = list(keys)
+        params.extend(params[-1:] * (size - len(params)))
+        rows = {row[0]: row[1:]
+                for row in self.sqlite.execute(self._in_query(column, size), params)}
+        try:
+            return [rows[key] for key in keys]
+        except KeyError as e:
+            raise KeyError(
+                f"{e.args[0]!r} not found in {self.table_name}.{column}") from None
+
+    def _fetch_through_temp_table(self, column: str, keys: Sequence[int | str]) -> list[T_co]:
+        key_table = "_hscitorchutil_keys"
+        con = self.sqlite
+        con.execute(
+            f"CREATE TEMP TABLE IF NOT EXISTS {key_table} (_pos INTEGER PRIMARY KEY, _key)")
+        con.execute("BEGIN")
+        try:
+            con.executemany(
+                f"INSERT INTO temp.{key_table} VALUES (?, ?)", enumerate(keys))
+            rows = con.execute(
+                f"SELECT k._pos, {self.columns_to_return} FROM temp.{key_table} AS k JOIN {self.table_name} ON {self.table_name}.{column} = k._key ORDER BY k._pos").fetchall()
+        finally:
+            con.execute(f"DELETE FROM temp.{key_table}")
+            con.execute("COMMIT")
+        if len(rows) != len(keys):
+            missing = next(pos for pos, row in enumerate(rows + [(len(keys),)]) if row[0] != pos)
+            raise KeyError(
+                f"{keys[missing]!r} not found in {self.table_name}.{column}")
+        return [row[1:] for row in rows]
 
     def __setstate__(self, state):
         (
@@ -51,9 +277,19 @@ class SQLiteDataset(Dataset[T_co], Generic[Unpack[Ts], T_co]):
             self.index_column,
             self.columns_to_return,
             self.id_column,
+            self.read_only,
+            self.immutable,
+            self.mmap_size,
+            self.cache_size,
+            self.max_query_parameters,
+            self.columnar,
+            self.per_thread_connections,
+            self.min_range_scan,
             self._len
         ) = state
-        self.sqlite = sqlite3.connect(self.sqlite_filename)
+        self._queries = dict()
+        self._column_names = None
+        self._connections = self._connection_pool()
 
     def __getstate__(self) -> object:
         return (
@@ -62,10 +298,96 @@ class SQLiteDataset(Dataset[T_co], Generic[Unpack[Ts], T_co]):
             self.index_column,
             self.columns_to_return,
             self.id_column,
+            self.read_only,
+            self.immutable,
+            self.mmap_size,
+            self.cache_size,
+            self.max_query_parameters,
+            self.columnar,
+            self.per_thread_connections,
+            self.min_range_scan,
             self._len
         )
 
 
+class IterableSQLiteDataset(IterableDataset[T_co], Generic[Unpack[Ts], T_co]):
+    r"""
+    An iterable dataset streaming the rows of an SQLite table in `index_column` order, for full
+    passes over a table.
+
+    The key range of `index_column` is split into contiguous parts, one for each DataLoader worker
+    and distributed process (see `hscitorchutil.dataset.current_shard`), and each part is read by
+    one range query, with rows pulled from its cursor `fetch_size` at a time. Parts are split by
+    key value, so large gaps in the keys make them uneven. The last key emitted is available
+    through `state_dict`, so that a `StatefulDataLoader` can resume iteration after it.
+
+    Args:
+        sqlite_filename (str): The SQLite database file
+        table_name (str): The table to read
+        index_column (str): An indexed integer column to order and split the rows by
+        columns_to_return (str): The columns to return, as an SQL column list
+        where (str, optional): An SQL condition the returned rows must satisfy
+        parameters (Sequence[Any]): Values for the parameters of `where`
+        fetch_size (int): The number of rows fetched at a time
+        read_only (bool): Open the database in read-only mode
+        immutable (bool): Open the database as immutable, disabling all locking and change detection.
+        mmap_size (int, optional): Value for `PRAGMA mmap_size`, in bytes
+        cache_size (int, optional): Value for `PRAGMA cache_size` (pages if positive, KiB if negative)
+        rank (int, optional): The rank of this process, if not taken from torch.distributed
+        world_size (int, optional): The number of processes, if not taken from torch.distributed
+    """
+
+    def __init__(self, sqlite_filename: str, table_name: str, index_column: str, columns_to_return: str,
+                 where: Optional[str] = None, parameters: Sequence[Any] = (), fetch_size: int = 4096,
+                 read_only: bool = True, immutable: bool = True, mmap_size: Optional[int] = None, cache_size: Optional[int] = None,
+                 rank: Optional[int] = None, world_size: Optional[int] = None):
+        self.sqlite_filename = sqlite_filename
+        self.table_name = table_name
+        self.index_column = index_column
+        self.columns_to_return = columns_to_return
+        self.where = where
+        self.parameters = parameters
+        self.fetch_size = fetch_size
+        self.read_only = read_only
+        self.immutable = immutable
+        self.mmap_size = mmap_size
+        self.cache_size = cache_size
+        self.rank = rank
+        self.world_size = world_size
+        self._last_key: Optional[int] = None
+        self._resume_key: Optional[int] = None
+
+    def __iter__(self):
+        shard, num_shards = current_shard(self.rank, self.world_size)
+        resume_key, self._resume_key = self._resume_key, None
+        self._last_key = resume_key
+        with closing(_connect(self.sqlite_filename, self.read_only, self.immutable, self.mmap_size, self.cache_size)) as con:
+            first, last = con.execute(
+                f"SELECT MIN({self.index_column}), MAX({self.index_column}) FROM {self.table_name}").fetchone()
+            if first is None:
+                return
+            keys = shard_range(last - first + 1, shard, num_shards)
+            if not keys:
+                return
+            start, stop = first + keys.start, first + keys.stop - 1
+            if resume_key is not None:
+                start = max(start, resume_key + 1)
+            where = f" AND ({self.where})" if self.where else ""
+            with closing(con.execute(
+                    f"SELECT {self.index_column}, {self.columns_to_return} FROM {self.table_name} WHERE {self.index_column} BETWEEN ? AND ?{where} ORDER BY {self.index_column}",
+                    (start, stop, *self.parameters))) as cur:
+                while rows := cur.fetchmany(self.fetch_size):
+                    for row in rows:
+                        self._last_key = row[0]
+                        yield row[1:]
+
+    def state_dict(self) -> dict[str, Any]:
+        return {"last_key": self._last_key}
+
+    def load_state_dict(self, state_dict: dict[str, Any]) -> None:
+        self._resume_key = state_dict["last_key"]
+
+
 class TypedDataLoader(Iterable[T_co], DataLoader[T_co], Generic[T_co]):
     pass
 
@@ -85,6 +407,8 @@ class SQLiteDataModule(ABaseDataModule[T_co, T2_co], Generic[Unpack[Ts], T_co, T
                      Dataset[tuple[Unpack[Ts]]]], Dataset[T_co]] = identity_transformation,
                  test_transform: Callable[[
                      Dataset[tuple[Unpack[Ts]]]], Dataset[T_co]] = identity_transformation,
+                 dataset_options: dict = dict(),
+                 staging_options: dict = dict(),
                  **kwargs):
         super().__init__(**kwargs)
         self.train_sqlite_url = train_sqlite_url
@@ -92,6 +416,8 @@ class SQLiteDataModule(ABaseDataModule[T_co, T2_co], Generic[Unpack[Ts], T_co, T
         self.test_sqlite_url = test_sqlite_url
         self.cache_dir = cache_dir
         self.storage_options = storage_options
+        self.dataset_options = dataset_options
+        self.staging_options = staging_options
 
         self.table_name = table_name
         self.index_column = index_column
@@ -101,53 +427,86 @@ class SQLiteDataModule(ABaseDataModule[T_co, T2_co], Generic[Unpack[Ts], T_co, T
         self.test_transform = test_transform
 
     def prepare_sqlite_databases(self):
-        """Ensure sqlite databases are downloaded"""
-        cache_locally_if_remote(
-            self.train_sqlite_url, storage_options=self.storage_options, cache_dir=self.cache_dir)
-        cache_locally_if_remote(
-            self.val_sqlite_url, storage_options=self.storage_options, cache_dir=self.cache_dir)
-        cache_locally_if_remote(
-            self.test_sqlite_url, storage_options=self.storage_options, cache_dir=self.cache_dir)
+        """Ensure sqlite databases are downloaded (concurrently, see `hscitorchutil.staging.stage_file`)"""
+        stage_files([self.train_sqlite_url, self.val_sqlite_url, self.test_sqlite_url],
+                    self.cache_dir, self.storage_options, **self.staging_options)
+
+    def _local_path(self, url: str) -> str:
+        # the databases were validated by prepare_sqlite_databases, setup only looks them up
+        options = {key: value for key, value in self.staging_options.items()
+                   if key not in ("max_files", "revalidate")}
+        return stage_file(url, self.cache_dir, self.storage_options, revalidate=False, **options)
 
     def setup(self, stage: Literal['fit', 'validate', 'test', 'predict']):
         """Fulfil the requirements for a given stage"""
         if (stage == "fit") and self.train_dataset is None:
-            self.train_dataset = self.train_transform(SQLiteDataset(cache_locally_if_remote(
-                self.train_sqlite_url, storage_options=self.storage_options, cache_dir=self.cache_dir),
+            self.train_dataset = self.train_transform(SQLiteDataset(self._local_path(self.train_sqlite_url),
                 self.table_name,
                 self.index_column,
                 self.columns_to_return,
-                self.id_column))
+                self.id_column,
+                **self.dataset_options))
         if (stage == "fit" or stage == "validate") and self.val_dataset is None:
-            self.val_dataset = self.test_transform(SQLiteDataset(cache_locally_if_remote(
-                self.val_sqlite_url, storage_options=self.storage_options, cache_dir=self.cache_dir),
+            self.val_dataset = self.test_transform(SQLiteDataset(self._local_path(self.val_sqlite_url),
                 self.table_name,
                 self.index_column,
                 self.columns_to_return,
-                self.id_column))
+                self.id_column,
+                **self.dataset_options))
         if (stage == "test") and self.test_dataset is None:
-            self.test_dataset = self.test_transform(SQLiteDataset(cache_locally_if_remote(
-                self.test_sqlite_url, storage_options=self.storage_options, cache_dir=self.cache_dir),
+            self.test_dataset = self.test_transform(SQLiteDataset(self._local_path(self.test_sqlite_url),
                 self.table_name,
                 self.index_column,
                 self.columns_to_return,
-                self.id_column))
+                self.id_column,
+                **self.dataset_options))
+
+
+def _index_zip(args: tuple) -> tuple[str, int, float]:
+    zip_url, sqlite_filename, storage_options, position = args
+    start = time.perf_counter()
+    entries = create_sqlite_directory(
+        zip_url, sqlite_filename, storage_options, position=position)
+    return sqlite_filename, entries, time.perf_counter() - start
 
 
 @click.command()
 @click.option("--key", required=False)
 @click.option("--secret", required=False, help="AWS secret access key or file from which to read credentials")
 @click.option("--endpoint-url", required=False)
-@click.argument("zip-url")
-@click.argument("sqlite-filename", required=True)
-def main(zip_url: str, sqlite_filename: Optional[str] = None, endpoint_url: Optional[str] = None, key: Optional[str] = None, secret: Optional[str] = None):
+@click.option("--output-dir", "-o", required=False, help="Directory for the created databases (default: current directory)")
+@click.option("--jobs", "-j", default=4, show_default=True, help="Number of zip files indexed in parallel")
+@click.argument("zip-urls", nargs=-1, required=True)
+def main(zip_urls: tuple[str, ...], output_dir: Optional[str] = None, jobs: int = 4, endpoint_url: Optional[str] = None, key: Optional[str] = None, secret: Optional[str] = None):
+    """Creates SQLite directories for the given zip files, named after each zip file with a
+    .offsets.sqlite3 suffix. For compatibility, `ZIP_URL SQLITE_FILENAME` (with SQLITE_FILENAME
+    ending in .sqlite, .sqlite3 or .db) writes the directory of a single zip file to SQLITE_FILENAME."""
     if secret is not None and os.path.exists(secret):
         credentials = get_s3fs_credentials(secret)
     else:
-        credentials = dict()
-    with fsspec.open(zip_url, **credentials) as zf:  # type: ignore
-        create_sqlite_directory_from_zip(
-            ZipFile(zf), sqlite_filename)  # type: ignore
+        credentials = {name: value for name, value in (
+            ("key", key), ("secret", secret), ("endpoint_url", endpoint_url)) if value is not None}
+    if len(zip_urls) == 2 and zip_urls[1].endswith((".sqlite", ".sqlite3", ".db")):
+        targets = [(zip_urls[0], zip_urls[1])]
+    else:
+        targets = [(zip_url, os.path.join(output_dir or ".", os.path.basename(zip_url.rstrip("/")) + ".offsets.sqlite3"))
+                   for zip_url in zip_urls]
+    start = time.perf_counter()
+    total = 0
+    tasks = [(zip_url, sqlite_filename, credentials, position)
+             for position, (zip_url, sqlite_filename) in enumerate(targets)]
+    if jobs > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            results = list(executor.map(_index_zip, tasks))
+    else:
+        results = [_index_zip(task) for task in tasks]
+    for sqlite_filename, entries, elapsed in results:
+        total += entries
+        click.echo(
+            f"{sqlite_filename}: {entries} entries in {elapsed:.1f}s ({entries / max(elapsed, 1e-9):.0f} entries/s)", err=True)
+    elapsed = time.perf_counter() - start
+    click.echo(
+        f"Indexed {total} entries from {len(targets)} zip files in {elapsed:.1f}s ({total / max(elapsed, 1e-9):.0f} entries/s)", err=True)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,193 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Iterable, Optional
+
+import fsspec
+from hscifsspecutil import PathCacheMapper
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None  # type: ignore[assignment]
+    import msvcrt
+
+
+def _fingerprint(info: dict[str, Any]) -> dict[str, Any]:
+    return {"size": info["size"], "etag": info.get("ETag", info.get("etag"))}
+
+
+def _read_json(path: str) -> Optional[dict[str, Any]]:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def _write_json(path: str, value: dict[str, Any]) -> None:
+    with open(path + ".tmp", "w") as f:
+        json.dump(value, f)
+    os.replace(path + ".tmp", path)
+
+
+@contextmanager
+def _file_lock(path: str):
+    with open(path, "a") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+            return
+        # msvcrt locks a byte range from the current position, retrying for only 10 seconds
+        f.seek(0)
+        while True:
+            try:
+                msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                break
+            except OSError:
+                pass
+        try:
+            yield
+        finally:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def _sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(1 << 24):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _is_valid(lpath: str, metadata: Optional[dict[str, Any]], fingerprint: Optional[dict[str, Any]], sha256: Optional[str]) -> bool:
+    if metadata is None or not os.path.exists(lpath) or os.path.getsize(lpath) != metadata["size"]:
+        return False
+    if sha256 is not None and metadata.get("sha256") != sha256:
+        return False
+    if fingerprint is not None:
+        if fingerprint["size"] != metadata["size"]:
+            return False
+        if fingerprint["etag"] is not None and metadata.get("etag") is not None and fingerprint["etag"] != metadata["etag"]:
+            return False
+    return True
+
+
+def _download(fs: fsspec.AbstractFileSystem, path: str, lpath: str, fingerprint: dict[str, Any], part_size: int, max_workers: int) -> None:
+    # parts are written in place into a preallocated .part file, and the parts done are recorded
+    # in a .part.json file, so that an interrupted download continues where it left off
+    ppath = lpath + ".part"
+    progress_path = ppath + ".json"
+    size = fingerprint["size"]
+    progress = _read_json(progress_path)
+    if progress is None or progress["fingerprint"] != fingerprint or progress["part_size"] != part_size or not os.path.exists(ppath):
+        progress = {"fingerprint": fingerprint, "part_size": part_size, "done": []}
+        with open(ppath, "wb") as f:
+            f.truncate(size)
+        _write_json(progress_path, progress)
+    done = set(progress["done"])
+    todo = [part for part in range((size + part_size - 1) // part_size) if part not in done]
+    if done:
+        logging.info(f"Resuming download of {path}, {len(todo)} parts left")
+    progress_lock = threading.Lock()
+    with open(ppath, "r+b") as f:
+        def fetch(part: int) -> None:
+            start = part * part_size
+            data = fs.cat_file(path, start=start, end=min(start + part_size, size))
+            with progress_lock:
+                # a part is only recorded as done once it has been handed to the OS
+                f.seek(start)
+                f.write(data)
+                f.flush()
+                done.add(part)
+                _write_json(progress_path, {**progress, "done": sorted(done)})
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(fetch, part) for part in todo]
+            try:
+                for future in futures:
+                    future.result()
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+        os.fsync(f.fileno())
+    os.replace(ppath, lpath)
+    os.remove(progress_path)
+
+
+def stage_file(urlpath: str, cache_dir: Optional[str], storage_options: Optional[dict[str, Any]] = None,
+               sha256: Optional[str] = None, revalidate: bool = True, part_size: int = 64 << 20, max_workers: int = 8) -> str:
+    r"""
+    Makes a local copy of a remote file, at the same path as `hscifsspecutil.cache_locally_if_remote`
+    and returns its path. Local files are returned as is.
+
+    The file is downloaded in parts of `part_size` bytes, `max_workers` at a time, and an
+    interrupted download is resumed. The size and ETag of the remote file (and its SHA-256 hash,
+    if `sha256` is given) are recorded in a `.meta.json` file next to the copy, and the copy is
+    only downloaded again if they no longer match. Processes sharing the cache directory take an
+    exclusive file lock while staging a file, so only one of them downloads it while the others wait.
+
+    Args:
+        urlpath (str): The URL of the file
+        cache_dir (str, optional): The directory holding local copies. Required for remote files.
+        storage_options (dict, optional): Options for the fsspec filesystem
+        sha256 (str, optional): The expected SHA-256 hash of the file, as a hex string
+        revalidate (bool): Whether to check the size and ETag of an existing copy against the remote file
+        part_size (int): The size of the parts downloaded concurrently
+        max_workers (int): The number of parts downloaded concurrently
+    """
+    fs, path = fsspec.core.url_to_fs(urlpath, **(storage_options or {}))
+    if getattr(fs, "local_file", False):
+        return urlpath
+    if cache_dir is None:
+        raise ValueError(
+            "If you want to use a non-local filesystem, you need to specify a cache_dir")
+    os.makedirs(cache_dir, exist_ok=True)
+    lpath = os.path.join(cache_dir, PathCacheMapper()(urlpath))
+    metadata_path = lpath + ".meta.json"
+    if not revalidate and _is_valid(lpath, _read_json(metadata_path), None, sha256):
+        return lpath
+    with _file_lock(lpath + ".lock"):
+        fingerprint = _fingerprint(fs.info(path))
+        metadata = _read_json(metadata_path)
+        if metadata is None and os.path.exists(lpath) and os.path.getsize(lpath) == fingerprint["size"]:
+            # adopt a copy made by cache_locally_if_remote
+            metadata = {**fingerprint, "etag": None}
+            if sha256 is not None:
+                metadata["sha256"] = _sha256(lpath)
+            _write_json(metadata_path, metadata)
+        if _is_valid(lpath, metadata, fingerprint, sha256):
+            return lpath
+        if os.path.exists(metadata_path):
+            os.remove(metadata_path)
+        logging.info(f"Downloading {urlpath} to {lpath}")
+        _download(fs, path, lpath, fingerprint, part_size, max_workers)
+        metadata = dict(fingerprint)
+        if sha256 is not None:
+            metadata["sha256"] = _sha256(lpath)
+            if metadata["sha256"] != sha256:
+                os.remove(lpath)
+                raise ValueError(
+                    f"SHA-256 of {urlpath} is {metadata['sha256']}, expected {sha256}")
+        _write_json(metadata_path, metadata)
+    return lpath
+
+
+def stage_files(urlpaths: Iterable[str], cache_dir: Optional[str], storage_options: Optional[dict[str, Any]] = None,
+                max_files: int = 4, **kwargs) -> list[str]:
+    """Stages several files concurrently (see `stage_file`), returning their local paths in order"""
+    urlpaths = list(urlpaths)
+    unique = list(dict.fromkeys(urlpaths))
+    with ThreadPoolExecutor(max_workers=max_files) as executor:
+        lpaths = dict(zip(unique, executor.map(
+            lambda urlpath: stage_file(urlpath, cache_dir, storage_options, **kwargs), unique)))
+    return [lpaths[urlpath] for urlpath in urlpaths]
@@ -0,0 +1,270 @@
+import bz2
+import functools
+import logging
+import mmap
+import struct
+import threading
+import zipfile
+import zlib
+from typing import Any, NamedTuple, Optional, Sequence
+
+import fsspec
+from fsspec.implementations.cached import WholeFileCacheFileSystem
+from fsspec.implementations.local import LocalFileSystem
+from torch.utils.data import Dataset
+
+from hscitorchutil.dataset import TransformPool
+from hscitorchutil.processlocal import ProcessLocalResource
+from hscitorchutil.sqlite import SQLiteDataset, _connect
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+_LOCAL_HEADER = struct.Struct("<4s5H3L2H")
+_ZSTD = 93
+_zstd_local = threading.local()
+
+
+def _inflate(data: memoryview, file_size: Optional[int]) -> bytes:
+    # with the uncompressed size known, the output is allocated once at its final size
+    return zlib.decompress(data, -15, file_size or zlib.DEF_BUF_SIZE)
+
+
+def _lzma(data: memoryview, file_size: Optional[int]) -> bytes:
+    return zipfile.LZMADecompressor().decompress(data)  # type: ignore[attr-defined]
+
+
+def _zstd(data: memoryview, file_size: Optional[int]) -> bytes:
+    if zstandard is None:
+        raise ValueError("Decompressing zstd members requires the zstandard package")
+    # decompression contexts are reusable, so keep one per thread
+    decompressor = getattr(_zstd_local, "decompressor", None)
+    if decompressor is None:
+        decompressor = _zstd_local.decompressor = zstandard.ZstdDecompressor()
+    return decompressor.decompress(data, max_output_size=file_size or 0)
+
+
+_DECOMPRESSORS = {
+    zipfile.ZIP_DEFLATED: _inflate,
+    zipfile.ZIP_BZIP2: lambda data, file_size: bz2.decompress(data),
+    zipfile.ZIP_LZMA: _lzma,
+    _ZSTD: _zstd,
+}
+
+
+def _filesystem(zip_url: str, storage_options: Optional[dict[str, Any]]) -> tuple[fsspec.AbstractFileSystem, str]:
+    return fsspec.core.url_to_fs(zip_url, **(storage_options or {}))
+
+
+class _Member(NamedTuple):
+    offset: int
+    method: int
+    data: memoryview
+    file_size: Optional[int]
+    crc: Optional[int]
+
+
+def _local_path(fs: fsspec.AbstractFileSystem, path: str) -> Optional[str]:
+    # the local file backing a path, if any: the file itself, or the copy of a whole-file cache
+    # (simplecache::, filecache::), fetched now. Block caches (blockcache::) are not whole files.
+    if isinstance(fs, LocalFileSystem):
+        return path
+    if isinstance(fs, WholeFileCacheFileSystem):
+        with fs.open(path, "rb") as f:
+            return getattr(f, "name", None)
+    return None
+
+
+def _map(path: str) -> mmap.mmap:
+    with open(path, "rb") as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _unmap(mapping: mmap.mmap) -> None:
+    try:
+        mapping.close()
+    except BufferError:
+        # members returned as memoryviews are still referenced, the map is released with them
+        pass
+
+
+def coalesce_ranges(starts: Sequence[int], ends: Sequence[int], max_gap: int, max_range: int) -> tuple[list[int], list[int], list[int]]:
+    """Merges byte ranges less than `max_gap` bytes apart into ranges of at most `max_range` bytes
+    (or one range, if longer). Returns the merged ranges and the merged range of each input range."""
+    order = sorted(range(len(starts)), key=starts.__getitem__)
+    merged_starts: list[int] = []
+    merged_ends: list[int] = []
+    assignment = [0] * len(starts)
+    for i in order:
+        start, end = starts[i], ends[i]
+        if merged_starts and start - merged_ends[-1] <= max_gap and max(end, merged_ends[-1]) - merged_starts[-1] <= max_range:
+            merged_ends[-1] = max(merged_ends[-1], end)
+        else:
+            merged_starts.append(start)
+            merged_ends.append(end)
+        assignment[i] = len(merged_starts) - 1
+    return merged_starts, merged_ends, assignment
+
+
+class EDZipMapDataset(Dataset[bytes | memoryview]):
+    r"""
+    A map dataset returning the (decompressed) contents of the members of a zip file, looked up
+    through an SQLite directory of the zip file (as created by `hscitorchutil.zipdirectory` or
+    `edzip.sqlite`).
+
+    Integer keys are member numbers, string keys member names. For a batch, the members are
+    sorted by offset, and members less than `max_gap` bytes apart are read together in coalesced
+    range requests of up to `max_range` bytes, issued concurrently through `fsspec`. The local
+    header of each member is parsed from the same read, assuming its name and extra field take at
+    most `header_slack` bytes more than the name in the directory (members with larger headers
+    are read again separately).
+
+    Local archives (including ones cached whole from remote storage through `simplecache::` or
+    `filecache::`, which are fetched on construction) are instead memory mapped once per process,
+    and compressed members are decompressed straight from the map. With `zero_copy`, stored
+    members of local archives are returned as read-only memoryviews into the map, without copying
+    them (wrap them with e.g. `numpy.frombuffer`). As memoryviews cannot be pickled and are not
+    understood by the default collate function, they should be decoded before leaving a
+    DataLoader worker, so `zero_copy` is off by default.
+
+    Stored, deflated, bzip2, LZMA and (with the `zstandard` package) zstd members are supported.
+    If `pool` is given, the members of a batch are decompressed in parallel on it (which must be
+    a thread pool, as the decompressors release the GIL), preserving order. When the directory
+    records the uncompressed size of the members (as the one of `hscitorchutil.zipdirectory`
+    does), inflated members are decompressed into a buffer of their final size. With
+    `verify_crc`, the CRC-32 of each member is checked against the directory (or the local header).
+    Members written with a data descriptor only record their CRC-32 in the central directory, so
+    they cannot be checked with directories lacking a `crc` column (as created by `edzip`), which
+    is logged as a warning.
+
+    Args:
+        zip_url (str): The URL of the zip file
+        sqlite_filename (str): The SQLite directory of the zip file
+        storage_options (dict, optional): Options for the fsspec filesystem
+        max_gap (int): The largest gap between members read in one request
+        max_range (int): The largest coalesced request
+        header_slack (int): Bytes read in addition to the expected local header of each member
+        zero_copy (bool): Return stored members of local archives as memoryviews instead of bytes
+        pool (TransformPool, optional): A thread pool to decompress batches on
+        verify_crc (bool): Check the CRC-32 of each member
+    """
+
+    def __init__(self, zip_url: str, sqlite_filename: str, storage_options: Optional[dict[str, Any]] = None,
+                 max_gap: int = 64 << 10, max_range: int = 16 << 20, header_slack: int = 256,
+                 zero_copy: bool = False, pool: Optional[TransformPool] = None, verify_crc: bool = False):
+        self.zip_url = zip_url
+        self.sqlite_filename = sqlite_filename
+        self.storage_options = storage_options
+        self.max_gap = max_gap
+        self.max_range = max_range
+        self.header_slack = header_slack
+        self.zero_copy = zero_copy
+        self.pool = pool
+        self.verify_crc = verify_crc
+        if pool is not None and pool.kind != 'thread':
+            raise ValueError("EDZipMapDataset can only decompress on a thread pool")
+        self._warned_unverifiable = False
+        # directories created by edzip do not record the uncompressed size and CRC-32 of members
+        con = _connect(sqlite_filename, True, False, None, None)
+        try:
+            columns = {row[1] for row in con.execute("PRAGMA table_info(offsets)")}
+        finally:
+            con.close()
+        self.directory: SQLiteDataset = SQLiteDataset(
+            sqlite_filename, "offsets", "file_number",
+            "header_offset, compressed_size, length(CAST(filename AS BLOB)), " +
+            ("file_size" if "file_size" in columns else "NULL") + ", " + ("crc" if "crc" in columns else "NULL"),
+            "filename")
+        self._filesystem = ProcessLocalResource(functools.partial(
+            _filesystem, zip_url, storage_options))
+        local_path = _local_path(*self._filesystem.get())
+        self._mapping: Optional[ProcessLocalResource[mmap.mmap]] = ProcessLocalResource(
+            functools.partial(_map, local_path), close=_unmap) if local_path is not None else None
+
+    def __len__(self) -> int:
+        return len(self.directory)
+
+    def __getitem__(self, idx: int | str) -> bytes | memoryview:
+        return self.__getitems__([idx])[0]
+
+    def _read_ranges(self, starts: list[int], ends: list[int]) -> list[bytes]:
+        fs, path = self._filesystem.get()
+        return fs.cat_ranges([path] * len(starts), starts, ends)
+
+    def _member(self, buffer: bytes | memoryview, entry: tuple[int, int, int, Optional[int], Optional[int]]) -> _Member:
+        # parses a member from a buffer starting at its local header (reading the member again if
+        # the header was longer than expected)
+        offset, compressed_size, _, file_size, crc = entry
+        (signature, _, flags, method, _, _, local_crc, _, _, name_length, extra_length) = _LOCAL_HEADER.unpack_from(buffer)
+        if signature != b"PK\x03\x04":
+            raise ValueError(f"Bad local header at offset {offset} of {self.zip_url}")
+        if flags & 0x1:
+            raise ValueError(f"Encrypted member at offset {offset} of {self.zip_url}")
+        data_start = _LOCAL_HEADER.size + name_length + extra_length
+        if data_start + compressed_size > len(buffer):
+            buffer = self._read_ranges([offset], [offset + data_start + compressed_size])[0]
+        if crc is None:
+            if not flags & 0x8:
+                crc = local_crc
+            elif self.verify_crc and not self._warned_unverifiable:
+                # with a data descriptor, the CRC-32 is only known from the central directory
+                logging.warning(
+                    f"Cannot verify the CRC-32 of members with data descriptors in {self.zip_url} without a crc column in {self.sqlite_filename}")
+                self._warned_unverifiable = True
+        return _Member(offset, method, memoryview(buffer)[data_start:data_start + compressed_size], file_size, crc)
+
+    def _decode(self, member: _Member, views: bool) -> bytes | memoryview:
+        if member.method == zipfile.ZIP_STORED:
+            data: bytes | memoryview = member.data if views else bytes(member.data)
+        else:
+            decompress = _DECOMPRESSORS.get(member.method)
+            if decompress is None:
+                raise ValueError(
+                    f"Unsupported compression method {member.method} at offset {member.offset} of {self.zip_url}")
+            data = decompress(member.data, member.file_size)
+        if self.verify_crc and member.crc is not None and zlib.crc32(data) != member.crc:
+            raise ValueError(f"Bad CRC-32 for member at offset {member.offset} of {self.zip_url}")
+        return data
+
+    def _decode_all(self, members: list[_Member], views: bool) -> list[bytes | memoryview]:
+        if self.pool is None or len(members) < 2:
+            return [self._decode(member, views) for member in members]
+        # balance the chunks by compressed size, keeping members in order
+        total = sum(len(member.data) for member in members)
+        target = total / self.pool.max_workers
+        chunks: list[list[_Member]] = [[]]
+        size = 0
+        for member in members:
+            if size >= target and chunks[-1]:
+                chunks.append([])
+                size = 0
+            chunks[-1].append(member)
+            size += len(member.data)
+        if len(chunks) == 1:
+            return [self._decode(member, views) for member in members]
+        decode = functools.partial(self._decode, views=views)
+        return [data for chunk in self.pool.map(lambda chunk: list(map(decode, chunk)), chunks) for data in chunk]
+
+    def __getitems__(self, idxs: Sequence[int | str]) -> list[bytes | memoryview]:
+        if len(idxs) == 0:
+            return []
+        entries = self.directory.__getitems__(idxs)
+        if self._mapping is not None:
+            view = memoryview(self._mapping.get())
+            return self._decode_all([self._member(view[entry[0]:], entry) for entry in entries], self.zero_copy)
+        starts = [entry[0] for entry in entries]
+        ends = [offset + _LOCAL_HEADER.size + name_length + self.header_slack + compressed_size
+                for offset, compressed_size, name_length, _, _ in entries]
+        range_starts, range_ends, assignment = coalesce_ranges(
+            starts, ends, self.max_gap, self.max_range)
+        ranges = [memoryview(data) for data in self._read_ranges(range_starts, range_ends)]
+        return self._decode_all([self._member(ranges[r][entry[0] - range_starts[r]:], entry)
+                                 for entry, r in zip(entries, assignment)], False)
+
+    def close(self) -> None:
+        """Closes the directory connections and the memory map of the current process"""
+        self.directory.close()
+        if self._mapping is not None:
+            self._mapping.close()
@@ -0,0 +1,166 @@
+import os
+import sqlite3
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Iterator, NamedTuple, Optional
+
+import fsspec
+from tqdm import tqdm
+
+_EOCD = struct.Struct("<4s4H2LH")
+_ZIP64_LOCATOR = struct.Struct("<4sLQL")
+_ZIP64_EOCD = struct.Struct("<4sQ2H2L4Q")
+_CENTRAL_HEADER = struct.Struct("<4s6H3L5H2L")
+_MAX_COMMENT = 0xFFFF
+
+
+class ZipEntry(NamedTuple):
+    filename: str
+    header_offset: int
+    compressed_size: int
+    compress_type: int
+    file_size: int
+    crc: int
+
+
+class CentralDirectory(NamedTuple):
+    entries: int
+    offset: int
+    size: int
+    concat: int
+
+
+def _fetch(fs: fsspec.AbstractFileSystem, path: str, start: int, end: int) -> bytes:
+    return fs.cat_file(path, start=start, end=end)
+
+
+def locate_central_directory(fs: fsspec.AbstractFileSystem, path: str, size: Optional[int] = None) -> CentralDirectory:
+    """Finds the central directory of a zip file from its end of central directory record(s),
+    reading the end of the file in one request"""
+    if size is None:
+        size = fs.size(path)
+    tail_start = max(0, size - (_EOCD.size + _MAX_COMMENT + _ZIP64_LOCATOR.size))
+    tail = _fetch(fs, path, tail_start, size)
+    position = tail.rfind(b"PK\x05\x06")
+    while position >= 0 and position + _EOCD.size + _EOCD.unpack_from(tail, position)[-1] != len(tail):
+        position = tail.rfind(b"PK\x05\x06", 0, position)
+    if position < 0:
+        raise ValueError(f"{path} is not a zip file")
+    (_, _, _, _, entries, cd_size, cd_offset, _) = _EOCD.unpack_from(tail, position)
+    eocd_start = tail_start + position
+    locator = position - _ZIP64_LOCATOR.size
+    if locator >= 0 and tail[locator:locator + 4] == b"PK\x06\x07":
+        # the offset in the locator does not account for prepended data, so the record is read
+        # from right before the locator instead (as in zipfile)
+        eocd_start -= _ZIP64_LOCATOR.size + _ZIP64_EOCD.size
+        record = _fetch(fs, path, eocd_start, eocd_start + _ZIP64_EOCD.size)
+        if record[:4] != b"PK\x06\x06":
+            raise ValueError(f"{path} has a corrupt zip64 end of central directory record")
+        (_, _, _, _, _, _, _, entries, cd_size, cd_offset) = _ZIP64_EOCD.unpack(record)
+    # data prepended to the archive shifts all offsets (as in zipfile)
+    concat = eocd_start - cd_size - cd_offset
+    return CentralDirectory(entries, cd_offset + concat, cd_size, concat)
+
+
+def _parse_zip64_extra(extra: bytes, file_size: int, compressed_size: int, header_offset: int) -> tuple[int, int, int]:
+    position = 0
+    while position + 4 <= len(extra):
+        tag, length = struct.unpack_from("<2H", extra, position)
+        if tag == 1:
+            values = iter(struct.unpack_from(f"<{length // 8}Q", extra, position + 4))
+            if file_size == 0xFFFFFFFF:
+                file_size = next(values)
+            if compressed_size == 0xFFFFFFFF:
+                compressed_size = next(values)
+            if header_offset == 0xFFFFFFFF:
+                header_offset = next(values)
+            break
+        position += 4 + length
+    return file_size, compressed_size, header_offset
+
+
+def read_central_directory(fs: fsspec.AbstractFileSystem, path: str, directory: Optional[CentralDirectory] = None, chunk_size: int = 64 << 20) -> Iterator[ZipEntry]:
+    """Parses the central directory of a zip file, fetched in large ranged reads of `chunk_size`
+    bytes (the next one being fetched while the previous one is parsed)"""
+    if directory is None:
+        directory = locate_central_directory(fs, path)
+    end = directory.offset + directory.size
+    header_size = _CENTRAL_HEADER.size
+    unpack = _CENTRAL_HEADER.unpack_from
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        next_start = min(directory.offset + chunk_size, end)
+        pending = executor.submit(_fetch, fs, path, directory.offset, next_start)
+        buffer = b""
+        position = 0
+        while True:
+            data = pending.result()
+            buffer = buffer[position:] + data
+            position = 0
+            if next_start < end:
+                pending = executor.submit(_fetch, fs, path, next_start, min(next_start + chunk_size, end))
+                next_start = min(next_start + chunk_size, end)
+                last = False
+            else:
+                last = True
+            while position + header_size <= len(buffer):
+                (signature, _, _, flags, compress_type, _, _, crc, compressed_size, file_size,
+                 name_length, extra_length, comment_length, _, _, _, header_offset) = unpack(buffer, position)
+                record_end = position + header_size + name_length + extra_length + comment_length
+                if record_end > len(buffer):
+                    break
+                if signature != b"PK\x01\x02":
+                    raise ValueError(f"{path} has a corrupt central directory")
+                name = buffer[position + header_size:position + header_size + name_length]
+                if 0xFFFFFFFF in (compressed_size, file_size, header_offset):
+                    extra_start = position + header_size + name_length
+                    file_size, compressed_size, header_offset = _parse_zip64_extra(
+                        buffer[extra_start:extra_start + extra_length], file_size, compressed_size, header_offset)
+                yield ZipEntry(name.decode("utf-8" if flags & 0x800 else "cp437"), header_offset + directory.concat,
+                               compressed_size, compress_type, file_size, crc)
+                position = record_end
+            if last:
+                break
+
+
+def create_sqlite_directory(zip_url: str, sqlite_filename: str, storage_options: Optional[dict[str, Any]] = None,
+                            chunk_size: int = 64 << 20, progress: bool = True, position: Optional[int] = None) -> int:
+    r"""
+    Creates an SQLite directory of a (local or remote) zip file, compatible with the one created by
+    `edzip.sqlite.create_sqlite_directory_from_zip`, and additionally storing the compression
+    method, uncompressed size and CRC-32 of each member. The central directory is fetched in a few
+    large reads and inserted in bulk in a single transaction, with journaling and syncing turned off
+    (an interrupted build leaves a corrupt database, which is rebuilt from scratch on the next run).
+
+    Args:
+        zip_url (str): The URL of the zip file
+        sqlite_filename (str): The database to create. Will be removed and recreated if it already exists.
+        storage_options (dict, optional): Options for the fsspec filesystem
+        chunk_size (int): The size of the reads of the central directory
+        progress (bool): Whether to show a progress bar
+        position (int, optional): The line of the progress bar, when showing several
+
+    Returns:
+        int: The number of entries in the zip file
+    """
+    fs, path = fsspec.core.url_to_fs(zip_url, **(storage_options or {}))
+    directory = locate_central_directory(fs, path)
+    if os.path.exists(sqlite_filename):
+        os.remove(sqlite_filename)
+    con = sqlite3.connect(sqlite_filename, isolation_level=None)
+    try:
+        con.execute("PRAGMA journal_mode = OFF")
+        con.execute("PRAGMA synchronous = OFF")
+        con.execute("PRAGMA cache_size = -262144")
+        con.execute("BEGIN")
+        con.execute("CREATE TABLE offsets (file_number INTEGER PRIMARY KEY, filename TEXT, header_offset INTEGER, compressed_size INTEGER, compress_type INTEGER, file_size INTEGER, crc INTEGER)")
+        entries = read_central_directory(fs, path, directory, chunk_size)
+        with tqdm(entries, total=directory.entries, unit='entr', dynamic_ncols=True, disable=not progress,
+                  desc=os.path.basename(path), position=position) as bar:
+            con.executemany("INSERT INTO offsets VALUES (?,?,?,?,?,?,?)",
+                            ((i, *entry) for i, entry in enumerate(bar)))
+        con.execute("CREATE INDEX idx_offsets_filename ON offsets (filename)")
+        con.execute("COMMIT")
+        return con.execute("SELECT COUNT(*) FROM offsets").fetchone()[0]
+    finally:
+        con.close()
+
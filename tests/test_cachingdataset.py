@@ -0,0 +1,92 @@
+import unittest
+
+import torch
+from torch.utils.data import DataLoader, TensorDataset
+from hscitorchutil.cache import ARCCache, LRUCache, SharedMemoryCache
+from hscitorchutil.dataset import CachingMapDataset, EntryTransformingMapDataset, identity_transformation
+
+
+class _CountingDataset(EntryTransformingMapDataset):
+    def __init__(self, dataset):
+        super().__init__(dataset, identity_transformation)
+        self.requested = []
+
+    def __getitems__(self, indices):
+        self.requested.append(list(indices))
+        return super().__getitems__(indices)
+
+
+class TestCachingMapDataset(unittest.TestCase):
+    def setUp(self):
+        self.dataset = TensorDataset(torch.arange(10))
+
+    def test_cachingdataset(self):
+        for policy in ('lru', 'arc'):
+            inner = _CountingDataset(self.dataset)
+            ds = CachingMapDataset(inner, max_bytes=1 << 20, policy=policy)
+            self.assertEqual(len(ds), 10)
+            self.assertEqual(ds.__getitems__([1, 2, 3]), [(1,), (2,), (3,)])
+            self.assertEqual(ds.__getitems__([3, 4, 1]), [(3,), (4,), (1,)])
+            self.assertEqual(inner.requested, [[1, 2, 3], [4]])
+            self.assertEqual(ds[4], (4,))
+            self.assertEqual((ds.hits, ds.misses), (3, 4))
+
+    def test_shared_cachingdataset_with_spawned_workers(self):
+        ds = CachingMapDataset(_CountingDataset(self.dataset), max_bytes=1 << 20, shared=True)
+        self.assertEqual(ds.__getitems__([1, 2]), [(1,), (2,)])
+        dl = DataLoader(ds, batch_size=5, num_workers=1, multiprocessing_context="spawn")
+        self.assertEqual(torch.cat([batch[0] for batch in dl]).tolist(), list(range(10)))
+        self.assertEqual(ds.__getitems__(list(range(10))), [(i,) for i in range(10)])
+        self.assertEqual(ds.dataset.requested, [[1, 2]])
+        ds.cache.close()
+
+    def test_shared_cachingdataset_with_workers(self):
+        ds = CachingMapDataset(_CountingDataset(self.dataset), max_bytes=1 << 20, shared=True)
+        dl = DataLoader(ds, batch_size=2, num_workers=2)
+        self.assertEqual(torch.cat([batch[0] for batch in dl]).tolist(), list(range(10)))
+        self.assertEqual(ds.__getitems__(list(range(10))), [(i,) for i in range(10)])
+        self.assertEqual(ds.dataset.requested, [])
+        ds.cache.close()
+
+
+class TestCaches(unittest.TestCase):
+    def test_lru(self):
+        cache = LRUCache(30, sizeof=lambda x: 10)
+        for i in range(3):
+            cache.put(i, i)
+        self.assertEqual(cache.get(0), 0)
+        cache.put(3, 3)
+        self.assertIsNone(cache.get(1))
+        self.assertEqual([cache.get(i) for i in (0, 2, 3)], [0, 2, 3])
+        self.assertEqual(cache.bytes, 30)
+
+    def test_arc_resists_scans(self):
+        cache = ARCCache(40, sizeof=lambda x: 10)
+        for i in range(2):
+            cache.put(i, i)
+            cache.get(i)
+        for i in range(100, 120):
+            cache.put(i, i)
+        self.assertEqual([cache.get(0), cache.get(1)], [0, 1])
+        self.assertLessEqual(cache.bytes, 40)
+
+    def test_shared_memory_eviction(self):
+        cache = SharedMemoryCache(4096, max_entries=64)
+        for i in range(200):
+            cache.put(i, bytes(100))
+        self.assertIsNone(cache.get(0))
+        self.assertEqual(cache.get(199), bytes(100))
+        cache.put("foo", "bar")
+        self.assertEqual(cache.get("foo"), "bar")
+        cache.close()
+
+    def test_shared_memory_pickling(self):
+        import pickle
+        cache = SharedMemoryCache(4096, max_entries=64)
+        cache.put("foo", "bar")
+        copied = pickle.loads(pickle.dumps(cache))
+        self.assertEqual(copied.get("foo"), "bar")
+        copied.put("baz", 1)
+        self.assertEqual(cache.get("baz"), 1)
+        copied.close()
+        cache.close()
@@ -1,7 +1,8 @@
 import unittest
 
 import torch
-from torch.utils.data import TensorDataset
+from torch.utils.data import DataLoader, TensorDataset
+from torchdata.stateful_dataloader import StatefulDataLoader
 from hscitorchutil.dataset import DatasetToIterableDataset
 
 class TestDatasetToIterableDataset(unittest.TestCase):
@@ -15,3 +16,62 @@ class TestDatasetToIterableDataset(unittest.TestCase):
             self.assertEqual(item, (i,))
             i += 1
         self.assertEqual(i, 10)
+
+
+class _BatchRecordingDataset(torch.utils.data.Dataset):
+    def __init__(self, n):
+        self.n = n
+        self.batches = []
+
+    def __getitem__(self, idx):
+        return idx
+
+    def __getitems__(self, indices):
+        self.batches.append(list(indices))
+        return list(indices)
+
+    def __len__(self):
+        return self.n
+
+
+class TestShardedIteration(unittest.TestCase):
+    def test_chunks(self):
+        inner = _BatchRecordingDataset(10)
+        self.assertEqual(list(DatasetToIterableDataset(inner, chunk_size=4)), list(range(10)))
+        self.assertEqual(inner.batches, [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]])
+
+    def test_ranks(self):
+        for sharding in ("contiguous", "strided"):
+            shards = [list(DatasetToIterableDataset(_BatchRecordingDataset(10), sharding=sharding, rank=rank, world_size=3))
+                      for rank in range(3)]
+            self.assertEqual(sorted(sum(shards, [])), list(range(10)))
+            self.assertEqual([len(shard) for shard in shards], [3, 3, 4] if sharding == "contiguous" else [4, 3, 3])
+        self.assertEqual(shards[1], [1, 4, 7])
+
+    def test_workers(self):
+        for sharding in ("contiguous", "strided"):
+            ds = DatasetToIterableDataset(_BatchRecordingDataset(20), sharding=sharding, chunk_size=3)
+            dl = DataLoader(ds, batch_size=2, num_workers=2)
+            self.assertEqual(sorted(torch.cat(list(dl)).tolist()), list(range(20)))
+
+    def test_resume(self):
+        ds = DatasetToIterableDataset(_BatchRecordingDataset(10), chunk_size=4)
+        it = iter(ds)
+        self.assertEqual([next(it) for _ in range(5)], [0, 1, 2, 3, 4])
+        state = ds.state_dict()
+        resumed = DatasetToIterableDataset(_BatchRecordingDataset(10), chunk_size=4)
+        resumed.load_state_dict(state)
+        self.assertEqual(list(resumed), [5, 6, 7, 8, 9])
+        self.assertEqual(resumed.dataset.batches, [[5, 6, 7, 8], [9]])
+        self.assertEqual(list(resumed), list(range(10)))
+
+    def test_stateful_dataloader(self):
+        ds = DatasetToIterableDataset(_BatchRecordingDataset(20), chunk_size=3)
+        dl = StatefulDataLoader(ds, batch_size=2, num_workers=2)
+        it = iter(dl)
+        seen = [next(it).tolist() for _ in range(3)]
+        state = dl.state_dict()
+        dl2 = StatefulDataLoader(DatasetToIterableDataset(_BatchRecordingDataset(20), chunk_size=3), batch_size=2, num_workers=2)
+        dl2.load_state_dict(state)
+        rest = [batch.tolist() for batch in dl2]
+        self.assertEqual(sorted(sum(seen + rest, [])), list(range(20)))
@@ -41,3 +41,85 @@ class TestExceptionHandlingMapDataset(unittest.TestCase):
         self.assertEqual(ds2[1], (1,))
         self.assertEqual(ds2[2], None)
         self.assertEqual(ds2.__getitems__([0, 2]), [(0,), None])
+
+
+class _FailingDataset(torch.utils.data.Dataset):
+    def __init__(self, n, bad):
+        self.n = n
+        self.bad = bad
+        self.calls = 0
+
+    def __getitem__(self, idx):
+        self.calls += 1
+        if idx in self.bad:
+            raise ValueError(idx)
+        return idx
+
+    def __getitems__(self, indices):
+        self.calls += 1
+        if any(idx in self.bad for idx in indices):
+            raise ValueError(indices)
+        return list(indices)
+
+    def __len__(self):
+        return self.n
+
+
+class TestBisectionAndQuarantine(unittest.TestCase):
+    def test_bisection(self):
+        inner = _FailingDataset(64, {5, 40})
+        ds = ExceptionHandlingMapDataset(inner, on_exception=lambda ds, idx, e: None, quarantine=True)
+        expected = [None if i in (5, 40) else i for i in range(64)]
+        self.assertEqual(ds.__getitems__(list(range(64))), expected)
+        self.assertLess(inner.calls, 30)
+        self.assertEqual((ds.fallbacks, ds.failures), (1, 2))
+        self.assertEqual(ds.quarantined, {5, 40})
+        # quarantined indices are not requested again
+        inner.calls = 0
+        self.assertEqual(ds.__getitems__(list(range(64))), expected)
+        self.assertEqual(inner.calls, 1)
+        self.assertEqual(ds[5], None)
+        self.assertEqual(inner.calls, 1)
+        self.assertEqual(ds.skipped, 3)
+
+    def test_no_quarantine(self):
+        inner = _FailingDataset(8, {3})
+        ds = ExceptionHandlingMapDataset(inner, on_exception=lambda ds, idx, e: -1)
+        self.assertEqual(ds.__getitems__(list(range(8))), [0, 1, 2, -1, 4, 5, 6, 7])
+        self.assertEqual(ds.__getitems__([2, 3]), [2, -1])
+        self.assertEqual(ds.quarantined, set())
+
+    def test_quarantine_file(self):
+        import tempfile
+        import os
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "quarantine.jsonl")
+            ds = ExceptionHandlingMapDataset(_FailingDataset(8, {3, 6}), quarantine_file=path)
+            other = pickle.loads(pickle.dumps(ds))
+            self.assertEqual(ds.__getitems__([0, 1, 2, 3]), [0, 1, 2, None])
+            # another process (here another copy) picks up the quarantine from the file
+            other.dataset.bad = set()
+            self.assertEqual(other.__getitems__([2, 3, 6]), [2, None, 6])
+            self.assertEqual(other.quarantined, {3})
+            self.assertEqual(ds[6], None)
+            rerun = ExceptionHandlingMapDataset(_FailingDataset(8, set()), quarantine_file=path)
+            self.assertEqual(rerun.__getitems__(list(range(8))), [0, 1, 2, None, 4, 5, None, 7])
+
+    def test_quarantine_keys(self):
+        import tempfile
+        import os
+        from hscitorchutil.dataset import LinearMapSubset, ShuffledMapDataset
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "quarantine.jsonl")
+            ds = ExceptionHandlingMapDataset(LinearMapSubset(ShuffledMapDataset(
+                _FailingDataset(16, {3, 12}), seed=0), 0, 8), quarantine_file=path)
+            results = ds.__getitems__(list(range(8)))
+            # the keys of the failing samples are quarantined, not their shuffled positions
+            failed = {ds.dataset.dataset._map_indices([i])[0] for i, result in enumerate(results) if result is None}
+            self.assertEqual(ds.quarantined, failed)
+            self.assertEqual(failed, {3})
+            reshuffled = ExceptionHandlingMapDataset(ShuffledMapDataset(
+                _FailingDataset(16, set()), seed=1), quarantine_file=path)
+            results = reshuffled.__getitems__(list(range(16)))
+            self.assertEqual({key for key, result in zip(reshuffled.dataset._map_indices(range(16)), results)
+                              if result is None}, failed)
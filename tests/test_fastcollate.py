@@ -0,0 +1,78 @@
+from collections import namedtuple
+import unittest
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+from torch.utils.data.dataloader import default_collate
+from hscitorchutil.dataset import FastCollate
+
+Point = namedtuple("Point", ["x", "y"])
+
+
+def _assert_same(test, a, b):
+    if isinstance(a, torch.Tensor):
+        test.assertEqual(a.dtype, b.dtype)
+        test.assertTrue(torch.equal(a, b))
+    elif isinstance(a, dict):
+        test.assertEqual(a.keys(), b.keys())
+        for k in a:
+            _assert_same(test, a[k], b[k])
+    elif isinstance(a, (list, tuple)):
+        test.assertEqual(type(a), type(b))
+        test.assertEqual(len(a), len(b))
+        for x, y in zip(a, b):
+            _assert_same(test, x, y)
+    else:
+        test.assertEqual(a, b)
+
+
+class TestFastCollate(unittest.TestCase):
+    def test_matches_default_collate(self):
+        batches = [
+            [(i, float(i), f"s{i}", torch.full((2, 3), i), np.arange(3) + i, np.float32(i), i % 2 == 0) for i in range(5)],
+            [{"a": i, "b": torch.tensor([i, i])} for i in range(4)],
+            [Point(i, torch.tensor(i)) for i in range(3)],
+            [torch.tensor([i, 2 * i]) for i in range(3)],
+            [((i, 2 * i), {"c": [i, i + 1]}, "t") for i in range(3)],
+        ]
+        for batch in batches:
+            _assert_same(self, FastCollate()(batch), default_collate(batch))
+
+    def test_drops_nones_and_malformed(self):
+        collate = FastCollate()
+        batch = [(1, torch.zeros(2)), None, (2, torch.zeros(2)), (3, torch.zeros(3)), ("x", torch.zeros(2)), (4,), (5, torch.ones(2))]
+        ids, tensors = collate(batch)
+        self.assertEqual(ids.tolist(), [1, 2, 5])
+        self.assertEqual(tensors.shape, (3, 2))
+        self.assertEqual(collate.dropped, 3)
+        # the schema is kept for later batches
+        self.assertEqual(collate([None, (7, torch.zeros(2)), (8, torch.zeros(4))])[0].tolist(), [7])
+        self.assertEqual(collate([None, None]), ())
+
+    def test_dataloader_workers(self):
+        dl = DataLoader([(i, torch.tensor([i, i])) for i in range(10)], batch_size=4, num_workers=2, collate_fn=FastCollate())
+        batches = list(dl)
+        self.assertEqual([b[0].tolist() for b in batches], [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]])
+        self.assertEqual(torch.cat([b[1] for b in batches])[:, 1].tolist(), list(range(10)))
+
+    def test_scalar_promotion(self):
+        collate = FastCollate()
+        self.assertEqual(collate([(1, "t"), (2, "t")])[0].dtype, torch.int64)
+        # later batches of a dynamically typed column may hold reals
+        values, _ = collate([(1.5, "t"), (2.5, "t")])
+        _assert_same(self, values, torch.tensor([1.5, 2.5], dtype=torch.float64))
+        values, names = collate([(0, "a"), (0.5, "b"), (True, "c")])
+        _assert_same(self, values, torch.tensor([0.0, 0.5, 1.0], dtype=torch.float64))
+        self.assertEqual(list(names), ["a", "b", "c"])
+        self.assertEqual(collate.dropped, 0)
+        # the promotion only applies to the batch it was needed for
+        self.assertEqual(collate([(3, "t")])[0].dtype, torch.int64)
+        self.assertEqual(collate([(3, "t"), ("x", "t")])[0].tolist(), [3])
+        self.assertEqual(collate.dropped, 1)
+
+    def test_nested(self):
+        batch = [((1, 2), {"a": (i, float(i))}) for i in range(3)]
+        collated = FastCollate()(batch)
+        _assert_same(self, collated, default_collate(batch))
+        self.assertEqual([t.tolist() for t in collated[0]], [[1, 1, 1], [2, 2, 2]])
@@ -0,0 +1,91 @@
+import functools
+import pickle
+import unittest
+
+import torch
+from torch.utils.data import TensorDataset
+from hscitorchutil.dataset import (EntryTransformingMapDataset, ExceptionHandlingMapDataset, FusedIndexMapDataset, IdBasedMapSubset,
+                                   KeyTransformingMapDataset, LinearMapSubset, ShuffledMapDataset, UnionMapDataset, fuse_index_maps,
+                                   identity_transformation)
+
+
+def _add(l, y):
+    return [x + y for x in l]
+
+
+def _first(l):
+    return [x[0].item() for x in l]
+
+
+class TestFuseIndexMaps(unittest.TestCase):
+    def setUp(self):
+        base = EntryTransformingMapDataset(TensorDataset(torch.arange(200)), _first)
+        self.pipeline = LinearMapSubset(ShuffledMapDataset(IdBasedMapSubset(KeyTransformingMapDataset(
+            base, functools.partial(_add, y=10)), list(range(0, 180, 2))), seed=0), start=5, end=60)
+
+    def test_fuse(self):
+        for max_materialized in (0, 1000):
+            fused = fuse_index_maps(self.pipeline, max_materialized=max_materialized)
+            self.assertIsInstance(fused, FusedIndexMapDataset)
+            # the key transform stops fusion
+            self.assertIsInstance(fused.dataset, KeyTransformingMapDataset)
+            self.assertIsInstance(fused.dataset.dataset, EntryTransformingMapDataset)
+            self.assertEqual(fused.index_map is not None, max_materialized > 0)
+            self.assertEqual(len(fused), len(self.pipeline))
+            idxs = [3, 0, 54, 17, 3]
+            self.assertEqual(fused.__getitems__(idxs), self.pipeline.__getitems__(idxs))
+            self.assertEqual([fused[i] for i in range(len(fused))], [self.pipeline[i] for i in range(len(fused))])
+            fused2 = pickle.loads(pickle.dumps(fused))
+            self.assertEqual(fused2.__getitems__(idxs), self.pipeline.__getitems__(idxs))
+
+    def test_fuse_keeps_entry_wrappers_and_unions(self):
+        pipeline = LinearMapSubset(ExceptionHandlingMapDataset(UnionMapDataset([self.pipeline, LinearMapSubset(
+            EntryTransformingMapDataset(TensorDataset(torch.arange(10)), identity_transformation), start=2)])), start=1)
+        fused = fuse_index_maps(pipeline)
+        self.assertIsInstance(fused.dataset, ExceptionHandlingMapDataset)
+        self.assertIsInstance(fused.dataset.dataset, UnionMapDataset)
+        self.assertIsInstance(fused.dataset.dataset.datasets[0], FusedIndexMapDataset)
+        idxs = list(range(len(pipeline)))
+        self.assertEqual(fused.__getitems__(idxs), pipeline.__getitems__(idxs))
+
+    def test_set_epoch(self):
+        fused = fuse_index_maps(self.pipeline)
+        idxs = list(range(len(fused)))
+        before = fused.__getitems__(idxs)
+        fused.set_epoch(1)
+        after = fused.__getitems__(idxs)
+        self.assertNotEqual(before, after)
+        # the original pipeline is not reshuffled
+        self.assertEqual(self.pipeline.__getitems__(idxs), before)
+        self.pipeline.dataset.set_epoch(1)
+        self.assertEqual(self.pipeline.__getitems__(idxs), after)
+
+    def test_set_epoch_persistent_workers(self):
+        from torchdata.stateful_dataloader import StatefulDataLoader
+        fused = fuse_index_maps(self.pipeline)
+        dl = StatefulDataLoader(fused, batch_size=8, num_workers=2, persistent_workers=True)
+        for epoch in range(3):
+            fused.set_epoch(epoch)
+            # the workers follow the epoch set in the main process
+            self.assertEqual([x for batch in dl for x in batch.tolist()], fused.__getitems__(list(range(len(fused)))))
+
+    def test_key_transforms_are_not_fused(self):
+        base = TensorDataset(torch.arange(10))
+        one_based = LinearMapSubset(KeyTransformingMapDataset(base, functools.partial(_add, y=-1)), start=1, end=11)
+        fused = fuse_index_maps(one_based)
+        self.assertIsInstance(fused, FusedIndexMapDataset)
+        self.assertIsInstance(fused.dataset, KeyTransformingMapDataset)
+        self.assertEqual(fused.__getitems__(list(range(10))), one_based.__getitems__(list(range(10))))
+        names = {"a": 3, "b": 7}
+        by_name = KeyTransformingMapDataset(ShuffledMapDataset(base, seed=0), lambda keys: [names[key] for key in keys])
+        fused = fuse_index_maps(by_name)
+        self.assertIsInstance(fused.dataset, FusedIndexMapDataset)
+        self.assertEqual(fused.__getitems__(["b", "a"]), by_name.__getitems__(["b", "a"]))
+
+    def test_pickle_drops_index_map(self):
+        fused = fuse_index_maps(self.pipeline)
+        self.assertIsNotNone(fused.index_map)
+        fused2 = pickle.loads(pickle.dumps(fused))
+        self.assertIsNone(fused2.index_map)
+        self.assertEqual(fused2[7], fused[7])
+        self.assertIsNotNone(fused2.index_map)
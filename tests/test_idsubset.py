@@ -1,8 +1,14 @@
+import os
+import pickle
+import tempfile
 import unittest
 
+import numpy as np
+
 import torch
 from torch.utils.data import TensorDataset
-from hscitorchutil.dataset import IdBasedMapSubset
+from hscitorchutil.dataset import IdBasedMapSubset, EntryTransformingMapDataset, identity_transformation
+from hscitorchutil.ids import StringIdArray
 
 class TestIdBasedMapSubset(unittest.TestCase):
     def setUp(self):
@@ -15,3 +21,77 @@ class TestIdBasedMapSubset(unittest.TestCase):
         self.assertEqual(ds[1], (4,))
         self.assertEqual(ds[2], (5,))
         self.assertEqual(ds.__getitems__([0,2]), [(3,),(5,)])
+
+    def test_idsubset_ranges(self):
+        ds = IdBasedMapSubset(EntryTransformingMapDataset(
+            self.dataset, lambda x: x), range(2, 9))
+        self.assertEqual(ds.__getitems__(range(1, 4)), [(3,), (4,), (5,)])
+        ds = IdBasedMapSubset(EntryTransformingMapDataset(
+            self.dataset, lambda x: x), [9, 1, 5, 7])
+        self.assertEqual(ds.__getitems__(range(1, 3)), [(1,), (5,)])
+
+    def test_idsubset_numpy_ids(self):
+        ds = IdBasedMapSubset(EntryTransformingMapDataset(
+            self.dataset, identity_transformation), np.array([9, 1, 5, 7]))
+        self.assertEqual(len(ds), 4)
+        self.assertEqual(ds[0], (9,))
+        self.assertEqual(ds.__getitems__([3, 1]), [(7,), (1,)])
+
+    def test_idsubset_memmapped_ids(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "ids.npy")
+            np.save(path, np.arange(10, dtype=np.int64)[::-1])
+            ds = IdBasedMapSubset(EntryTransformingMapDataset(
+                self.dataset, identity_transformation), path)
+            self.assertEqual(ds.__getitems__([0, 2]), [(9,), (7,)])
+            self.assertIsInstance(ds.ids, np.memmap)
+            state = pickle.dumps(ds)
+            self.assertLess(len(state), 1000)
+            ds2 = pickle.loads(state)
+            self.assertEqual(ds2.__getitems__([1, 9]), [(8,), (0,)])
+
+    def test_idsubset_string_ids(self):
+        dataset = _KeyEchoDataset()
+        ids = StringIdArray.from_strings(["foo", "bär", "", "baz"])
+        ds = IdBasedMapSubset(dataset, ids)
+        self.assertEqual(ds.__getitems__([3, 1, 2]), ["baz", "bär", ""])
+        with tempfile.TemporaryDirectory() as tmp:
+            ids.save(os.path.join(tmp, "ids"))
+            ds = IdBasedMapSubset(dataset, StringIdArray.load(os.path.join(tmp, "ids")))
+            ds2 = pickle.loads(pickle.dumps(ds))
+            self.assertEqual(ds2.__getitems__([0, 1]), ["foo", "bär"])
+            self.assertEqual(ds2[3], "baz")
+
+    def test_idsubset_id_types(self):
+        dataset = _KeyEchoDataset()
+        ds = IdBasedMapSubset(dataset, ["foo", "bär", "baz"])
+        self.assertIsInstance(ds.ids, StringIdArray)
+        self.assertEqual(ds.__getitems__([2, 0]), ["baz", "foo"])
+        ds = IdBasedMapSubset(dataset, [("a", 1), ("b", 2)])
+        self.assertEqual(ds.__getitems__([1, 0]), [("b", 2), ("a", 1)])
+        self.assertEqual(ds.__getitems__(range(0, 2)), [("a", 1), ("b", 2)])
+        ds = IdBasedMapSubset(dataset, [1, "1", 2.5])
+        self.assertEqual(ds.__getitems__([0, 1, 2]), [1, "1", 2.5])
+        ds = IdBasedMapSubset(dataset, (3, 1, 2))
+        self.assertEqual(ds.ids.dtype, np.int64)
+        self.assertEqual(ds.__getitems__([0, 1]), [3, 1])
+
+    def test_idsubset_passes_on_ranges(self):
+        dataset = _KeyEchoDataset()
+        ds = IdBasedMapSubset(dataset, [7, 2, 3, 4, 5, 9])
+        self.assertEqual(ds.__getitems__(range(1, 5)), [2, 3, 4, 5])
+        self.assertEqual(ds.__getitems__([2, 3]), [3, 4])
+        self.assertEqual(ds.__getitems__(range(0, 3)), [7, 2, 3])
+        self.assertEqual(dataset.received, [range, range, list])
+
+
+class _KeyEchoDataset:
+    def __init__(self):
+        self.received = []
+
+    def __getitem__(self, key):
+        return key
+
+    def __getitems__(self, keys):
+        self.received.append(type(keys))
+        return list(keys)
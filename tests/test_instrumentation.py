@@ -0,0 +1,133 @@
+import unittest
+
+import torch
+from torch.utils.data import Dataset, TensorDataset
+
+from hscitorchutil.dataset import (ABaseDataModule, CachingMapDataset, DatasetToIterableDataset, ExceptionHandlingMapDataset,
+                                   FastCollate, InstrumentedMapDataset, LinearMapSubset, PipelineMetrics,
+                                   ShuffledMapDataset, UnionMapDataset, instrument_pipeline)
+
+
+class _FailingDataset(Dataset):
+    def __init__(self, n: int, failing: set[int]):
+        self.n = n
+        self.failing = failing
+
+    def __getitem__(self, idx):
+        if idx in self.failing:
+            raise ValueError(idx)
+        return idx
+
+    def __getitems__(self, indices):
+        return [self[idx] for idx in indices]
+
+    def __len__(self):
+        return self.n
+
+
+class _DataModule(ABaseDataModule):
+    def __init__(self, **kwargs):
+        kwargs.setdefault("batch_size", 4)
+        super().__init__(pin_memory=False, collate_fn=FastCollate(), **kwargs)
+        self.val_dataset = ExceptionHandlingMapDataset(
+            CachingMapDataset(_FailingDataset(40, {3, 17}), max_bytes=1 << 20))
+
+
+class TestInstrumentation(unittest.TestCase):
+    def test_layers(self):
+        metrics = PipelineMetrics()
+        cache = CachingMapDataset(TensorDataset(torch.arange(100)), max_bytes=1 << 20)
+        pipeline = LinearMapSubset(cache, 10, 60)
+        instrumented = instrument_pipeline(pipeline, metrics, "train")
+        self.assertIsInstance(instrumented, InstrumentedMapDataset)
+        self.assertIs(instrumented.dataset, pipeline)
+        self.assertIs(pipeline.dataset.dataset, cache)
+        self.assertEqual(metrics.layers, ["train/LinearMapSubset", "train/LinearMapSubset/CachingMapDataset",
+                                          "train/LinearMapSubset/CachingMapDataset/TensorDataset"])
+        self.assertEqual(metrics.parents, [None, 0, 1])
+        self.assertEqual(instrumented.__getitems__([0, 1, 2]), [(10,), (11,), (12,)])
+        self.assertEqual(instrumented.__getitems__([1, 2, 3]), [(11,), (12,), (13,)])
+        self.assertEqual(instrumented[3], (13,))
+        self.assertEqual(len(instrumented), 50)
+        summary = metrics.summary()
+        self.assertEqual(summary["train/LinearMapSubset/calls"], 3)
+        self.assertEqual(summary["train/LinearMapSubset/samples"], 7)
+        self.assertEqual(summary["train/LinearMapSubset/CachingMapDataset/hits"], 3)
+        self.assertEqual(summary["train/LinearMapSubset/CachingMapDataset/misses"], 4)
+        self.assertAlmostEqual(summary["train/LinearMapSubset/CachingMapDataset/hit_rate"], 3 / 7)
+        self.assertEqual(summary["train/LinearMapSubset/CachingMapDataset/TensorDataset/samples"], 4)
+        self.assertGreaterEqual(summary["train/LinearMapSubset/seconds"],
+                                summary["train/LinearMapSubset/CachingMapDataset/seconds"])
+        self.assertGreater(summary["train/LinearMapSubset/latency_p99_ms"], 0)
+        # the layers are instrumented in place
+        self.assertEqual(cache.hits, 3)
+        self.assertIs(instrument_pipeline(instrumented, metrics, "train"), instrumented)
+        instrument_pipeline(pipeline, metrics, "val")
+        self.assertEqual(metrics.layers[3:], ["val/LinearMapSubset"])
+        metrics.reset()
+        self.assertEqual(metrics.summary(), {})
+
+    def test_union_and_attributes(self):
+        metrics = PipelineMetrics()
+        union = UnionMapDataset([TensorDataset(torch.arange(5)), TensorDataset(torch.arange(5, 8))])
+        instrumented = instrument_pipeline(ShuffledMapDataset(union, seed=0), metrics)
+        self.assertEqual(metrics.layers[2:], ["ShuffledMapDataset/UnionMapDataset[0]/TensorDataset",
+                                              "ShuffledMapDataset/UnionMapDataset[1]/TensorDataset"])
+        self.assertEqual(sorted(instrumented.__getitems__(list(range(8)))), [(i,) for i in range(8)])
+        instrumented.set_epoch(1)
+        self.assertEqual(instrumented.dataset.epoch, 1)
+        iterable = instrument_pipeline(DatasetToIterableDataset(union), metrics)
+        self.assertIsInstance(iterable, DatasetToIterableDataset)
+        self.assertEqual(sorted(x for (x,) in iterable), list(range(8)))
+        self.assertEqual(metrics.summary()["DatasetToIterableDataset/UnionMapDataset/samples"], 8)
+
+    def test_too_many_layers(self):
+        with self.assertRaises(ValueError):
+            instrument_pipeline(LinearMapSubset(TensorDataset(torch.arange(3))), PipelineMetrics(max_layers=1))
+
+    def test_datamodule(self):
+        dm = _DataModule()
+        self.assertIs(dm.val_dataloader().dataset, dm.val_dataset)
+        self.assertEqual(dm.data_metrics(), {})
+        for workers in (0, 2):
+            dm = _DataModule(instrument=True, num_val_workers=workers)
+            self.assertEqual(torch.cat(list(dm.val_dataloader())).tolist(), sorted(set(range(40)) - {3, 17}))
+            metrics = dm.data_metrics()
+            self.assertEqual(metrics["val/ExceptionHandlingMapDataset/calls"], 10)
+            self.assertEqual(metrics["val/ExceptionHandlingMapDataset/samples"], 40)
+            self.assertEqual(metrics["val/ExceptionHandlingMapDataset/fallbacks"], 2)
+            self.assertEqual(metrics["val/ExceptionHandlingMapDataset/failures"], 2)
+            # failing batches are retried in halves
+            self.assertGreater(metrics["val/ExceptionHandlingMapDataset/CachingMapDataset/misses"], 40)
+            if workers == 0:
+                self.assertEqual(metrics["val/ExceptionHandlingMapDataset/CachingMapDataset/misses"],
+                                 dm.val_dataset.dataset.misses)
+            self.assertEqual(metrics["val/collate/FastCollate/calls"], 10)
+            self.assertEqual(metrics["val/collate/FastCollate/dropped"], 0)
+
+    def test_datamodule_shared_rows(self):
+        # the persistent training and validation workers with the same id record to the same row
+        dm = _DataModule(instrument=True, num_train_workers=2, num_val_workers=2, batch_size=1)
+        dm.train_dataset = ExceptionHandlingMapDataset(_FailingDataset(40, {5}))
+        dm.sampler_factory = lambda dataset, stage: torch.utils.data.SequentialSampler(dataset)
+        for _ in range(3):
+            for _ in zip(dm.train_dataloader(), dm.val_dataloader()):
+                pass
+        metrics = dm.data_metrics()
+        for stage, failures in (("train", 1), ("val", 2)):
+            self.assertEqual(metrics[f"{stage}/ExceptionHandlingMapDataset/calls"], 3 * 40)
+            self.assertEqual(metrics[f"{stage}/ExceptionHandlingMapDataset/failures"], 3 * failures)
+            self.assertEqual(metrics[f"{stage}/collate/FastCollate/calls"], 3 * 40)
+
+    def test_datamodule_reshuffles(self):
+        dm = _DataModule(instrument=True)
+        dm.train_dataset = ShuffledMapDataset(TensorDataset(torch.arange(40)), seed=0)
+        dm.sampler_factory = lambda dataset, stage: torch.utils.data.SequentialSampler(dataset)
+        epochs = []
+        for epoch in range(2):
+            dm.train_dataset.set_epoch(epoch)
+            epochs.append(torch.cat([batch for batch, in dm.train_dataloader()]).tolist())
+        self.assertEqual(sorted(epochs[0]), list(range(40)))
+        self.assertEqual(sorted(epochs[1]), list(range(40)))
+        self.assertNotEqual(epochs[0], epochs[1])
+        self.assertEqual(dm.data_metrics()["train/ShuffledMapDataset/samples"], 80)
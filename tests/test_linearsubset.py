@@ -2,7 +2,7 @@ import unittest
 
 import torch
 from torch.utils.data import TensorDataset
-from hscitorchutil.dataset import LinearMapSubset
+from hscitorchutil.dataset import LinearMapSubset, EntryTransformingMapDataset
 
 class TestLinearMapSubset(unittest.TestCase):
     def setUp(self):
@@ -15,3 +15,16 @@ class TestLinearMapSubset(unittest.TestCase):
         self.assertEqual(ds[1], (4,))
         self.assertEqual(ds[2], (5,))
         self.assertEqual(ds.__getitems__([0,2]), [(3,),(5,)])
+
+    def test_linearsubset_passes_ranges(self):
+        requested = []
+
+        class _Recording(EntryTransformingMapDataset):
+            def __getitems__(self, indices):
+                requested.append(indices)
+                return super().__getitems__(indices)
+        ds = LinearMapSubset(_Recording(self.dataset, lambda x: x), start=2, end=8)
+        self.assertEqual(ds.__getitems__([1, 2, 3]), [(3,), (4,), (5,)])
+        self.assertEqual(requested[-1], range(3, 6))
+        self.assertEqual(ds.__getitems__([3, 1]), [(5,), (3,)])
+        self.assertEqual(requested[-1], [5, 3])
@@ -0,0 +1,62 @@
+import threading
+import unittest
+
+import torch
+from torch.utils.data import BatchSampler, DataLoader, SequentialSampler, TensorDataset
+from hscitorchutil.dataset import CachingMapDataset, EntryTransformingMapDataset, LookaheadBatch, PrefetchBatchSampler, PrefetchingMapDataset
+
+
+def _record_thread(l):
+    return [(x[0].item(), threading.get_ident()) for x in l]
+
+
+def _record_main_thread(l):
+    return [(x[0].item(), threading.current_thread() is threading.main_thread()) for x in l]
+
+
+class TestPrefetchingMapDataset(unittest.TestCase):
+    def setUp(self):
+        self.dataset = EntryTransformingMapDataset(TensorDataset(torch.arange(20)), _record_thread)
+
+    def test_lookahead_batches(self):
+        batches = list(PrefetchBatchSampler(BatchSampler(SequentialSampler(range(10)), 2, False), depth=2, num_workers=2))
+        self.assertEqual(batches, [[0, 1], [2, 3], [4, 5], [6, 7], [8, 9]])
+        self.assertEqual([b.upcoming for b in batches], [
+                         [[4, 5], [8, 9]], [[6, 7]], [[8, 9]], [], []])
+
+    def test_prefetching(self):
+        ds = PrefetchingMapDataset(self.dataset, depth=2)
+        sampler = PrefetchBatchSampler(BatchSampler(SequentialSampler(range(20)), 4, False), depth=2)
+        out = [ds.__getitems__(batch) for batch in sampler]
+        self.assertEqual([i for batch in out for i, _ in batch], list(range(20)))
+        self.assertEqual((ds.hits, ds.misses), (4, 1))
+        self.assertTrue(all(t != threading.get_ident() for batch in out[1:] for _, t in batch))
+        # an unexpected batch (e.g. after restoring state) cancels pending prefetches
+        self.assertEqual([i for i, _ in ds.__getitems__(LookaheadBatch([0, 1], [[2, 3]]))], [0, 1])
+        self.assertEqual([i for i, _ in ds.__getitems__([5, 6])], [5, 6])
+        self.assertEqual(len(ds._state.get().pending), 0)
+        ds.close()
+
+    def test_dataloader(self):
+        dataset = EntryTransformingMapDataset(TensorDataset(torch.arange(20)), _record_main_thread)
+        for num_workers in (0, 2):
+            ds = PrefetchingMapDataset(dataset, depth=2)
+            dl = DataLoader(ds, batch_sampler=PrefetchBatchSampler(BatchSampler(SequentialSampler(range(20)), 3, False), depth=2, num_workers=num_workers),
+                            num_workers=num_workers, collate_fn=lambda batch: batch)
+            self.assertEqual(len(dl), 7)
+            batches = list(dl)
+            self.assertEqual([i for batch in batches for i, _ in batch], list(range(20)))
+            # prefetch hits were fetched off the main thread (of the worker processes)
+            self.assertGreater(sum(not main for batch in batches for _, main in batch[:1]), 0)
+            if num_workers == 0:
+                self.assertGreater(ds.hits, 0)
+
+    def test_caching_under_prefetching(self):
+        cache = CachingMapDataset(TensorDataset(torch.arange(200)), max_bytes=1 << 10)
+        ds = PrefetchingMapDataset(cache, depth=4, max_workers=4)
+        for _ in range(3):
+            sampler = PrefetchBatchSampler(BatchSampler(SequentialSampler(range(200)), 5, False), depth=4)
+            self.assertEqual([x[0].item() for batch in sampler for x in ds.__getitems__(batch)], list(range(200)))
+        self.assertEqual(cache.hits + cache.misses, 600)
+        self.assertGreater(ds.hits, 0)
+        ds.close()
@@ -0,0 +1,65 @@
+import multiprocessing
+import pickle
+import threading
+import unittest
+
+from hscitorchutil.processlocal import ProcessLocalResource
+
+
+class _Resource:
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def _resource_id(resource: ProcessLocalResource, queue) -> None:
+    queue.put(id(resource.get()))
+
+
+class TestProcessLocalResource(unittest.TestCase):
+    def test_lazy_and_cached(self):
+        created = []
+
+        def factory():
+            created.append(_Resource())
+            return created[-1]
+        resource = ProcessLocalResource(factory)
+        self.assertEqual(created, [])
+        r = resource.get()
+        self.assertIs(resource.get(), r)
+        self.assertEqual(len(created), 1)
+        resource.close()
+        self.assertTrue(r.closed)
+        self.assertIsNot(resource.get(), r)
+
+    def test_per_thread(self):
+        resource = ProcessLocalResource(_Resource, per_thread=True)
+        main = resource.get()
+        others = []
+        t = threading.Thread(target=lambda: others.append(resource.get()))
+        t.start()
+        t.join()
+        self.assertIsNot(others[0], main)
+        self.assertIs(resource.get(), main)
+        resource.close()
+        self.assertTrue(main.closed)
+        self.assertTrue(others[0].closed)
+
+    def test_pickling(self):
+        resource = ProcessLocalResource(_Resource)
+        r = resource.get()
+        resource2 = pickle.loads(pickle.dumps(resource))
+        self.assertIsNot(resource2.get(), r)
+
+    def test_fork(self):
+        resource = ProcessLocalResource(_Resource)
+        r = resource.get()
+        ctx = multiprocessing.get_context("fork")
+        queue = ctx.Queue()
+        p = ctx.Process(target=_resource_id, args=(resource, queue))
+        p.start()
+        child_id = queue.get()
+        p.join()
+        self.assertNotEqual(child_id, id(r))
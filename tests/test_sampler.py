@@ -0,0 +1,130 @@
+import unittest
+
+import torch
+from torch.utils.data import TensorDataset
+from torchdata.stateful_dataloader import StatefulDataLoader
+from hscitorchutil.dataset import ABaseDataModule, UnionMapDataset
+from hscitorchutil.sampler import LengthBucketBatchSampler, PartitionedDistributedSampler
+
+
+class TestPartitionedDistributedSampler(unittest.TestCase):
+    def test_contiguous(self):
+        samplers = [PartitionedDistributedSampler(range(10), num_replicas=3, rank=rank, seed=1) for rank in range(3)]
+        partitions = [list(sampler) for sampler in samplers]
+        self.assertEqual([len(p) for p in partitions], [4, 4, 4])
+        self.assertEqual(sorted(set(partitions[0])), [0, 1, 2])
+        self.assertEqual(sorted(set(partitions[2])), [6, 7, 8, 9])
+        self.assertEqual(set(sum(partitions, [])), set(range(10)))
+        dropped = PartitionedDistributedSampler(range(10), num_replicas=3, rank=2, drop_last=True)
+        self.assertEqual(len(list(dropped)), 3)
+
+    def test_epochs(self):
+        sampler = PartitionedDistributedSampler(range(100), num_replicas=2, rank=1, seed=3)
+        first = list(sampler)
+        self.assertEqual(first, list(PartitionedDistributedSampler(range(100), num_replicas=2, rank=1, seed=3)))
+        self.assertEqual(sorted(first), list(range(50, 100)))
+        sampler.set_epoch(1)
+        second = list(sampler)
+        self.assertNotEqual(first, second)
+        self.assertEqual(sorted(second), list(range(50, 100)))
+        ordered = PartitionedDistributedSampler(range(100), num_replicas=2, rank=1, shuffle=False)
+        self.assertEqual(list(ordered), list(range(50, 100)))
+
+    def test_shards(self):
+        union = UnionMapDataset([TensorDataset(torch.arange(n)) for n in (50, 10, 30, 20, 10)])
+        partitions = [sorted(set(PartitionedDistributedSampler(union, num_replicas=2, rank=rank, partition="shards")))
+                      for rank in range(2)]
+        # shards of 50 and 10 vs. shards of 30, 20 and 10
+        self.assertEqual(partitions[0], list(range(0, 60)))
+        self.assertEqual(partitions[1], list(range(60, 120)))
+        with self.assertRaises(ValueError):
+            PartitionedDistributedSampler(range(10), num_replicas=2, rank=0, partition="shards")
+        with self.assertRaises(ValueError):
+            PartitionedDistributedSampler(range(10), num_replicas=3, rank=0, partition="shards", shard_offsets=[0, 5])
+
+    def test_block_shuffle(self):
+        sampler = PartitionedDistributedSampler(range(64), num_replicas=2, rank=0, block_size=8)
+        indices = list(sampler)
+        self.assertEqual(sorted(indices), list(range(32)))
+        self.assertNotEqual(indices, list(range(32)))
+
+    def test_resume(self):
+        sampler = PartitionedDistributedSampler(range(40), num_replicas=2, rank=0, seed=5)
+        sampler.set_epoch(2)
+        dl = StatefulDataLoader(list(range(40)), sampler=sampler, batch_size=4)
+        it = iter(dl)
+        seen = [next(it).tolist() for _ in range(2)]
+        state = dl.state_dict()
+        rest = [batch.tolist() for batch in it]
+        sampler2 = PartitionedDistributedSampler(range(40), num_replicas=2, rank=0, seed=5)
+        dl2 = StatefulDataLoader(list(range(40)), sampler=sampler2, batch_size=4)
+        dl2.load_state_dict(state)
+        self.assertEqual([batch.tolist() for batch in dl2], rest)
+        self.assertEqual(sorted(sum(seen + rest, [])), list(range(20)))
+
+
+class _DataModule(ABaseDataModule):
+    def __init__(self, **kwargs):
+        super().__init__(batch_size=5, pin_memory=False, **kwargs)
+        self.train_dataset = list(range(20))
+        self.val_dataset = list(range(20))
+
+
+def _partition(dataset, stage):
+    return PartitionedDistributedSampler(dataset, num_replicas=2, rank=1, shuffle=stage == "train")
+
+
+class TestDataModuleSamplers(unittest.TestCase):
+    def test_default(self):
+        dm = _DataModule()
+        self.assertEqual(sorted(torch.cat(list(dm.train_dataloader())).tolist()), list(range(20)))
+        self.assertEqual(torch.cat(list(dm.val_dataloader())).tolist(), list(range(20)))
+
+    def test_sampler_factory(self):
+        dm = _DataModule(sampler_factory=_partition)
+        self.assertEqual(sorted(torch.cat(list(dm.train_dataloader())).tolist()), list(range(10, 20)))
+        self.assertEqual(torch.cat(list(dm.val_dataloader())).tolist(), list(range(10, 20)))
+
+    def test_batch_sampler_factory(self):
+        dm = _DataModule(batch_sampler_factory=lambda dataset, stage: [[0, 1], [2]] if stage == "val" else None)
+        self.assertEqual([batch.tolist() for batch in dm.val_dataloader()], [[0, 1], [2]])
+        self.assertEqual(len(dm.train_dataloader()), 4)
+
+
+class TestLengthBucketBatchSampler(unittest.TestCase):
+    def setUp(self):
+        self.lengths = (torch.arange(200) * 7919 % 100 + 1).numpy()
+
+    def test_budget(self):
+        sampler = LengthBucketBatchSampler(self.lengths, max_tokens=400, pool_size=50, seed=1)
+        batches = list(sampler)
+        self.assertEqual(len(batches), len(sampler))
+        self.assertEqual(sorted(sum(batches, [])), list(range(200)))
+        for batch in batches:
+            self.assertLessEqual(len(batch) * max(self.lengths[batch]), 400)
+        unpadded = list(LengthBucketBatchSampler(self.lengths, max_tokens=400, padded=False, max_batch_size=6))
+        for batch in unpadded:
+            self.assertLessEqual(sum(self.lengths[batch]), 400)
+            self.assertLessEqual(len(batch), 6)
+        self.assertEqual(list(LengthBucketBatchSampler([5, 50, 5], max_tokens=20, shuffle=False)), [[0, 2], [1]])
+
+    def test_epochs_and_ranks(self):
+        sampler = LengthBucketBatchSampler(self.lengths, max_tokens=400, seed=1)
+        first = list(sampler)
+        self.assertEqual(first, list(LengthBucketBatchSampler(self.lengths, max_tokens=400, seed=1)))
+        sampler.set_epoch(1)
+        self.assertNotEqual(first, list(sampler))
+        ranks = [list(LengthBucketBatchSampler(self.lengths, max_tokens=400, seed=1, num_replicas=2, rank=rank)) for rank in range(2)]
+        self.assertEqual(len(ranks[0]), len(ranks[1]))
+        self.assertFalse(set(sum(ranks[0], [])) & set(sum(ranks[1], [])))
+
+    def test_resume(self):
+        dataset = list(range(200))
+        dl = StatefulDataLoader(dataset, batch_sampler=LengthBucketBatchSampler(self.lengths, max_tokens=400), collate_fn=list)
+        it = iter(dl)
+        [next(it) for _ in range(3)]
+        state = dl.state_dict()
+        rest = list(it)
+        dl2 = StatefulDataLoader(dataset, batch_sampler=LengthBucketBatchSampler(self.lengths, max_tokens=400), collate_fn=list)
+        dl2.load_state_dict(state)
+        self.assertEqual(list(dl2), rest)
@@ -3,6 +3,7 @@ import unittest
 import torch
 from torch.utils.data import TensorDataset
 from hscitorchutil.dataset import ShuffledMapDataset
+from hscitorchutil.permutation import BlockShufflePermutation, FeistelPermutation
 import pickle
 
 class TestShuffledMapDataset(unittest.TestCase):
@@ -32,3 +33,89 @@ class TestShuffledMapDataset(unittest.TestCase):
         self.assertEqual(ds2[1], (0,))
         self.assertEqual(ds2[2], (1,))
         self.assertEqual(ds2.__getitems__([0,2]), [(2,),(1,)])
+
+    def test_shuffleddataset_epochs(self):
+        ds = ShuffledMapDataset(TensorDataset(torch.arange(100)), seed=1)
+        epoch0 = [item[0].item() for item in ds.__getitems__(list(range(100)))]
+        self.assertEqual(sorted(epoch0), list(range(100)))
+        ds.set_epoch(1)
+        epoch1 = [ds[i][0].item() for i in range(100)]
+        self.assertEqual(sorted(epoch1), list(range(100)))
+        self.assertNotEqual(epoch0, epoch1)
+        ds2 = pickle.loads(pickle.dumps(ds))
+        self.assertEqual([ds2[i][0].item() for i in range(100)], epoch1)
+        ds.set_epoch(0)
+        self.assertEqual([ds[i][0].item() for i in range(100)], epoch0)
+
+    def test_shuffleddataset_indices(self):
+        ds = ShuffledMapDataset(TensorDataset(torch.arange(10)), seed=0, indices=[1, 3, 5, 7])
+        self.assertEqual(len(ds), 4)
+        self.assertEqual(sorted(item[0].item() for item in ds.__getitems__([0, 1, 2, 3])), [1, 3, 5, 7])
+
+    def test_shuffleddataset_key_types(self):
+        ds = ShuffledMapDataset(_Keys(), seed=0, indices=[1, "a", (2, 3)])
+        self.assertEqual(sorted(map(repr, ds.__getitems__([0, 1, 2]))), ["'a'", "(2, 3)", "1"])
+        ds = ShuffledMapDataset(_Keys(), seed=0, indices=["a", "b", "c"])
+        self.assertEqual(sorted(ds.__getitems__([0, 1, 2])), ["a", "b", "c"])
+        self.assertEqual(sorted(pickle.loads(pickle.dumps(ds)).__getitems__([0, 1, 2])), ["a", "b", "c"])
+
+    def test_shuffleddataset_persistent_workers(self):
+        from torchdata.stateful_dataloader import StatefulDataLoader
+        ds = ShuffledMapDataset(TensorDataset(torch.arange(40)), seed=0)
+        dl = StatefulDataLoader(ds, batch_size=8, num_workers=2, persistent_workers=True)
+        epochs = []
+        for epoch in range(3):
+            ds.set_epoch(epoch)
+            epochs.append(torch.cat([batch for batch, in dl]).tolist())
+            self.assertEqual(sorted(epochs[-1]), list(range(40)))
+        self.assertNotEqual(epochs[0], epochs[1])
+        self.assertNotEqual(epochs[1], epochs[2])
+        # the workers shuffle like the main process
+        self.assertEqual(epochs[2], [ds[i][0].item() for i in range(40)])
+        ds.set_epoch(0)
+        self.assertEqual(torch.cat([batch for batch, in dl]).tolist(), epochs[0])
+
+    def test_shuffleddataset_copy(self):
+        import copy
+        ds = ShuffledMapDataset(TensorDataset(torch.arange(100)), seed=1)
+        copied = copy.copy(ds)
+        copied.set_epoch(1)
+        self.assertEqual(ds.epoch, 0)
+        self.assertEqual(ds.__getitems__(list(range(100))), ShuffledMapDataset(
+            TensorDataset(torch.arange(100)), seed=1).__getitems__(list(range(100))))
+
+
+class _Keys(torch.utils.data.Dataset):
+    def __getitem__(self, key):
+        return key
+
+
+class TestFeistelPermutation(unittest.TestCase):
+    def test_bijection(self):
+        for n in (1, 2, 3, 7, 64, 1000, 4097):
+            for seed in range(3):
+                self.assertEqual(sorted(FeistelPermutation(n, seed)[:]), list(range(n)))
+        self.assertEqual(FeistelPermutation(1000, 5)[:], FeistelPermutation(1000, 5)[:])
+        self.assertNotEqual(FeistelPermutation(1000, 5)[:], FeistelPermutation(1000, 6)[:])
+        with self.assertRaises(IndexError):
+            FeistelPermutation(10, 0)[10]
+
+
+class TestBlockShuffle(unittest.TestCase):
+    def test_block_shuffle(self):
+        for n in (10, 100, 1003):
+            p = BlockShufflePermutation(n, block_size=8, window_size=32, seed=0)
+            values = p[:]
+            self.assertEqual(sorted(values), list(range(n)))
+            for start in range(0, n, 32):
+                # each window draws from at most window_size / block_size full blocks (plus the tail)
+                self.assertLessEqual(len({v // 8 for v in values[start:start + 32]}), 5)
+        self.assertNotEqual(BlockShufflePermutation(1000, 8, 32, seed=0)[:], BlockShufflePermutation(1000, 8, 32, seed=0, epoch=1)[:])
+
+    def test_block_shuffled_dataset(self):
+        ds = ShuffledMapDataset(TensorDataset(torch.arange(100)), seed=3, block_size=10, window_size=20)
+        values = [item[0].item() for item in ds.__getitems__(list(range(100)))]
+        self.assertEqual(sorted(values), list(range(100)))
+        self.assertNotEqual(values, list(range(100)))
+        ds2 = pickle.loads(pickle.dumps(ds))
+        self.assertEqual([ds2[i][0].item() for i in range(100)], values)
@@ -3,6 +3,7 @@ from pathlib import Path
 import sqlite3
 from typing import Sequence, cast
 
+import numpy as np
 import pytest
 from torch import Tensor
 from torch.utils.data import Dataset
@@ -76,6 +77,36 @@ def test_sqlitedatamodule(dbname: str, tmp_path):
     assert len(db.val_dataloader()) == 2  # type: ignore
     assert len(db.test_dataloader()) == 2  # type: ignore
 
+def _negate(dataset):
+    from hscitorchutil.dataset import EntryTransformingMapDataset
+    return EntryTransformingMapDataset(dataset, lambda batch: [(-value, id) for value, id in batch])
+
+
+def test_sqlitedatamodule_positional_transforms(dbname: str, tmp_path):
+    from hscitorchutil.sqlite import SQLiteDataModule
+    db = SQLiteDataModule(dbname, dbname, dbname, str(tmp_path / "cache"), "test", "entry_number", "value, id", "id",
+                          {}, _negate, _negate)
+    db.setup("test")
+    assert db.test_dataset.__getitems__([0, 1]) == [(-100, 'foo'), (-200, 'bar')]
+
+
+def test_sqlitedatamodule_staging_options(dbname: str, tmp_path):
+    import fsspec
+    from hscitorchutil.sqlite import SQLiteDataModule
+    fs = fsspec.filesystem("memory")
+    with open(dbname, "rb") as f:
+        fs.pipe_file("/staged/test.db", f.read())
+    url = "memory://staged/test.db"
+    db = SQLiteDataModule(url, url, url, str(tmp_path / "cache"), "test", "entry_number", "value, id", "id",
+                          staging_options={"max_files": 2, "revalidate": True, "part_size": 1024})
+    db.prepare_sqlite_databases()
+    db.setup("fit")
+    db.setup("test")
+    assert db.test_dataset[2] == (300, 'barfoo')
+    assert db.train_dataset.sqlite_filename.startswith(str(tmp_path / "cache"))
+    fs.rm("/staged", recursive=True)
+
+
 def test_dataloader_state(dbname: str, tmp_path):
     from hscitorchutil.sqlite import SQLiteDataModule
     db = SQLiteDataModule(dbname, dbname, dbname, str(
@@ -133,3 +164,188 @@ def test_dataloader_state_with_workers(largedbname: str, tmp_path):
             outs.remove(item.item())
     assert len(outs) == 0
 
+
+
+def test_sqlitedataset_request_order(largedbname: str):
+    from hscitorchutil.sqlite import SQLiteDataset
+    db = SQLiteDataset(largedbname, "test", "entry_number", "value, id", "id")
+    assert db.__getitems__([5, 3, 5, 0]) == [
+        (500, 'foo_5'), (300, 'foo_3'), (500, 'foo_5'), (0, 'foo_0')]
+    assert db.__getitems__(['foo_7', 'foo_2', 'foo_7']) == [
+        (700, 'foo_7'), (200, 'foo_2'), (700, 'foo_7')]
+    assert db.__getitems__([]) == []
+    with pytest.raises(KeyError):
+        db.__getitems__([1, 1000])
+
+
+def test_sqlitedataset_large_batch(largedbname: str):
+    from hscitorchutil.sqlite import SQLiteDataset
+    db = SQLiteDataset(largedbname, "test", "entry_number",
+                       "value, id", "id", max_query_parameters=8)
+    idxs = list(reversed(range(100))) + [42, 42]
+    assert db.__getitems__(idxs) == [(i*100, f'foo_{i}') for i in idxs]
+    assert db.__getitems__(idxs) == [(i*100, f'foo_{i}') for i in idxs]
+    with pytest.raises(KeyError):
+        db.__getitems__(idxs + [1000])
+    assert db.__getitems__(list(range(9))) == [
+        (i*100, f'foo_{i}') for i in range(9)]
+
+
+def test_sqlitedataset_columnar(tmp_path):
+    from hscitorchutil.sqlite import SQLiteDataset
+    from hscitorchutil.dataset import collate_columns
+    import numpy as np
+    import torch
+    db_path = str(tmp_path / "columnar.db")
+    con = sqlite3.connect(db_path)
+    with con:
+        con.execute(
+            "CREATE TABLE test (entry_number INTEGER PRIMARY KEY, id TEXT, value INTEGER, score REAL, data BLOB, maybe INTEGER)")
+        con.executemany("INSERT INTO test VALUES (?, ?, ?, ?, ?, ?)", [
+                        (i, f'foo_{i}', i*100, i/2, bytes([i]*3), i if i % 2 else None) for i in range(4)])
+    con.close()
+    db = SQLiteDataset(db_path, "test", "entry_number",
+                       "value, score, id, data, maybe", "id", columnar="numpy")
+    assert db.column_names == ['value', 'score', 'id', 'data', 'maybe']
+    assert db[2] == (200, 1.0, 'foo_2', bytes([2]*3), None)
+    batch = db.__getitems__([3, 1, 3])
+    assert batch['value'].dtype == np.int64
+    assert batch['value'].tolist() == [300, 100, 300]
+    assert batch['score'].tolist() == [1.5, 0.5, 1.5]
+    assert batch['id'] == ['foo_3', 'foo_1', 'foo_3']
+    assert [bytes(b) for b in batch['data']] == [bytes([3]*3), bytes([1]*3), bytes([3]*3)]
+    assert batch['maybe'].tolist() == [3, 1, 3]
+    assert np.isnan(db.__getitems__([0, 1])['maybe'][0])
+    collated = collate_columns(batch)
+    assert isinstance(collated['value'], torch.Tensor)
+    assert collated['value'].tolist() == [300, 100, 300]
+    assert collated['id'] == ['foo_3', 'foo_1', 'foo_3']
+    db = SQLiteDataset(db_path, "test", "entry_number",
+                       "value", "id", columnar="torch")
+    assert db.__getitems__([1, 2])['value'].tolist() == [100, 200]
+    assert isinstance(db.__getitems__([1, 2])['value'], torch.Tensor)
+
+
+def test_sqlitedataset_columnar_mixed_types(tmp_path):
+    from hscitorchutil.sqlite import SQLiteDataset
+    import numpy as np
+    db_path = str(tmp_path / "mixed.db")
+    con = sqlite3.connect(db_path)
+    with con:
+        # columns without a declared type keep whatever type each value has
+        con.execute("CREATE TABLE test (entry_number INTEGER PRIMARY KEY, id TEXT, number, anything)")
+        con.executemany("INSERT INTO test VALUES (?, ?, ?, ?)", [
+                        (0, 'foo_0', 1, 1), (1, 'foo_1', 2.5, 'two'), (2, 'foo_2', None, b'three')])
+    con.close()
+    db = SQLiteDataset(db_path, "test", "entry_number", "number, anything", "id", columnar="numpy")
+    batch = db.__getitems__([0, 1])
+    assert batch['number'].dtype == np.float64
+    assert batch['number'].tolist() == [1.0, 2.5]
+    assert batch['anything'] == [1, 'two']
+    batch = db.__getitems__([2, 0, 1])
+    assert np.isnan(batch['number'][0]) and batch['number'][1:].tolist() == [1.0, 2.5]
+    assert batch['anything'] == [b'three', 1, 'two']
+
+
+def test_sqlitedataset_lazy_connections(largedbname: str):
+    from hscitorchutil.sqlite import SQLiteDataset
+    import pickle
+    import threading
+    db = SQLiteDataset(largedbname, "test", "entry_number", "value, id", "id")
+    assert not hasattr(db._connections._local, "resources")
+    assert db[3] == (300, 'foo_3')
+    db2 = pickle.loads(pickle.dumps(db))
+    assert not hasattr(db2._connections._local, "resources")
+    assert db2[4] == (400, 'foo_4')
+    assert db2.sqlite is not db.sqlite
+    db.close()
+    assert db[5] == (500, 'foo_5')
+    results = []
+    t = threading.Thread(target=lambda: results.append(db[6]))
+    t.start()
+    t.join()
+    assert results == [(600, 'foo_6')]
+    db = SQLiteDataset(largedbname, "test", "entry_number",
+                       "value, id", "id", per_thread_connections=True)
+    connections = []
+    t = threading.Thread(target=lambda: connections.append(db.sqlite))
+    t.start()
+    t.join()
+    assert connections[0] is not db.sqlite
+
+
+def test_sqlitedataset_range_scans(largedbname: str):
+    from hscitorchutil.sqlite import SQLiteDataset
+    db = SQLiteDataset(largedbname, "test", "entry_number",
+                       "value, id", "id", min_range_scan=4)
+    assert db.__getitems__(range(10, 20)) == [
+        (i*100, f'foo_{i}') for i in range(10, 20)]
+    idxs = [50, 3, 4, 5, 6, 7, 1, 20, 21, 22, 23, 2]
+    assert db.__getitems__(idxs) == [(i*100, f'foo_{i}') for i in idxs]
+    with pytest.raises(KeyError, match="100"):
+        db.__getitems__(range(95, 105))
+    with pytest.raises(KeyError, match="100"):
+        db.__getitems__([1] + list(range(96, 102)))
+
+
+def test_iterablesqlitedataset(largedbname: str):
+    from hscitorchutil.sqlite import IterableSQLiteDataset
+    ds = IterableSQLiteDataset(largedbname, "test", "entry_number", "value, id", fetch_size=7)
+    assert list(ds) == [(i*100, f'foo_{i}') for i in range(100)]
+    ds = IterableSQLiteDataset(largedbname, "test", "entry_number", "id",
+                               where="value % ? = 0", parameters=(1000,))
+    assert list(ds) == [(f'foo_{i}',) for i in range(0, 100, 10)]
+    shards = [list(IterableSQLiteDataset(largedbname, "test", "entry_number", "value", rank=rank, world_size=3))
+              for rank in range(3)]
+    assert [len(shard) for shard in shards] == [33, 33, 34]
+    assert sorted(sum(shards, [])) == [(i*100,) for i in range(100)]
+
+
+def test_iterablesqlitedataset_resume(largedbname: str):
+    from hscitorchutil.sqlite import IterableSQLiteDataset
+    from torchdata.stateful_dataloader import StatefulDataLoader
+    ds = IterableSQLiteDataset(largedbname, "test", "entry_number", "value")
+    it = iter(ds)
+    assert [next(it) for _ in range(3)] == [(0,), (100,), (200,)]
+    resumed = IterableSQLiteDataset(largedbname, "test", "entry_number", "value")
+    resumed.load_state_dict(ds.state_dict())
+    assert next(iter(resumed)) == (300,)
+    dl = StatefulDataLoader(IterableSQLiteDataset(largedbname, "test", "entry_number", "value"),
+                            batch_size=10, num_workers=2)
+    it = iter(dl)
+    seen = [next(it) for _ in range(4)]
+    state = dl.state_dict()
+    dl = StatefulDataLoader(IterableSQLiteDataset(largedbname, "test", "entry_number", "value"),
+                            batch_size=10, num_workers=2)
+    dl.load_state_dict(state)
+    values = sorted(v.item() for batch in seen + list(dl) for v in batch[0])
+    assert values == [i*100 for i in range(100)]
+
+
+def test_sqlitedataset_read_column(largedbname: str):
+    from hscitorchutil.sqlite import SQLiteDataset
+    db = SQLiteDataset(largedbname, "test", "entry_number", "value, id", "id")
+    values = db.read_column("value", fetch_size=7)
+    assert values.dtype == np.int32
+    assert values.tolist() == [i*100 for i in range(100)]
+    assert db.read_column("length(id)").tolist() == [len(f'foo_{i}') for i in range(100)]
+
+
+def test_sqlitedataset_read_column_types(tmp_path):
+    from hscitorchutil.sqlite import SQLiteDataset
+    db_path = str(tmp_path / "read_column.db")
+    con = sqlite3.connect(db_path)
+    with con:
+        con.execute("CREATE TABLE test (entry_number INTEGER PRIMARY KEY, id TEXT, score REAL, maybe INTEGER)")
+        con.executemany("INSERT INTO test VALUES (?, ?, ?, ?)", [
+                        (i, f'foo_{i}', i + 0.5, i if i % 2 else None) for i in range(4)])
+    con.close()
+    db = SQLiteDataset(db_path, "test", "entry_number", "score", "id")
+    scores = db.read_column("score", dtype=np.float32)
+    assert scores.dtype == np.float32
+    assert scores.tolist() == [0.5, 1.5, 2.5, 3.5]
+    maybe = db.read_column("maybe", dtype=np.float64)
+    assert np.isnan(maybe[[0, 2]]).all() and maybe[[1, 3]].tolist() == [1, 3]
+    assert db.read_column("maybe", fill_value=-1).tolist() == [-1, 1, -1, 3]
+    with pytest.raises(ValueError, match="NULL"):
+        db.read_column("maybe")
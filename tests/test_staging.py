@@ -0,0 +1,135 @@
+import json
+import os
+import threading
+
+import fsspec
+import pytest
+from fsspec.implementations.memory import MemoryFileSystem
+
+from hscitorchutil.staging import stage_file, stage_files
+
+
+@pytest.fixture
+def remote():
+    fs = fsspec.filesystem("memory")
+    data = bytes(range(256)) * 1000
+    fs.pipe_file("/bucket/data.bin", data)
+    yield fs, data
+    fs.rm("/bucket", recursive=True)
+
+
+@pytest.fixture
+def fetches(monkeypatch):
+    calls = []
+    cat_file = MemoryFileSystem.cat_file
+
+    def counting_cat_file(self, path, start=None, end=None, **kwargs):
+        calls.append((start, end))
+        return cat_file(self, path, start=start, end=end, **kwargs)
+    monkeypatch.setattr(MemoryFileSystem, "cat_file", counting_cat_file)
+    return calls
+
+
+def test_stage_file(remote, fetches, tmp_path):
+    fs, data = remote
+    lpath = stage_file("memory://bucket/data.bin", str(tmp_path), part_size=10000)
+    assert lpath == os.path.join(str(tmp_path), "memory:_@__@_bucket_@_data.bin")
+    with open(lpath, "rb") as f:
+        assert f.read() == data
+    assert len(fetches) == 26
+    assert json.load(open(lpath + ".meta.json"))["size"] == len(data)
+    # valid copies are not downloaded again
+    assert stage_file("memory://bucket/data.bin", str(tmp_path), part_size=10000) == lpath
+    assert stage_file("memory://bucket/data.bin", str(tmp_path), revalidate=False) == lpath
+    assert len(fetches) == 26
+    # changed files are
+    fs.pipe_file("/bucket/data.bin", data[:1000])
+    stage_file("memory://bucket/data.bin", str(tmp_path), part_size=10000)
+    with open(lpath, "rb") as f:
+        assert f.read() == data[:1000]
+    assert len(fetches) == 27
+
+
+def test_local_files_are_not_staged(tmp_path):
+    path = str(tmp_path / "local.bin")
+    open(path, "wb").close()
+    assert stage_file(path, None) == path
+
+
+def test_resume(remote, fetches, tmp_path):
+    fs, data = remote
+    failing = [True]
+    cat_file = MemoryFileSystem.cat_file
+
+    def flaky_cat_file(self, path, start=None, end=None, **kwargs):
+        if start == 50000 and failing[0]:
+            raise IOError("connection reset")
+        return cat_file(self, path, start=start, end=end, **kwargs)
+    MemoryFileSystem.cat_file = flaky_cat_file
+    try:
+        with pytest.raises(IOError):
+            stage_file("memory://bucket/data.bin", str(tmp_path), part_size=10000, max_workers=1)
+    finally:
+        MemoryFileSystem.cat_file = cat_file
+    assert 5 <= len(fetches) < 26
+    lpath = stage_file("memory://bucket/data.bin", str(tmp_path), part_size=10000, max_workers=1)
+    with open(lpath, "rb") as f:
+        assert f.read() == data
+    # only the missing parts were fetched again
+    assert len(fetches) == 26
+    assert not os.path.exists(lpath + ".part")
+
+
+def test_checksum(remote, tmp_path):
+    import hashlib
+    fs, data = remote
+    expected = hashlib.sha256(data).hexdigest()
+    lpath = stage_file("memory://bucket/data.bin", str(tmp_path), sha256=expected)
+    assert json.load(open(lpath + ".meta.json"))["sha256"] == expected
+    with pytest.raises(ValueError):
+        stage_file("memory://bucket/data.bin", str(tmp_path / "other"), sha256="0" * 64)
+    assert not os.path.exists(os.path.join(str(tmp_path / "other"), os.path.basename(lpath)))
+
+
+def test_concurrent_staging(remote, fetches, tmp_path):
+    fs, data = remote
+    fs.pipe_file("/bucket/other.bin", data[:5000])
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(stage_files(
+        ["memory://bucket/data.bin", "memory://bucket/other.bin", "memory://bucket/data.bin"], str(tmp_path), part_size=100000)))
+        for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(results) == 4 and all(result == results[0] for result in results)
+    assert results[0][0] == results[0][2]
+    # each file was downloaded once
+    assert len(fetches) == 4
+
+
+def test_without_fcntl(monkeypatch, tmp_path):
+    # on Windows, fcntl is missing and files are locked with msvcrt instead
+    import importlib.util
+    import sys
+    import types
+    calls = []
+    msvcrt = types.SimpleNamespace(LK_LOCK=1, LK_UNLCK=0, locking=lambda fd, mode, n: calls.append(mode))
+    monkeypatch.setitem(sys.modules, "fcntl", None)
+    monkeypatch.setitem(sys.modules, "msvcrt", msvcrt)
+    spec = importlib.util.find_spec("hscitorchutil.staging")
+    staging = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(staging)
+    assert staging.fcntl is None
+    with staging._file_lock(str(tmp_path / "file.lock")):
+        assert calls == [msvcrt.LK_LOCK]
+    assert calls == [msvcrt.LK_LOCK, msvcrt.LK_UNLCK]
+
+
+def test_stage_file_without_pwrite(remote, monkeypatch, tmp_path):
+    # os.pwrite is not available on Windows
+    fs, data = remote
+    monkeypatch.delattr(os, "pwrite")
+    lpath = stage_file("memory://bucket/data.bin", str(tmp_path), part_size=10000, max_workers=4)
+    with open(lpath, "rb") as f:
+        assert f.read() == data
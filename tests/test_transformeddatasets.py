@@ -1,9 +1,11 @@
 import functools
+import threading
+import time
 import unittest
 
 import torch
 from torch.utils.data import TensorDataset
-from hscitorchutil.dataset import KeyTransformingMapDataset, EntryTransformingMapDataset
+from hscitorchutil.dataset import KeyTransformingMapDataset, EntryTransformingMapDataset, TransformPool
 import pickle
 
 
@@ -62,3 +64,40 @@ class TestTransformedMapDataset(unittest.TestCase):
         self.assertEqual(ds2[-1], 3)
         self.assertEqual(ds2[-2], 4)
         self.assertEqual(ds2.__getitems__([0, -2]), [2, 4])
+
+
+_active = 0
+_max_active = 0
+_lock = threading.Lock()
+
+
+def _slow_transform(l):
+    global _active, _max_active
+    with _lock:
+        _active += 1
+        _max_active = max(_max_active, _active)
+    time.sleep(0.01)
+    with _lock:
+        _active -= 1
+    return [x[0] * 10 for x in l]
+
+
+class TestParallelTransforms(unittest.TestCase):
+    def test_thread_pool(self):
+        pool = TransformPool('thread', max_workers=4, max_pending=2)
+        ds = EntryTransformingMapDataset(TensorDataset(torch.arange(20)), _slow_transform, pool=pool, chunk_size=3)
+        ds2 = EntryTransformingMapDataset(TensorDataset(torch.arange(20)), _transform, pool=pool)
+        idxs = list(reversed(range(20)))
+        self.assertEqual(ds.__getitems__(idxs), [i * 10 for i in idxs])
+        self.assertEqual(ds2.__getitems__(idxs), [i + 2 for i in idxs])
+        self.assertEqual(ds[3], 30)
+        self.assertLessEqual(_max_active, 2)
+        ds3 = pickle.loads(pickle.dumps(ds))
+        self.assertEqual(ds3.__getitems__(idxs), [i * 10 for i in idxs])
+        pool.close()
+
+    def test_process_pool(self):
+        pool = TransformPool('process', max_workers=2)
+        ds = EntryTransformingMapDataset(TensorDataset(torch.arange(10)), _transform, pool=pool)
+        self.assertEqual(ds.__getitems__(list(range(10))), [i + 2 for i in range(10)])
+        pool.close()
@@ -25,3 +25,23 @@ class TestUnionMapDataset(unittest.TestCase):
         ds = UnionMapDataset(self.datasets2)
         self.assertEqual(ds.__getitems__([0, 8, 3, 2]), [
                          (0,), (8,), (3,), (2,)])
+
+    def test_uniondataset_ranges(self):
+        ds = UnionMapDataset(self.datasets2)
+        self.assertEqual(ds.__getitems__(range(2, 8)), [
+                         (i,) for i in range(2, 8)])
+        self.assertEqual(ds.__getitems__(range(3, 6)), [
+                         (i,) for i in range(3, 6)])
+        with self.assertRaises(IndexError):
+            ds.__getitems__(range(len(ds) - 2, len(ds) + 1))
+        with self.assertRaises(IndexError):
+            ds.__getitems__(range(-1, 2))
+
+    def test_uniondataset_mixed_and_concurrent(self):
+        for max_workers in (0, 4):
+            ds = UnionMapDataset([self.datasets[0], self.datasets2[1], self.datasets2[2]], max_workers=max_workers)
+            self.assertEqual(ds.__getitems__([7, 0, 4, 8, 3, 2, 7]), [
+                             (7,), (0,), (4,), (8,), (3,), (2,), (7,)])
+            self.assertEqual(ds.__getitems__([]), [])
+            with self.assertRaises(IndexError):
+                ds.__getitems__([9])
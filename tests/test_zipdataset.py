@@ -0,0 +1,225 @@
+import io
+import logging
+import pickle
+import random
+import zipfile
+
+import fsspec
+import pytest
+from fsspec.implementations.memory import MemoryFileSystem
+
+from hscitorchutil.zipdataset import EDZipMapDataset, coalesce_ranges
+from hscitorchutil.zipdirectory import create_sqlite_directory
+
+
+@pytest.fixture(scope="module")
+def archive(tmp_path_factory):
+    directory = tmp_path_factory.mktemp("zips")
+    zip_path = str(directory / "members.zip")
+    rng = random.Random(0)
+    contents = {}
+    with zipfile.ZipFile(zip_path, "w") as zf:
+        for i in range(50):
+            name = f"member_{i}.bin"
+            contents[name] = bytes(rng.getrandbits(8) for _ in range(rng.randrange(0, 3000))) if i % 2 else f"text {i} ".encode() * 100
+            zf.writestr(name, contents[name], compress_type=zipfile.ZIP_DEFLATED if i % 3 else zipfile.ZIP_STORED)
+    sqlite_filename = str(directory / "members.sqlite3")
+    create_sqlite_directory(zip_path, sqlite_filename, progress=False)
+    return zip_path, sqlite_filename, contents
+
+
+def test_coalesce_ranges():
+    starts, ends, assignment = coalesce_ranges([100, 0, 500, 130], [120, 50, 600, 140], max_gap=60, max_range=1000)
+    assert (starts, ends, assignment) == ([0, 500], [140, 600], [0, 0, 1, 0])
+    starts, ends, assignment = coalesce_ranges([0, 60, 120], [50, 110, 170], max_gap=60, max_range=120)
+    assert (starts, ends, assignment) == ([0, 120], [110, 170], [0, 0, 1])
+
+
+def test_zipdataset(archive):
+    zip_path, sqlite_filename, contents = archive
+    names = list(contents)
+    ds = EDZipMapDataset(zip_path, sqlite_filename)
+    assert len(ds) == 50
+    assert ds[3] == contents[names[3]]
+    assert ds["member_7.bin"] == contents["member_7.bin"]
+    idxs = [9, 2, 40, 2, 0]
+    assert ds.__getitems__(idxs) == [contents[names[i]] for i in idxs]
+    assert ds.__getitems__(["member_1.bin", "member_0.bin"]) == [contents["member_1.bin"], contents["member_0.bin"]]
+    ds2 = pickle.loads(pickle.dumps(ds))
+    assert ds2.__getitems__(list(range(50))) == list(contents.values())
+    with pytest.raises(KeyError):
+        ds["missing"]
+
+
+def test_coalesced_remote_reads(archive, monkeypatch):
+    zip_path, sqlite_filename, contents = archive
+    remote = fsspec.filesystem("memory")
+    with open(zip_path, "rb") as f:
+        remote.pipe_file("/zips/members.zip", f.read())
+    requests = []
+    cat_ranges = MemoryFileSystem.cat_ranges
+
+    def counting_cat_ranges(self, paths, starts, ends, **kwargs):
+        requests.append(len(starts))
+        return cat_ranges(self, paths, starts, ends, **kwargs)
+    monkeypatch.setattr(MemoryFileSystem, "cat_ranges", counting_cat_ranges)
+    ds = EDZipMapDataset("memory://zips/members.zip", sqlite_filename)
+    idxs = list(range(0, 50, 2))
+    assert ds.__getitems__(idxs) == [list(contents.values())[i] for i in idxs]
+    assert requests == [1]
+    ds = EDZipMapDataset("memory://zips/members.zip", sqlite_filename, max_gap=0, max_range=4096, header_slack=0)
+    assert ds.__getitems__(idxs) == [list(contents.values())[i] for i in idxs]
+    assert requests[1] == len(idxs)
+    remote.rm("/zips", recursive=True)
+
+
+def test_edzip_directory(archive, tmp_path):
+    from edzip.sqlite import create_sqlite_directory_from_zip
+    zip_path, _, contents = archive
+    sqlite_filename = str(tmp_path / "edzip.sqlite3")
+    with zipfile.ZipFile(zip_path) as zf:
+        create_sqlite_directory_from_zip(zf, sqlite_filename).close()
+    ds = EDZipMapDataset(zip_path, sqlite_filename)
+    assert ds.__getitems__([5, 4]) == [contents["member_5.bin"], contents["member_4.bin"]]
+
+
+def test_memory_mapped(archive, monkeypatch):
+    import numpy as np
+    from fsspec.implementations.local import LocalFileSystem
+    zip_path, sqlite_filename, contents = archive
+    monkeypatch.setattr(LocalFileSystem, "cat_ranges", None)
+    ds = EDZipMapDataset(zip_path, sqlite_filename, zero_copy=True)
+    members = ds.__getitems__(list(range(50)))
+    assert members == list(contents.values())
+    for i, member in enumerate(members):
+        assert isinstance(member, memoryview if i % 3 == 0 else bytes)
+    assert np.frombuffer(members[3], dtype=np.uint8).tobytes() == contents["member_3.bin"]
+    ds.close()
+    assert members[3] == contents["member_3.bin"]
+    assert ds[6] == contents["member_6.bin"]
+    ds = EDZipMapDataset(zip_path, sqlite_filename)
+    assert all(isinstance(member, bytes) for member in ds.__getitems__([0, 3, 1]))
+    ds2 = pickle.loads(pickle.dumps(ds))
+    assert ds2[9] == contents["member_9.bin"]
+
+
+@pytest.mark.parametrize("protocol", ["simplecache", "filecache", "blockcache"])
+def test_cached(archive, protocol, tmp_path):
+    zip_path, sqlite_filename, contents = archive
+    ds = EDZipMapDataset(f"{protocol}::file://{zip_path}", sqlite_filename,
+                         storage_options={protocol: {"cache_storage": str(tmp_path)}}, zero_copy=True)
+    # whole-file caches are memory mapped, block caches are read in ranges
+    assert (ds._mapping is not None) == (protocol != "blockcache")
+    members = ds.__getitems__(list(range(50)))
+    assert members == list(contents.values())
+    assert isinstance(members[0], bytes if protocol == "blockcache" else memoryview)
+    ds.close()
+
+
+@pytest.fixture(scope="module")
+def compressed_archive(tmp_path_factory):
+    directory = tmp_path_factory.mktemp("compressed")
+    zip_path = str(directory / "compressed.zip")
+    contents = {}
+    methods = [zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED, zipfile.ZIP_BZIP2, zipfile.ZIP_LZMA]
+    with zipfile.ZipFile(zip_path, "w") as zf:
+        for i in range(40):
+            name = f"text_{i}.txt"
+            contents[name] = " ".join(f"word{j * i}" for j in range(i * 50)).encode()
+            zf.writestr(name, contents[name], compress_type=methods[i % 4])
+    sqlite_filename = str(directory / "compressed.sqlite3")
+    create_sqlite_directory(zip_path, sqlite_filename, progress=False)
+    return zip_path, sqlite_filename, contents
+
+
+@pytest.mark.parametrize("remote", [False, True])
+def test_pooled_decompression(compressed_archive, remote, monkeypatch):
+    from hscitorchutil.dataset import TransformPool
+    zip_path, sqlite_filename, contents = compressed_archive
+    if remote:
+        fs = fsspec.filesystem("memory")
+        with open(zip_path, "rb") as f:
+            fs.pipe_file("/compressed/compressed.zip", f.read())
+        zip_path = "memory://compressed/compressed.zip"
+    chunks = []
+    pool = TransformPool("thread", 4)
+    pool_map = pool.map
+    monkeypatch.setattr(pool, "map", lambda fn, items: chunks.append(len(items)) or pool_map(fn, items))
+    ds = EDZipMapDataset(zip_path, sqlite_filename, pool=pool, verify_crc=True)
+    idxs = [39, 0, 5, 22, 22, 13, 8, 31, 2]
+    assert [bytes(member) for member in ds.__getitems__(idxs)] == [list(contents.values())[i] for i in idxs]
+    assert 1 < chunks[0] <= 4
+    assert ds[6] == contents["text_6.txt"]
+    assert len(chunks) == 1
+    pool.close()
+    if remote:
+        fs.rm("/compressed", recursive=True)
+
+
+def test_verify_crc(compressed_archive, tmp_path):
+    from edzip.sqlite import create_sqlite_directory_from_zip
+    zip_path, sqlite_filename, contents = compressed_archive
+    with open(zip_path, "rb") as f:
+        data = bytearray(f.read())
+    with zipfile.ZipFile(zip_path) as zf:
+        info = zf.getinfo("text_4.txt")
+    # flip a byte of a stored member
+    position = info.header_offset + 30 + len(info.filename) + len(info.extra) + 10
+    data[position] ^= 0xFF
+    corrupt_path = str(tmp_path / "corrupt.zip")
+    with open(corrupt_path, "wb") as f:
+        f.write(data)
+    assert EDZipMapDataset(corrupt_path, sqlite_filename)[4] != contents["text_4.txt"]
+    with pytest.raises(ValueError, match="CRC"):
+        EDZipMapDataset(corrupt_path, sqlite_filename, verify_crc=True)[4]
+    assert EDZipMapDataset(corrupt_path, sqlite_filename, verify_crc=True)[5] == contents["text_5.txt"]
+    # without a crc column, the local header is used
+    legacy_filename = str(tmp_path / "legacy.sqlite3")
+    with zipfile.ZipFile(corrupt_path) as zf:
+        create_sqlite_directory_from_zip(zf, legacy_filename).close()
+    ds = EDZipMapDataset(corrupt_path, legacy_filename, verify_crc=True)
+    assert ds.__getitems__([2, 3]) == [contents["text_2.txt"], contents["text_3.txt"]]
+    with pytest.raises(ValueError, match="CRC"):
+        ds[4]
+
+
+def test_process_pool_rejected(compressed_archive):
+    from hscitorchutil.dataset import TransformPool
+    zip_path, sqlite_filename, _ = compressed_archive
+    with pytest.raises(ValueError, match="thread pool"):
+        EDZipMapDataset(zip_path, sqlite_filename, pool=TransformPool("process", 2))
+
+
+class _Unseekable(io.RawIOBase):
+    def __init__(self, f):
+        self.f = f
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        return self.f.write(b)
+
+
+def test_verify_crc_data_descriptors(tmp_path, caplog):
+    from edzip.sqlite import create_sqlite_directory_from_zip
+    zip_path = str(tmp_path / "streamed.zip")
+    with open(zip_path, "wb") as f, zipfile.ZipFile(_Unseekable(f), "w") as zf:
+        for i in range(3):
+            with zf.open(f"member_{i}.txt", "w") as member:
+                member.write(f"member {i}".encode())
+    sqlite_filename = str(tmp_path / "streamed.sqlite3")
+    with zipfile.ZipFile(zip_path) as zf:
+        assert all(info.flag_bits & 0x8 for info in zf.infolist())
+        create_sqlite_directory_from_zip(zf, sqlite_filename).close()
+    ds = EDZipMapDataset(zip_path, sqlite_filename, verify_crc=True)
+    with caplog.at_level(logging.WARNING):
+        assert ds.__getitems__([0, 2]) == [b"member 0", b"member 2"]
+        assert ds[1] == b"member 1"
+    assert len([record for record in caplog.records if "data descriptors" in record.getMessage()]) == 1
+    # the directory of hscitorchutil.zipdirectory records the CRC-32
+    directory = str(tmp_path / "streamed.offsets.sqlite3")
+    create_sqlite_directory(zip_path, directory, progress=False)
+    caplog.clear()
+    assert EDZipMapDataset(zip_path, directory, verify_crc=True)[1] == b"member 1"
+    assert not caplog.records
@@ -0,0 +1,89 @@
+import sqlite3
+import zipfile
+
+import fsspec
+import pytest
+from click.testing import CliRunner
+
+from hscitorchutil.zipdirectory import create_sqlite_directory, locate_central_directory, read_central_directory
+
+
+@pytest.fixture(scope="module")
+def zip_path(tmp_path_factory) -> str:
+    path = str(tmp_path_factory.mktemp("zips") / "test.zip")
+    with zipfile.ZipFile(path, "w") as zf:
+        zf.writestr("stored.txt", b"hello" * 100, compress_type=zipfile.ZIP_STORED)
+        zf.writestr("deflated.txt", b"world" * 100, compress_type=zipfile.ZIP_DEFLATED)
+        zf.writestr("ünïcödé/名前.bin", bytes(range(256)))
+        with zf.open("zip64.bin", "w", force_zip64=True) as f:
+            f.write(b"x" * 1000)
+        zf.comment = b"a comment"
+    return path
+
+
+def _expected(path):
+    with zipfile.ZipFile(path) as zf:
+        return [(zi.filename, zi.header_offset, zi.compress_size, zi.compress_type, zi.file_size, zi.CRC) for zi in zf.infolist()]
+
+
+def test_read_central_directory(zip_path):
+    fs = fsspec.filesystem("file")
+    directory = locate_central_directory(fs, zip_path)
+    assert directory.entries == 4
+    assert [tuple(entry) for entry in read_central_directory(fs, zip_path, chunk_size=50)] == _expected(zip_path)
+
+
+def test_prepended_data(zip_path, tmp_path):
+    path = str(tmp_path / "prepended.zip")
+    with open(path, "wb") as f, open(zip_path, "rb") as zf:
+        f.write(b"#!/bin/sh\n" * 10)
+        f.write(zf.read())
+    fs = fsspec.filesystem("file")
+    assert [tuple(entry) for entry in read_central_directory(fs, path)] == _expected(path)
+
+
+def test_zip64_many_entries(tmp_path):
+    path = str(tmp_path / "many.zip")
+    with zipfile.ZipFile(path, "w") as zf:
+        for i in range(70000):
+            zf.writestr(f"{i}", b"")
+    fs = fsspec.filesystem("file")
+    assert locate_central_directory(fs, path).entries == 70000
+    assert [tuple(entry) for entry in read_central_directory(fs, path, chunk_size=1 << 16)] == _expected(path)
+    prepended = str(tmp_path / "prepended-many.zip")
+    with open(prepended, "wb") as f, open(path, "rb") as zf:
+        f.write(b"#!/bin/sh\n" * 10)
+        f.write(zf.read())
+    directory = locate_central_directory(fs, prepended)
+    assert (directory.entries, directory.concat) == (70000, 100)
+    assert [tuple(entry) for entry in read_central_directory(fs, prepended)] == _expected(prepended)
+
+
+def test_create_sqlite_directory(zip_path, tmp_path):
+    remote = fsspec.filesystem("memory")
+    with open(zip_path, "rb") as f:
+        remote.pipe_file("/zips/test.zip", f.read())
+    sqlite_filename = str(tmp_path / "test.sqlite3")
+    assert create_sqlite_directory("memory://zips/test.zip", sqlite_filename, progress=False) == 4
+    con = sqlite3.connect(sqlite_filename)
+    rows = con.execute(
+        "SELECT filename, header_offset, compressed_size, compress_type, file_size, crc FROM offsets ORDER BY file_number").fetchall()
+    assert rows == _expected(zip_path)
+    # compatible with edzip
+    from edzip.sqlite import SQLiteExternalDirectory
+    directory = SQLiteExternalDirectory(con)
+    assert directory.getinfo("deflated.txt").header_offset == rows[1][1]
+    remote.rm("/zips", recursive=True)
+
+
+def test_cli(zip_path, tmp_path):
+    from hscitorchutil.sqlite import main
+    runner = CliRunner()
+    legacy = str(tmp_path / "legacy.sqlite3")
+    result = runner.invoke(main, [zip_path, legacy])
+    assert result.exit_code == 0, result.output
+    assert sqlite3.connect(legacy).execute("SELECT COUNT(*) FROM offsets").fetchone()[0] == 4
+    result = runner.invoke(main, ["-o", str(tmp_path), "-j", "1", zip_path, zip_path])
+    assert result.exit_code == 0, result.output
+    assert sqlite3.connect(str(tmp_path / "test.zip.offsets.sqlite3")).execute(
+        "SELECT COUNT(*) FROM offsets").fetchone()[0] == 4